@@ -0,0 +1,114 @@
+"""
+对话历史写入基准测试 - 比较每轮对话写入的字节数
+旧方案：每轮把最多 MAX_HISTORY_LEN 条历史序列化成JSON，INSERT OR REPLACE 整行
+新方案：每轮向 messages 表追加两行（database.append_messages）
+
+用法：python -m bench.bench_history_writes [轮数]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import tool.database as database
+
+USER_ID = "bench_user"
+USER_MESSAGE = "今天心情不太好，陪我聊聊天吧"
+AI_MESSAGE = "怎么啦？发生什么事了，说出来我听听，也许会好受一点。"
+
+
+def _written_bytes():
+    """返回本进程累计写入的字节数（Linux 的 /proc/self/io 中的 wchar），不支持时返回 None。"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _db_size(path):
+    """
+    先把 WAL 中的内容合并回数据库文件并截断 WAL，再返回数据库文件大小。
+    直接加上未合并的 -wal 文件会把同一页的多次改写都算进去，夸大 WAL 模式下的占用。
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return sum(os.path.getsize(p) for p in (path, path + '-wal', path + '-journal') if os.path.exists(p))
+
+
+def bench_json_blob(path, turns):
+    """旧方案：整段JSON重写。"""
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE conversations (user_id TEXT PRIMARY KEY, history TEXT NOT NULL)')
+    conn.commit()
+    empty_size = _db_size(path)
+    history = []
+    payload = 0
+    for _ in range(turns):
+        row = conn.execute('SELECT history FROM conversations WHERE user_id = ?', (USER_ID,)).fetchone()
+        history = json.loads(row[0]) if row else []
+        history.append({"role": "user", "content": USER_MESSAGE})
+        history.append({"role": "assistant", "content": AI_MESSAGE})
+        history_json = json.dumps(history[-config.MAX_HISTORY_LEN:], ensure_ascii=False)
+        payload += len(history_json.encode('utf-8'))
+        conn.execute('INSERT OR REPLACE INTO conversations (user_id, history) VALUES (?, ?)', (USER_ID, history_json))
+        conn.commit()
+    conn.close()
+    return payload, empty_size
+
+
+def bench_append(path, turns):
+    """新方案：追加消息行。"""
+    database.DATABASE_FILE = path
+    database.init_db()
+    empty_size = _db_size(path)
+    payload = 0
+    with Flask(__name__).app_context():
+        for _ in range(turns):
+            database.get_user_session(USER_ID)
+            database.append_messages(USER_ID, [
+                {"role": "user", "content": USER_MESSAGE},
+                {"role": "assistant", "content": AI_MESSAGE},
+            ])
+            payload += len(USER_MESSAGE.encode('utf-8')) + len(AI_MESSAGE.encode('utf-8'))
+            # 每轮都重新查库，排除缓存的影响
+            database.invalidate_user_cache(USER_ID)
+    return payload, empty_size
+
+
+def run(name, func, turns):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    before = _written_bytes()
+    start = time.perf_counter()
+    payload, empty_size = func(path, turns)
+    elapsed = time.perf_counter() - start
+    after = _written_bytes()
+
+    print(f"[{name}]")
+    print(f"  每轮耗时:       {elapsed / turns * 1000:.3f} ms")
+    print(f"  每轮内容字节:   {payload / turns:.0f} B")
+    if before is not None:
+        print(f"  每轮实际写入:   {(after - before) / turns:.0f} B (wchar)")
+    size = _db_size(path)
+    # 新方案的库里还有访问统计等表，空表结构本身就占若干页，单独列出
+    print(f"  数据库文件大小: {size} B（空表结构 {empty_size} B，数据增长 {size - empty_size} B）")
+
+
+if __name__ == '__main__':
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print(f"模拟单个用户连续 {turns} 轮对话，MAX_HISTORY_LEN={config.MAX_HISTORY_LEN}")
+    run("整段JSON重写", bench_json_blob, turns)
+    run("追加消息行", bench_append, turns)
@@ -0,0 +1,95 @@
+"""
+天气页面解析基准测试 - 比较每个地区页面的解析耗时
+旧方案：html5lib（或可用的解析器）构建整棵文档树后再查找 div.conMidtab
+新方案：weather.parse_region，只构建 div.conMidtab 子树
+
+样本页面是 weather.com.cn 的原始页面，不随仓库提交：需要先在能访问该网站的机器上抓取一次，之后可以离线重复测试。
+没有样本时脚本报错退出（退出码 1），不会输出空结果。
+
+用法：
+    python -m bench.bench_weather_parse --save bench/fixtures   # 先抓取页面保存为样本
+    python -m bench.bench_weather_parse bench/fixtures [重复次数]
+"""
+
+import glob
+import os
+import sys
+import time
+from bs4 import BeautifulSoup, FeatureNotFound
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tool.weather as weather
+
+
+def save_fixtures(directory):
+    """抓取所有地区页面并保存到 directory，返回是否至少保存了一个页面。"""
+    os.makedirs(directory, exist_ok=True)
+    saved = 0
+    for url in weather.URLS:
+        html = weather._fetch_region_html(url)
+        if html is None:
+            continue
+        path = os.path.join(directory, os.path.basename(url).replace('.shtml', '.html'))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        saved += 1
+        print(f"已保存 {path}")
+    if not saved:
+        print("没有抓取到任何页面，请检查能否访问 weather.com.cn。")
+    return saved > 0
+
+
+def full_tree_soup(html):
+    """旧方案：优先使用 html5lib 构建整棵文档树。"""
+    for parser in ("html5lib", "lxml", "html.parser"):
+        try:
+            return BeautifulSoup(html, parser)
+        except FeatureNotFound:
+            continue
+    raise RuntimeError("未找到可用的 HTML 解析器")
+
+
+def parse_full_tree(html):
+    soup = full_tree_soup(html)
+    div = soup.find("div", class_="conMidtab")
+    return len(div.find_all("tr")) if div else 0
+
+
+def measure(func, html, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(html)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run(directory, repeat):
+    paths = sorted(glob.glob(os.path.join(directory, '*.html')))
+    if not paths:
+        print(f"{directory} 中没有样本页面。样本不随仓库提交，请先在能访问 weather.com.cn 的机器上抓取：\n"
+              f"    python -m bench.bench_weather_parse --save {directory}")
+        return False
+
+    print(f"{'地区':<10}{'大小(KB)':>10}{'整棵树(ms)':>14}{'子树(ms)':>12}{'城市数':>8}")
+    total_old = total_new = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        old_ms = measure(parse_full_tree, html, repeat)
+        new_ms = measure(weather.parse_region, html, repeat)
+        cities = len(weather.parse_region(html))
+        total_old += old_ms
+        total_new += new_ms
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f"{name:<10}{len(html.encode('utf-8')) / 1024:>10.0f}{old_ms:>14.1f}{new_ms:>12.1f}{cities:>8}")
+    print(f"{'合计':<10}{'':>10}{total_old:>14.1f}{total_new:>12.1f}")
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--save':
+        sys.exit(0 if save_fixtures(sys.argv[2]) else 1)
+    else:
+        directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'fixtures')
+        repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        sys.exit(0 if run(directory, repeat) else 1)
@@ -0,0 +1,49 @@
+"""
+流式响应解码检查 - 用本地 Cloudflare 桩服务返回中文回复，比较同步客户端的流式和非流式结果
+SSE 响应不带 charset，解码方式不对时流式结果会变成乱码，STREAM_MAX_CHARS 的截断也会按错误的字数计算。
+
+用法：python -m bench.check_stream_encoding
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import tool.chatAI as chatAI
+from stubs.cloudflare_ai import start_stub
+
+MESSAGES = [{"role": "user", "content": "今天北京天气怎么样？给我讲个笑话吧"}]
+
+
+def run():
+    stub = start_stub(latency='fixed:0', reply_chars=80, token_interval=0)
+    config.CF_API_BASE = stub.base_url
+    config.ACCOUNT_ID = config.ACCOUNT_ID or "stub"
+    config.AUTH_TOKEN = config.AUTH_TOKEN or "stub"
+    config.STREAM_MAX_CHARS = 0
+    config.STREAM_MAX_SENTENCES = 0
+
+    failures = 0
+    blocking = chatAI.chat_with_cf(MESSAGES, stream=False)
+    streamed = chatAI.chat_with_cf(MESSAGES, stream=True)
+    if streamed != blocking:
+        failures += 1
+        print(f"[失败] 流式结果与非流式不同：\n  流式：{streamed!r}\n  非流式：{blocking!r}")
+
+    # 截断按字符计数：限制30字时，结果应是完整回复的前缀且不超过30字
+    config.STREAM_MAX_CHARS = 30
+    truncated = chatAI.chat_with_cf(MESSAGES, stream=True)
+    if len(truncated) > 30 or not blocking.startswith(truncated):
+        failures += 1
+        print(f"[失败] 截断结果不正确（{len(truncated)}字）：{truncated!r}")
+
+    stub.shutdown()
+    print(f"非流式回复：{blocking}")
+    print("结果：" + ("全部通过" if failures == 0 else f"{failures} 项检查失败"))
+    return failures == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run() else 1)
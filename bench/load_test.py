@@ -0,0 +1,222 @@
+"""
+并发压测 - 以目标速率向运行中的服务发送混合流量（聊天、天气提问、指令），统计延迟和数据库增长
+消息来自多个模拟的 OpenID，按泊松过程到达（开环），延迟从计划发送时刻算起，
+服务变慢时不会因为压测端自己排队而低估延迟。
+
+准备（模型和客服消息都指向本地桩服务，不消耗真实配额）：
+    python -m stubs.cloudflare_ai 8082 --latency lognormal:0.8,0.5 --error-rate 0.01
+    python -m stubs.wechat_api 8081
+    CF_API_BASE=http://127.0.0.1:8082 WECHAT_API_BASE=http://127.0.0.1:8081 \\
+    CLOUDFLARE_ACCOUNT_ID=stub CLOUDFLARE_AUTH_TOKEN=stub python main.py
+
+用法：python -m bench.load_test [--rate 20] [--duration 60] [--users 200] [--mix chat=70,weather=20,command=10]
+      [--out 结果.json] [--compare 上次结果.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import test
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 超过这个时间的被动回复微信不再接收（服务端会在此之前改为客服消息推送）
+WECHAT_DEADLINE = 5.0
+
+MESSAGES = {
+    "chat": [
+        "你好呀", "今天过得怎么样？", "给我讲个笑话吧", "推荐一本适合周末读的书",
+        "怎么才能早点睡着？", "帮我想一个生日祝福", "你喜欢什么音乐？", "解释一下什么是黑洞",
+        "我有点无聊，陪我聊聊天", "学编程应该从哪门语言开始？",
+    ],
+    "weather": [
+        "北京天气怎么样", "今天上海会下雨吗", "广州热不热", "查一下杭州的天气",
+        "成都和重庆今天天气如何", "明天去西安要带伞吗",
+    ],
+    "command": [
+        "/当前身份", "/身份列表", "/指令", "/天气 北京", "/天气 深圳", "/随机身份",
+    ],
+}
+
+
+def parse_mix(spec):
+    """把 chat=70,weather=20,command=10 转换为 ([类型], [权重])。"""
+    kinds, weights = [], []
+    for item in spec.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in MESSAGES:
+            raise ValueError(f"未知的消息类型: {kind}")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def percentile(sorted_values, p):
+    """最近秩法求百分位数，列表为空时返回 0。"""
+    if not sorted_values:
+        return 0.0
+    index = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def db_size(path):
+    """数据库文件加上 WAL 文件的总大小（字节）。"""
+    total = 0
+    for suffix in ('', '-wal'):
+        try:
+            total += os.path.getsize(path + suffix)
+        except OSError:
+            pass
+    return total
+
+
+class LoadTest:
+    def __init__(self, url, rate, duration, users, mix, concurrency):
+        self.url = url
+        self.rate = rate
+        self.duration = duration
+        self.user_ids = [f"load_user_{i:05d}" for i in range(users)]
+        self.kinds, self.weights = parse_mix(mix)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = []  # (类型, 延迟秒, 结果)，结果为 reply / async / error
+        self.msg_base = int(time.time() * 1000) * 1000  # 保证各次运行的 MsgId 不重复
+        self.sent = 0
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _send(self, kind, user_id, content, msg_id, scheduled):
+        xml_data = test.build_message_xml(content, user_id=user_id, msg_id=str(msg_id))
+        try:
+            response = self._session().post(
+                self.url, data=xml_data.encode('utf-8'), params=test.sign_params(),
+                headers={'Content-Type': 'application/xml'}, timeout=30,
+            )
+            response.encoding = 'utf-8'
+            # 文本为 success 表示超过时间预算，回复改为客服消息推送
+            outcome = "async" if response.text.strip() == "success" else "reply"
+            if response.status_code != 200:
+                outcome = "error"
+        except requests.exceptions.RequestException:
+            outcome = "error"
+        latency = time.perf_counter() - scheduled
+        with self.lock:
+            self.results.append((kind, latency, outcome))
+
+    def run(self):
+        start = time.perf_counter()
+        next_at = start
+        end = start + self.duration
+        while next_at < end:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = random.choices(self.kinds, self.weights)[0]
+            content = random.choice(MESSAGES[kind])
+            user_id = random.choice(self.user_ids)
+            self.executor.submit(self._send, kind, user_id, content, self.msg_base + self.sent, next_at)
+            self.sent += 1
+            next_at += random.expovariate(self.rate)
+        self.executor.shutdown(wait=True)
+        return time.perf_counter() - start
+
+
+def summarize(results, elapsed, db_growth):
+    """汇总压测结果，返回可以写入 JSON 的字典。"""
+    latencies = sorted(latency for _, latency, outcome in results if outcome != "error")
+    report = {
+        "sent": len(results),
+        "completed": len(latencies),
+        "errors": sum(1 for *_, outcome in results if outcome == "error"),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "over_deadline": sum(1 for latency in latencies if latency > WECHAT_DEADLINE) / len(latencies) if latencies else 0.0,
+        "async_share": sum(1 for *_, outcome in results if outcome == "async") / len(results) if results else 0.0,
+        "db_growth": db_growth,
+        "by_kind": {},
+    }
+    for kind in sorted({kind for kind, _, _ in results}):
+        values = sorted(latency for k, latency, outcome in results if k == kind and outcome != "error")
+        report["by_kind"][kind] = {
+            "count": len(values), "p50": percentile(values, 50),
+            "p95": percentile(values, 95), "p99": percentile(values, 99),
+        }
+    return report
+
+
+def print_report(report, previous=None):
+    def delta(key, scale=1.0, unit=""):
+        if previous is None or key not in previous:
+            return ""
+        return f"（上次 {previous[key] * scale:.1f}{unit}）"
+
+    print(f"发送 {report['sent']} 条，完成 {report['completed']} 条，失败 {report['errors']} 条，耗时 {report['elapsed']:.1f} 秒")
+    print(f"吞吐量：{report['throughput']:.1f} 条/秒{delta('throughput')}")
+    for key in ("p50", "p95", "p99"):
+        print(f"{key}：{report[key] * 1000:.0f} ms{delta(key, 1000, ' ms')}")
+    print(f"超过5秒的回复：{report['over_deadline']:.1%}{delta('over_deadline', 100, '%')}")
+    print(f"改为客服消息推送：{report['async_share']:.1%}{delta('async_share', 100, '%')}")
+    per_message = report['db_growth'] / report['completed'] if report['completed'] else 0
+    print(f"数据库增长：{report['db_growth'] / 1024:.1f} KB（每条 {per_message:.0f} 字节）{delta('db_growth', 1 / 1024, ' KB')}")
+    print(f"{'类型':<10}{'数量':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for kind, stats in report["by_kind"].items():
+        print(f"{kind:<10}{stats['count']:>8}{stats['p50'] * 1000:>10.0f}{stats['p95'] * 1000:>10.0f}{stats['p99'] * 1000:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发压测：以目标速率发送混合流量")
+    parser.add_argument('--url', default=test.SERVER_URL)
+    parser.add_argument('--rate', type=float, default=20, help="目标速率（条/秒）")
+    parser.add_argument('--duration', type=float, default=60, help="持续时间（秒）")
+    parser.add_argument('--users', type=int, default=200, help="模拟的用户数")
+    parser.add_argument('--mix', default='chat=70,weather=20,command=10', help="各类消息的比例")
+    parser.add_argument('--concurrency', type=int, default=256, help="最多同时进行的请求数")
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'chat_history.db'), help="服务使用的数据库文件")
+    parser.add_argument('--out', help="把结果写入 JSON 文件")
+    parser.add_argument('--compare', help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    test.SERVER_URL = args.url
+    if not test.verify_server():
+        print(f"无法连接服务器 {args.url}，请先启动 main.py 或 server_async.py")
+        return 1
+
+    load = LoadTest(args.url, args.rate, args.duration, args.users, args.mix, args.concurrency)
+    print(f"以 {args.rate} 条/秒向 {args.url} 发送 {args.duration:.0f} 秒，{args.users} 个用户，比例 {args.mix}")
+    size_before = db_size(args.db)
+    elapsed = load.run()
+    # 访问日志由写线程批量提交，稍等一下再统计数据库大小
+    time.sleep(1)
+    report = summarize(load.results, elapsed, db_size(args.db) - size_before)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
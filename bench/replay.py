@@ -0,0 +1,198 @@
+"""
+流量回放 - 把 CAPTURE_ENABLED 采集的真实消息按原始节奏（或加速）重新发送给服务
+保留每个用户的消息顺序：同一用户的下一条消息要等上一条收到回复、并且到了计划时间才发送，
+不同用户之间并发。每条消息换成新的 MsgId，避免被服务端当作微信重试去重。
+
+用法：python -m bench.replay [采集文件 ...] [--speed 1|10|max] [--url http://127.0.0.1:80]
+      [--out 结果.json] [--compare 上次结果.json]
+不指定采集文件时读取 config.CAPTURE_FILE 及其轮转出的 .gz 文件。
+"""
+
+import argparse
+import glob
+import gzip
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import test
+from bench.load_test import db_size, percentile, print_report, summarize
+
+
+def capture_files():
+    """默认的采集文件：轮转出的旧文件在前，当前文件在后（回放前会按时间重新排序）。"""
+    rotated = sorted(glob.glob(config.CAPTURE_FILE + '.*.gz'),
+                     key=lambda path: int(path.rsplit('.', 2)[-2]), reverse=True)
+    return rotated + ([config.CAPTURE_FILE] if os.path.exists(config.CAPTURE_FILE) else [])
+
+
+def load_capture(paths):
+    """读取采集文件，返回按到达时间排序的记录列表。"""
+    entries = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def classify(root):
+    """按消息内容分类，用于分组统计延迟。"""
+    msg_type = root.findtext('MsgType') or ''
+    if msg_type != 'text':
+        return msg_type or 'unknown'
+    return 'command' if (root.findtext('Content') or '').strip().startswith('/') else 'chat'
+
+
+class Replay:
+    def __init__(self, url, entries, speed, concurrency):
+        self.url = url
+        self.speed = speed  # 0 表示不等待，尽快发送
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='replay')
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.ready = []  # (计划发送时刻, 序号, 用户)，每个用户最多有一条在这里
+        self.in_flight = 0
+        self._seq = itertools.count()  # 计划时刻相同时按加入顺序发送
+        self.results = []  # (类型, 延迟秒, 结果)
+        self.lag = []  # 实际发送时刻比计划晚的秒数
+        self.origin_ms = [entry.get("ms", 0) for entry in entries]
+
+        msg_base = int(time.time() * 1000) * 1000
+        self.queues = {}  # 用户 -> 按顺序待发送的 [(相对时间, 类型, XML)]
+        t0 = entries[0]["t"] if entries else 0
+        for i, entry in enumerate(entries):
+            root = ET.fromstring(entry["xml"])
+            msg_id = root.find('MsgId')
+            if msg_id is None:
+                msg_id = ET.SubElement(root, 'MsgId')
+            msg_id.text = str(msg_base + i)
+            user = root.findtext('FromUserName') or ''
+            self.queues.setdefault(user, []).append(
+                (entry["t"] - t0, classify(root), ET.tostring(root, encoding='utf-8'))
+            )
+        for user in self.queues:
+            self.queues[user].reverse()  # 从末尾弹出
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _due(self, offset):
+        return self.start + offset / self.speed if self.speed else 0.0
+
+    def _schedule_next(self, user):
+        """把用户的下一条消息放入待发送堆，调用方需持有 cond。"""
+        pending = self.queues[user]
+        if pending:
+            heapq.heappush(self.ready, (self._due(pending[-1][0]), next(self._seq), user))
+            self.cond.notify()
+
+    def _send(self, user, kind, body, due):
+        sent_at = time.perf_counter()
+        try:
+            response = self._session().post(
+                self.url, data=body, params=test.sign_params(),
+                headers={'Content-Type': 'application/xml'}, timeout=30,
+            )
+            response.encoding = 'utf-8'
+            outcome = "async" if response.text.strip() == "success" else "reply"
+            if response.status_code != 200:
+                outcome = "error"
+        except requests.exceptions.RequestException:
+            outcome = "error"
+        latency = time.perf_counter() - sent_at
+        with self.cond:
+            self.results.append((kind, latency, outcome))
+            self.lag.append(max(sent_at - due, 0.0) if due else 0.0)
+            self.in_flight -= 1
+            self._schedule_next(user)
+            self.cond.notify()
+
+    def run(self):
+        self.start = time.perf_counter()
+        with self.cond:
+            for user in self.queues:
+                self._schedule_next(user)
+            while self.ready or self.in_flight:
+                if not self.ready:
+                    self.cond.wait()
+                    continue
+                due, _, user = self.ready[0]
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    # 等待期间可能有更早的消息加入堆，醒来后重新检查
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.ready)
+                _, kind, body = self.queues[user].pop()
+                self.in_flight += 1
+                self.executor.submit(self._send, user, kind, body, due)
+        self.executor.shutdown(wait=True)
+        return time.perf_counter() - self.start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按原始节奏回放采集的流量")
+    parser.add_argument('files', nargs='*', help="采集文件，默认读取 config.CAPTURE_FILE 及其轮转文件")
+    parser.add_argument('--url', default=test.SERVER_URL)
+    parser.add_argument('--speed', default='1', help="回放倍速，如 1、10，max 为尽快发送")
+    parser.add_argument('--concurrency', type=int, default=256, help="最多同时进行的请求数")
+    parser.add_argument('--db', default=os.path.join(config.BASE_DIR, 'chat_history.db'), help="服务使用的数据库文件")
+    parser.add_argument('--out', help="把结果写入 JSON 文件")
+    parser.add_argument('--compare', help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    speed = 0.0 if args.speed == 'max' else float(args.speed)
+    entries = load_capture(args.files or capture_files())
+    if not entries:
+        print("没有可回放的记录，请先在服务端设置 CAPTURE_ENABLED=1 采集流量")
+        return 1
+
+    test.SERVER_URL = args.url
+    if not test.verify_server():
+        print(f"无法连接服务器 {args.url}，请先启动 main.py 或 server_async.py")
+        return 1
+
+    replay = Replay(args.url, entries, speed, args.concurrency)
+    span = entries[-1]["t"] - entries[0]["t"]
+    print(f"回放 {len(entries)} 条消息（{len(replay.queues)} 个用户，原始时长 {span:.0f} 秒），"
+          f"倍速 {'max' if not speed else args.speed}")
+    size_before = db_size(args.db)
+    elapsed = replay.run()
+    time.sleep(1)  # 等访问日志写线程提交
+    report = summarize(replay.results, elapsed, db_size(args.db) - size_before)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    lag = sorted(replay.lag)
+    print(f"发送延后（服务端变慢导致同一用户排队）：p50 {percentile(lag, 50) * 1000:.0f} ms，p99 {percentile(lag, 99) * 1000:.0f} ms")
+    origin = sorted(replay.origin_ms)
+    print(f"采集时的服务端耗时：p50 {percentile(origin, 50):.0f} ms，p99 {percentile(origin, 99):.0f} ms")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+按用户串行处理的压力测试 - 通过 main.py 的实际回复路径（reply_within_deadline）检查：
+1. 并发消息下对话历史不丢失、顺序正确：同时向同一个用户发送大量消息（并夹杂其他用户的消息）；
+2. 一个用户连发多条消息不会挡住其他用户：用户A一次发送超过回复线程数的慢消息后，
+   用户B的一条消息仍应在约一次模型调用的时间内得到被动回复。
+模型调用用一个随机耗时的本地函数代替。
+
+用法：python -m bench.stress_user_order [每个用户的消息数] [用户数]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import main
+import tool.chatAI as chatAI
+import tool.database as database
+import tool.user_lock as user_lock
+
+# 第二项检查中模型调用的固定耗时（秒）
+SLOW_CALL = 0.5
+
+_model_delay = (0.001, 0.02)
+
+
+def fake_chat_with_cf(messages, max_tokens=None, on_text=None, stream=None):
+    """代替模型调用：随机等待后回显用户消息。"""
+    time.sleep(random.uniform(*_model_delay))
+    return f"收到：{messages[-1]['content']}"
+
+
+def send(user_id, message):
+    """与 main.handle_text 一样经过 reply_within_deadline，返回 (被动回复XML, 耗时秒)。"""
+    received_at = time.time()
+    reply = main.reply_within_deadline(user_id, "gh_stress_bot", received_at, main.generate_reply, user_id, message)
+    return reply, time.time() - received_at
+
+
+def check_order(per_user, users):
+    """检查1：每个用户的历史条数和顺序。"""
+    user_ids = [f"stress_user_{i}" for i in range(users)]
+    jobs = [(user_id, n) for n in range(per_user) for user_id in user_ids]
+
+    start = time.perf_counter()
+    # 模拟 Flask 的请求线程：请求按顺序到达、并发等待回复
+    with ThreadPoolExecutor(max_workers=32) as requests_pool:
+        for user_id, n in jobs:
+            requests_pool.submit(send, user_id, f"第{n}条消息")
+            time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+
+    failures = 0
+    with main.app.app_context():
+        for user_id in user_ids:
+            database.invalidate_user_cache(user_id)
+            history = database.get_user_session(user_id)
+            expected = [f"第{n}条消息" for n in range(per_user)]
+            actual = [m["content"] for m in history if m["role"] == "user"]
+            if len(history) != per_user * 2 or actual != expected:
+                failures += 1
+                print(f"[失败] {user_id}: 历史 {len(history)} 条，期望 {per_user * 2} 条")
+
+    stats = user_lock.get_stats()
+    print(f"{users} 个用户 × {per_user} 条消息，耗时 {elapsed:.2f} 秒")
+    print(f"需要排队 {stats['contended']} 次，最大队列深度 {stats['depth_max']}，"
+          f"平均等待 {stats['wait_avg'] * 1000:.1f} ms，最长等待 {stats['wait_max'] * 1000:.1f} ms")
+    print("顺序检查：" + ("全部通过" if failures == 0 else f"{failures} 个用户的历史有丢失或乱序"))
+    return failures == 0
+
+
+def check_cross_user():
+    """检查2：用户A的排队消息不占用回复线程，用户B不受影响。"""
+    global _model_delay
+    _model_delay = (SLOW_CALL, SLOW_CALL)
+    burst = config.ASYNC_WORKERS + 1
+    # 时间预算足够A的全部消息依次完成，B如果被挡住会体现在耗时上而不是转为客服消息
+    config.REPLY_DEADLINE = SLOW_CALL * (burst + 2)
+
+    with ThreadPoolExecutor(max_workers=burst + 1) as requests_pool:
+        for n in range(burst):
+            requests_pool.submit(send, "stress_user_a", f"A的第{n}条消息")
+        time.sleep(0.05)
+        reply, latency = requests_pool.submit(send, "stress_user_b", "B的消息").result()
+
+    ok = reply != "success" and latency < SLOW_CALL * 2
+    print(f"用户A连发 {burst} 条（每条 {SLOW_CALL} 秒）时，用户B的回复耗时 {latency:.2f} 秒")
+    print("跨用户检查：" + ("通过" if ok else "失败，用户B被用户A的排队消息阻塞"))
+    return ok
+
+
+def run(per_user, users):
+    database.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    database.init_db()
+    chatAI.chat_with_cf = fake_chat_with_cf
+    config.REPLY_CACHE_ENABLED = False
+    config.SUMMARY_ENABLED = False
+    config.LLM_MAX_CONCURRENCY = 1000
+    config.LLM_RATE_PER_MINUTE = 0
+    # 让历史窗口足够大，便于检查全部消息；时间预算足够长，回复都走被动回复
+    config.MAX_HISTORY_LEN = per_user * 2 + 1
+    config.REPLY_DEADLINE = 60
+
+    ordered = check_order(per_user, users)
+    isolated = check_cross_user()
+    return ordered and isolated
+
+
+if __name__ == '__main__':
+    per_user = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sys.exit(0 if run(per_user, users) else 1)
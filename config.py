@@ -8,6 +8,8 @@ load_dotenv()
 ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID", "")
 AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN", "")
 MODEL = "llama-3.1-8b-instruct-fast"
+# Cloudflare 接口地址，压测时可指向本地桩服务（见 stubs/cloudflare_ai.py）
+CF_API_BASE = os.getenv("CF_API_BASE", "https://api.cloudflare.com")
 
 # 微信验证token
 TOKEN = os.getenv("WECHAT_TOKEN", "")
@@ -15,8 +17,102 @@ TOKEN = os.getenv("WECHAT_TOKEN", "")
 APP_ID = os.getenv("WECHAT_APP_ID", "")
 APP_SECRET = os.getenv("WECHAT_APP_SECRET", "")
 
+# 微信接口地址，测试时可指向本地桩服务（见 stubs/wechat_api.py）
+WECHAT_API_BASE = os.getenv("WECHAT_API_BASE", "https://api.weixin.qq.com")
+
+# 对外HTTP客户端配置（tool/http_client.py）
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))  # 缓存连接池的主机数
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))  # 每个主机的最大长连接数
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))  # 连接超时（秒）
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_BASE = 0.2  # 退避基准时间（秒）
+HTTP_BACKOFF_MAX = 2.0  # 单次退避的最长时间（秒）
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # DNS缓存时间（秒），0为关闭
+HTTP_DNS_CACHE_SIZE = int(os.getenv("HTTP_DNS_CACHE_SIZE", "256"))  # DNS缓存最多保存的解析结果数，0为关闭
+
+# 异步回复配置
+# 微信被动回复必须在5秒内返回，否则会重试3次
+ASYNC_REPLY_ENABLED = os.getenv("ASYNC_REPLY_ENABLED", "1") == "1"
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", "4.5"))  # 被动回复的时间预算（秒）
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", "8"))  # 后台生成回复的线程数
+
+# 异步入口（server_async.py）配置：等待模型时只占用协程，数据库操作交给小线程池
+ASYNC_SERVER_HOST = os.getenv("ASYNC_SERVER_HOST", "0.0.0.0")
+ASYNC_SERVER_PORT = int(os.getenv("ASYNC_SERVER_PORT", "80"))
+ASYNC_DB_WORKERS = int(os.getenv("ASYNC_DB_WORKERS", "4"))  # 执行数据库操作的线程数
+
+# 指标服务：在单独的本地端口上以 Prometheus 文本格式输出延迟直方图和计数，0为不启动
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# 消息去重配置（应对微信重试）
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "60"))  # 已处理消息的回复缓存时间（秒）
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+
+# 用户状态缓存（身份、待处理动作、最近对话历史）
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))  # 最多缓存的用户数，0为关闭
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))  # 缓存有效期（秒）
+USER_CACHE_CHECK_INTERVAL = float(os.getenv("USER_CACHE_CHECK_INTERVAL", "1"))  # 读取缓存前核对版本号的最短间隔（秒），多进程部署时其他进程的修改最多延迟这么久可见
+
+# 数据库配置（WAL 模式）
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))  # 等待写锁的最长时间（毫秒）
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # WAL 模式下 NORMAL 已能保证不损坏数据库
+
+# 访问日志批量写入配置
+ACCESS_LOG_QUEUE_SIZE = int(os.getenv("ACCESS_LOG_QUEUE_SIZE", "10000"))  # 队列容量，满了退回同步写入
+ACCESS_LOG_BATCH_SIZE = int(os.getenv("ACCESS_LOG_BATCH_SIZE", "200"))  # 每批最多写入条数
+ACCESS_LOG_FLUSH_INTERVAL = float(os.getenv("ACCESS_LOG_FLUSH_INTERVAL", "1.0"))  # 最长攒批时间（秒）
+
+# 访问统计：用 HyperLogLog 近似统计多日独立访客数（每天约占 4KB）
+ACCESS_HLL_ENABLED = os.getenv("ACCESS_HLL_ENABLED", "0") == "1"
+ACCESS_HLL_PRECISION = 12
+
+# 天气抓取并发数（共7个地区页面）
+WEATHER_FETCH_WORKERS = int(os.getenv("WEATHER_FETCH_WORKERS", "7"))
+
+# 一条消息最多回答几个城市的天气
+WEATHER_MAX_CITIES = 5
+
+# 天气数据多进程共享：只有抢到文件锁的一个进程负责抓取并写入快照文件，
+# 其他进程在查询时按快照版本惰性重新加载
+WEATHER_REFRESH_INTERVAL = int(os.getenv("WEATHER_REFRESH_INTERVAL", "3600"))  # 抓取间隔（秒）
+WEATHER_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("WEATHER_SNAPSHOT_CHECK_INTERVAL", "5"))  # 检查快照版本的最短间隔（秒）
+# 刷新失败后按指数退避重试：第一次等待 WEATHER_RETRY_BASE 秒，每次翻倍，最长不超过抓取间隔
+WEATHER_RETRY_BASE = float(os.getenv("WEATHER_RETRY_BASE", "30"))
+
+# 每隔多少秒检查一次身份文件是否被修改（0为只在 /reload 时重新加载）
+PERSONA_CHECK_INTERVAL = int(os.getenv("PERSONA_CHECK_INTERVAL", "30"))
+
+# 上下文构建：历史消息（含摘要）最多使用的 token 数
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1000"))
+
+# 滚动摘要：后台任务把较早的对话折叠成摘要
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_INTERVAL = int(os.getenv("SUMMARY_INTERVAL", "600"))  # 摘要任务运行间隔（秒）
+SUMMARY_KEEP_RECENT = 20  # 最近的这么多条消息不折叠，原样发送
+SUMMARY_MIN_BATCH = 20  # 至少积累这么多条可折叠的消息才更新摘要
+SUMMARY_MAX_CHARS = 200  # 摘要的目标长度（字）
+
+# 回复缓存：没有上下文的短消息（如问候语）复用同一身份的回复
+# 单个身份可在 PERSONAS 中设置 "cache": False 关闭
+REPLY_CACHE_ENABLED = os.getenv("REPLY_CACHE_ENABLED", "1") == "1"
+REPLY_CACHE_MAX_HISTORY = 0  # 历史消息数不超过这个值时才使用缓存
+REPLY_CACHE_MAX_MESSAGE_CHARS = 20  # 只缓存规范化后不超过这么多字的消息
+REPLY_CACHE_TTL = int(os.getenv("REPLY_CACHE_TTL", "3600"))  # 缓存有效期（秒）
+REPLY_CACHE_MAX_ENTRIES = 2000
+REPLY_CACHE_MAX_BYTES = 1024 * 1024  # 缓存占用的内存上限（字节）
+
+# 模型调用准入控制（按进程生效，多进程部署时按进程数分摊）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # 同时进行的模型调用上限
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))  # 排队等待的调用上限
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "3"))  # 最长排队时间（秒）
+LLM_RATE_PER_MINUTE = int(os.getenv("LLM_RATE_PER_MINUTE", "300"))  # 上游配额：每分钟调用次数，0为不限
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "20"))  # 令牌桶容量（允许的突发调用数）
+BUSY_REPLY = "现在找我聊天的人太多啦，请稍后再试~"
+
 # 最大历史会话长度
 MAX_HISTORY_LEN = 101  # 包含系统指令 + 100条消息
+HISTORY_TRIM_INTERVAL = 20  # 每追加这么多条消息裁剪一次超出长度的旧消息
 
 # 管理员用户ID
 ADMIN_USER_ID = [
@@ -24,14 +120,42 @@ ADMIN_USER_ID = [
 ]
 
 # 身份配置
-# 格式: "编号": {"name": "身份名称", "file": "prompt文件名"}
+# 格式: "编号": {"name": "身份名称", "file": "prompt文件名", "max_tokens": 可选，单次回复的最大token数}
 PERSONAS = {
     "1": {"name": "找人怼你", "file": "chaojia.txt"},
     "2": {"name": "我妻由乃", "file": "Gasai.txt"},
     "3": {"name": "春日野穹", "file": "Kasugano.txt"}
 }
 
+# 模型输出配置
+DEFAULT_MAX_TOKENS = int(os.getenv("DEFAULT_MAX_TOKENS", "256"))  # 未单独配置的身份使用的 max_tokens
+CF_STREAM_ENABLED = os.getenv("CF_STREAM_ENABLED", "1") == "1"  # 使用流式响应
+STREAM_MAX_CHARS = int(os.getenv("STREAM_MAX_CHARS", "300"))  # 流式输出达到这么多字后提前结束，0为不限
+STREAM_MAX_SENTENCES = int(os.getenv("STREAM_MAX_SENTENCES", "0"))  # 流式输出达到这么多句后提前结束，0为不限
+STREAM_SEGMENT_CHARS = int(os.getenv("STREAM_SEGMENT_CHARS", "60"))  # 异步推送时每段至少积累的字数
+SENTENCE_ENDINGS = "。！？!?\n"  # 句子结束符：流式输出按句提前结束和超时后分段推送共用
+
 # 项目根目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-FEEDBACK_FILE = os.path.join(BASE_DIR, 'user_feedback.txt')
\ No newline at end of file
+FEEDBACK_FILE = os.path.join(BASE_DIR, 'user_feedback.txt')  # 旧的反馈文件，启动时一次性导入数据库
+FEEDBACK_PAGE_SIZE = 30  # /反馈列表 每页显示的条数
+# 请求追踪：按比例采样记录每个请求的调用树，总耗时超过阈值的写入慢请求日志（JSONL，按大小轮转）
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))  # 记录调用树的请求比例（默认1%），排查问题时可调高，0为关闭；被选中做性能分析的请求总是记录
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "3.0"))  # 慢请求阈值（秒），包括超时后在后台完成的部分
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))  # 每个请求最多记录的 span 数
+TRACE_SLOW_LOG = os.getenv("TRACE_SLOW_LOG", os.path.join(BASE_DIR, 'logs', 'slow_requests.jsonl'))
+TRACE_SLOW_LOG_MAX_BYTES = int(os.getenv("TRACE_SLOW_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_SLOW_LOG_BACKUPS = int(os.getenv("TRACE_SLOW_LOG_BACKUPS", "5"))
+ANON_SALT = os.getenv("ANON_SALT", "")  # 日志中匿名化用户 id 的密钥，为空时每次启动随机生成
+
+# 性能分析：对接下来的 N 个请求做 cProfile，结果保存在 PROFILE_DIR（也可以用 /性能分析 指令开启）
+PROFILE_REQUESTS = int(os.getenv("PROFILE_REQUESTS", "0"))
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+# 流量采集：把收到的消息XML（FromUserName 匿名化）和时间写入轮转文件，供 bench/replay.py 回放
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "0") == "1"
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", os.path.join(BASE_DIR, 'logs', 'capture.jsonl'))
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))  # 超过后轮转，旧文件 gzip 压缩
+CAPTURE_BACKUPS = int(os.getenv("CAPTURE_BACKUPS", "10"))
+CAPTURE_QUEUE_SIZE = 10000  # 写线程来不及写入时最多缓存的记录数，超出的丢弃
@@ -1,17 +1,24 @@
-import hashlib
 import time
 from flask import Flask, request, g # 导入 g
-import xml.etree.ElementTree as ET
 import config
+import tool.capture as capture
 import tool.chatAI as chatAI
 import tool.database as database
 import tool.command_handler as command_handler # 导入新的指令处理模块
-import tool.weather as weather
-import threading
+import tool.wechat_api as wechat_api
+import tool.wechat_message as wechat_message
+import tool.dedup as dedup
+import tool.user_lock as user_lock
+import tool.lifecycle as lifecycle
+import tool.tracing as tracing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # --- Flask Web 应用 ---
 app = Flask(__name__)
 
+# 后台回复线程池：超过时间预算的对话在这里继续生成，完成后通过客服消息推送
+reply_executor = ThreadPoolExecutor(max_workers=config.ASYNC_WORKERS, thread_name_prefix='reply')
+
 # --- 数据库连接管理 ---
 @app.teardown_appcontext
 def close_db(e=None):
@@ -21,14 +28,128 @@ def close_db(e=None):
         db.close()
 
 
-def schedule_weather_updates():
+def generate_reply(from_user_name, user_input, on_text=None):
+    """生成AI回复。"""
+    return chatAI.get_response(from_user_name, user_input, on_text=on_text).strip()
+
+def run_command(from_user_name, user_input, on_text=None):
+    """执行指令并返回回复内容。"""
+    return command_handler.handle_command(user_input, from_user_name)
+
+def run_in_app_context(func, *args):
+    """在独立的应用上下文中执行 func，在后台线程中运行。"""
+    with app.app_context():
+        return func(*args)
+
+def encode_reply(from_user_name, to_user_name, content):
+    """编码被动回复XML，耗时计入 ENCODE_SECONDS。"""
+    start = time.perf_counter()
+    reply = wechat_message.encode_text_reply(from_user_name, to_user_name, content)
+    wechat_message.ENCODE_SECONDS.observe(time.perf_counter() - start)
+    return reply
+
+def deliver_async_reply(streaming_reply, future):
+    """后台生成完成后，通过客服消息接口把剩余的回复推送给用户。"""
+    try:
+        content = future.result()
+    except Exception as e:
+        print(f"后台生成回复失败: {e}")
+        content = ""
+    streaming_reply.finish(content)
+
+def reply_within_deadline(from_user_name, to_user_name, received_at, func, *args):
     """
-    定时任务函数，每小时更新一次天气缓存。
+    按用户的消息到达顺序执行 func(*args, on_text) 生成回复。
+    在时间预算内完成则直接被动回复；
+    否则立即返回 success，由后台线程生成完毕后通过客服消息推送。
     """
-    while True:
-        weather.update_weather_cache()
-        # 等待1小时
-        time.sleep(3600)
+    # 到达时就按用户排队，保证同一用户的消息按顺序处理、不会并发读写历史；
+    # 排队中的消息不占用线程池，不同用户之间互不阻塞。bind() 让后台线程中的 span 挂在本次请求的追踪上
+    if not config.ASYNC_REPLY_ENABLED:
+        future = user_lock.submit_in_order(reply_executor, from_user_name, tracing.bind(run_in_app_context), func, *args, None)
+        return encode_reply(from_user_name, to_user_name, future.result())
+
+    # 流式生成的文本先缓存；超时后改为边生成边按句推送
+    streaming_reply = wechat_api.StreamingReply(from_user_name)
+    future = user_lock.submit_in_order(
+        reply_executor, from_user_name, tracing.bind(run_in_app_context), func, *args, streaming_reply.on_text
+    )
+    remaining = config.REPLY_DEADLINE - (time.time() - received_at)
+    try:
+        content = future.result(timeout=max(remaining, 0))
+    except FutureTimeoutError:
+        capture.mark_pushed()
+        streaming_reply.start()
+        future.add_done_callback(tracing.bind(lambda f: deliver_async_reply(streaming_reply, f)))
+        return "success"
+    return encode_reply(from_user_name, to_user_name, content)
+
+# 按 MsgType / Event 分发消息，没有注册的类型直接回复 success
+dispatcher = wechat_message.Dispatcher()
+
+@dispatcher.register('text')
+def handle_text(message, received_at):
+    """文本消息：以 / 开头的是指令，其余交给模型对话。"""
+    user_input = (message.content or "").strip()
+    if not user_input:
+        return "success"
+
+    # --- 指令处理系统 ---
+    # 指令和对话都受5秒被动回复时限约束，并与该用户的其他消息按顺序执行
+    if user_input.startswith("/"):
+        return reply_within_deadline(message.from_user, message.to_user, received_at, run_command, message.from_user, user_input)
+    # --- 正常对话处理 ---
+    return reply_within_deadline(message.from_user, message.to_user, received_at, generate_reply, message.from_user, user_input)
+
+@dispatcher.register('event', 'CLICK')
+def handle_menu_click(message, received_at):
+    """菜单点击事件：key 是指令（见 tool/create_menu.py）时直接执行，不经过模型。"""
+    command = (message.event_key or "").strip()
+    if not command.startswith("/"):
+        return "success"
+    return reply_within_deadline(message.from_user, message.to_user, received_at, run_command, message.from_user, command)
+
+def handle_message(message, received_at):
+    """处理一条微信消息，返回回复XML或 success。"""
+    # 记录用户访问
+    database.log_access(message.from_user)
+
+    handler = dispatcher.resolve(message)
+    if handler is None:
+        return "success"
+    return handler(message, received_at)
+
+def receive_message(xml_data, received_at):
+    """解析、去重并处理一条微信消息，返回回复XML或 success。"""
+    with tracing.span('parse'):
+        try:
+            start = time.perf_counter()
+            message = wechat_message.parse(xml_data)
+        except ValueError:
+            wechat_message.MESSAGES.inc("invalid")
+            return "success"
+        wechat_message.PARSE_SECONDS.observe(time.perf_counter() - start)
+        wechat_message.MESSAGES.inc(message.msg_type)
+    tracing.set_user(message.from_user)
+    tracing.annotate(msg_type=message.msg_type)
+
+    # --- 微信重试去重 ---
+    # 处理中的重试等待第一次的结果，已处理完的重试直接返回缓存的回复
+    entry, is_new = dedup.begin(dedup.make_key(message.msg_id, message.from_user, message.create_time))
+    if not is_new:
+        remaining = config.REPLY_DEADLINE - (time.time() - received_at)
+        return entry.wait(max(remaining, 0)) or "success"
+
+    reply_xml = "success"
+    try:
+        reply_xml = handle_message(message, received_at)
+    except Exception as e:
+        # 在服务器环境中，我们不打印错误，只返回success，避免微信重试；异常类型计入指标
+        wechat_message.HANDLER_ERRORS.inc(type(e).__name__)
+        tracing.annotate(error=type(e).__name__)
+    finally:
+        dedup.finish(entry, reply_xml)
+    return reply_xml
 
 @app.route('/', methods=['GET', 'POST'])
 def wechat():
@@ -39,84 +160,27 @@ def wechat():
         nonce = request.args.get('nonce', '')
         echostr = request.args.get('echostr', '')
 
-        tmp_list = [config.TOKEN, str(timestamp), str(nonce)]
-        tmp_list.sort()
-        tmp_str = ''.join(tmp_list)
-        hashcode = hashlib.sha1(tmp_str.encode('utf-8')).hexdigest()
-        
-        if hashcode == signature:
+        if wechat_api.check_signature(signature, timestamp, nonce):
             return echostr
         else:
             return 'token验证失败'
     else:
         # --- 接收并处理微信消息 ---
+        received_at = time.time()
         xml_data = request.data
         if not xml_data:
             return "success"
-            
-        try:
-            xml_rec = ET.fromstring(xml_data)
-            
-            # 提取消息内容
-            to_user_name = xml_rec.find('ToUserName').text
-            from_user_name = xml_rec.find('FromUserName').text
-            msg_type = xml_rec.find('MsgType').text
-
-            # 记录用户访问
-            database.log_access(from_user_name)
-
-            if msg_type == 'text':
-                user_input = xml_rec.find('Content').text.strip()
-                
-                # --- 指令处理系统 ---
-                if user_input.startswith("/"):
-                    reply_content = command_handler.handle_command(user_input, from_user_name)
-                    
-                    # 构造回复XML
-                    reply_xml = f"""
-                    <xml>
-                        <ToUserName><![CDATA[{from_user_name}]]></ToUserName>
-                        <FromUserName><![CDATA[{to_user_name}]]></FromUserName>
-                        <CreateTime>{int(time.time())}</CreateTime>
-                        <MsgType><![CDATA[text]]></MsgType>
-                        <Content><![CDATA[{reply_content}]]></Content>
-                    </xml>
-                    """
-                    return reply_xml
-                else:
-                    # --- 正常对话处理 ---
-                    ai_reply_content = chatAI.get_response(from_user_name, user_input)
-                    ai_reply_content = ai_reply_content.strip()
-                    
-                    # 构造回复的XML
-                    reply_xml = f"""
-                    <xml>
-                        <ToUserName><![CDATA[{from_user_name}]]></ToUserName>
-                        <FromUserName><![CDATA[{to_user_name}]]></FromUserName>
-                        <CreateTime>{int(time.time())}</CreateTime>
-                        <MsgType><![CDATA[text]]></MsgType>
-                        <Content><![CDATA[{ai_reply_content}]]></Content>
-                    </xml>
-                    """
-                    return reply_xml
-            else:
-                # 对于非文本消息，可以简单回复或不处理
-                return "success"
-
-        except Exception:
-            # 在服务器环境中，我们不打印错误，只返回success，避免微信重试
-            return "success"
+        with tracing.start_trace('wechat'), capture.track() as tracked:
+            reply_xml = receive_message(xml_data, received_at)
+        # 流量采集（未开启时直接返回）
+        capture.record(xml_data, received_at, time.time() - received_at, tracked.pushed)
+        return reply_xml
 
 if __name__ == '__main__':
-    # 初始化数据库
-    database.init_db()
-
-    # 首次立即更新天气缓存
-    weather.update_weather_cache()
-
-    # 启动后台线程定时更新天气
-    update_thread = threading.Thread(target=schedule_weather_updates, daemon=True)
-    update_thread.start()
-
-    # 运行 Flask 应用来对接微信
-    app.run(host='0.0.0.0', port=80)
\ No newline at end of file
+    # 启动钩子：数据库、访问日志写线程、上游连接预热、天气缓存和后台定时任务
+    lifecycle.startup()
+    try:
+        # 运行 Flask 应用来对接微信（生产环境可改用异步入口 server_async.py）
+        app.run(host='0.0.0.0', port=80)
+    finally:
+        lifecycle.shutdown()
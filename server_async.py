@@ -0,0 +1,228 @@
+"""
+异步入口：在 aiohttp 事件循环上运行公众号服务，接口与 main.py 完全相同（/ 的 GET 验证和 POST 消息XML）。
+等待模型回复时只占用协程，大量同时进行的慢对话不再各占一个线程；
+数据库操作（含指令处理）交给 ASYNC_DB_WORKERS 个线程执行。
+
+用法：python server_async.py
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import config
+import tool.admission as admission
+import tool.async_client as async_client
+import tool.capture as capture
+import tool.chatAI as chatAI
+import tool.command_handler as command_handler
+import tool.database as database
+import tool.dedup as dedup
+import tool.lifecycle as lifecycle
+import tool.tracing as tracing
+import tool.user_lock as user_lock
+import tool.wechat_api as wechat_api
+import tool.wechat_message as wechat_message
+
+# 数据库线程池：不在 Flask 应用上下文中，每个线程复用一个连接
+db_executor = ThreadPoolExecutor(max_workers=config.ASYNC_DB_WORKERS, thread_name_prefix='db')
+
+# 超过时间预算、改为客服消息推送的后台任务，保留引用避免被回收
+_background_tasks = set()
+
+
+async def run_db(func, *args):
+    """在数据库线程池中执行 func(*args)，其中的 span 挂在当前请求的追踪上。"""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, tracing.bind(func), *args)
+
+
+@tracing.traced()
+async def generate_reply(from_user_name, user_input, on_text=None):
+    """生成AI回复：读写数据库在线程池中执行，等待模型时只占用协程。"""
+    turn = await run_db(chatAI.prepare_response, from_user_name, user_input)
+    if turn.reply is not None:
+        return turn.reply.strip()
+    if turn.cached_reply is not None:
+        return (await run_db(chatAI.finish_response, turn, turn.cached_reply)).strip()
+
+    start = time.time()
+    try:
+        # 准入控制：并发和速率超出预算时直接回复繁忙提示
+        async with admission.admit_async():
+            ai_response = await async_client.chat_with_cf(
+                turn.messages, max_tokens=turn.max_tokens, on_text=on_text
+            )
+    except admission.Overloaded:
+        return config.BUSY_REPLY
+    return (await run_db(chatAI.finish_response, turn, ai_response, time.time() - start)).strip()
+
+
+async def run_command(from_user_name, user_input, on_text=None):
+    """执行指令并返回回复内容。"""
+    return await run_db(command_handler.handle_command, user_input, from_user_name)
+
+
+async def run_in_user_order(from_user_name, func, *args):
+    """等该用户之前的消息处理完后执行 func。"""
+    async with user_lock.hold_async(from_user_name):
+        return await func(*args)
+
+
+def encode_reply(from_user_name, to_user_name, content):
+    """编码被动回复XML，耗时计入 ENCODE_SECONDS。"""
+    start = time.perf_counter()
+    reply = wechat_message.encode_text_reply(from_user_name, to_user_name, content)
+    wechat_message.ENCODE_SECONDS.observe(time.perf_counter() - start)
+    return reply
+
+
+async def deliver_async_reply(streaming_reply, task):
+    """被动回复超时后，先推送已生成的完整句子，生成完成后推送剩余的回复。"""
+    await streaming_reply.start()
+    try:
+        content = await task
+    except Exception as e:
+        print(f"后台生成回复失败: {e}")
+        content = ""
+    await streaming_reply.finish(content)
+
+
+async def reply_within_deadline(from_user_name, to_user_name, received_at, func, *args):
+    """
+    按用户的消息到达顺序执行 func(*args, on_text) 生成回复。
+    在时间预算内完成则直接被动回复；否则立即返回 success，生成完毕后通过客服消息推送。
+    """
+    if not config.ASYNC_REPLY_ENABLED:
+        content = await run_in_user_order(from_user_name, func, *args, None)
+        return encode_reply(from_user_name, to_user_name, content)
+
+    # 任务按创建顺序开始执行，因此同一用户的消息按到达顺序排队
+    streaming_reply = async_client.StreamingReply(from_user_name)
+    task = asyncio.ensure_future(tracing.bind(run_in_user_order)(from_user_name, func, *args, streaming_reply.on_text))
+    remaining = config.REPLY_DEADLINE - (time.time() - received_at)
+    try:
+        content = await asyncio.wait_for(asyncio.shield(task), max(remaining, 0))
+    except asyncio.TimeoutError:
+        capture.mark_pushed()
+        delivery = asyncio.ensure_future(tracing.bind(deliver_async_reply)(streaming_reply, task))
+        _background_tasks.add(delivery)
+        delivery.add_done_callback(_background_tasks.discard)
+        return "success"
+    return encode_reply(from_user_name, to_user_name, content)
+
+
+# 按 MsgType / Event 分发消息，处理函数与 main.py 相同，只是改为协程
+dispatcher = wechat_message.Dispatcher()
+
+
+@dispatcher.register('text')
+async def handle_text(message, received_at):
+    """文本消息：以 / 开头的是指令，其余交给模型对话。"""
+    user_input = (message.content or "").strip()
+    if not user_input:
+        return "success"
+    if user_input.startswith("/"):
+        return await reply_within_deadline(message.from_user, message.to_user, received_at, run_command, message.from_user, user_input)
+    return await reply_within_deadline(message.from_user, message.to_user, received_at, generate_reply, message.from_user, user_input)
+
+
+@dispatcher.register('event', 'CLICK')
+async def handle_menu_click(message, received_at):
+    """菜单点击事件：key 是指令时直接执行，不经过模型。"""
+    command = (message.event_key or "").strip()
+    if not command.startswith("/"):
+        return "success"
+    return await reply_within_deadline(message.from_user, message.to_user, received_at, run_command, message.from_user, command)
+
+
+async def handle_message(message, received_at):
+    """处理一条微信消息，返回回复XML或 success。"""
+    # 记录用户访问：放入写线程的队列；写线程未启动或队列已满时在数据库线程中同步写入，不阻塞事件循环
+    if not database.try_log_access(message.from_user):
+        await run_db(database.log_access, message.from_user)
+
+    handler = dispatcher.resolve(message)
+    if handler is None:
+        return "success"
+    return await handler(message, received_at)
+
+
+async def wechat_verify(request):
+    """微信服务器验证。"""
+    query = request.query
+    if wechat_api.check_signature(query.get('signature', ''), query.get('timestamp', ''), query.get('nonce', '')):
+        return web.Response(text=query.get('echostr', ''))
+    return web.Response(text='token验证失败')
+
+
+async def receive_message(request):
+    """接收并处理微信消息。"""
+    received_at = time.time()
+    xml_data = await request.read()
+    if not xml_data:
+        return web.Response(text="success")
+    with tracing.start_trace('wechat'), capture.track() as tracked:
+        reply_xml = await process_message(xml_data, received_at)
+    # 流量采集（未开启时直接返回）
+    capture.record(xml_data, received_at, time.time() - received_at, tracked.pushed)
+    return web.Response(text=reply_xml)
+
+
+async def process_message(xml_data, received_at):
+    """解析、去重并处理一条微信消息，返回回复XML或 success。"""
+    with tracing.span('parse'):
+        try:
+            start = time.perf_counter()
+            message = wechat_message.parse(xml_data)
+        except ValueError:
+            wechat_message.MESSAGES.inc("invalid")
+            return "success"
+        wechat_message.PARSE_SECONDS.observe(time.perf_counter() - start)
+        wechat_message.MESSAGES.inc(message.msg_type)
+    tracing.set_user(message.from_user)
+    tracing.annotate(msg_type=message.msg_type)
+
+    # 微信重试去重：处理中的重试等待第一次的结果，已处理完的重试直接返回缓存的回复
+    entry, is_new = dedup.begin(dedup.make_key(message.msg_id, message.from_user, message.create_time))
+    if not is_new:
+        remaining = config.REPLY_DEADLINE - (time.time() - received_at)
+        return await entry.wait_async(max(remaining, 0)) or "success"
+
+    reply_xml = "success"
+    try:
+        reply_xml = await handle_message(message, received_at)
+    except Exception as e:
+        # 不打印错误，只返回success，避免微信重试；异常类型计入指标
+        wechat_message.HANDLER_ERRORS.inc(type(e).__name__)
+        tracing.annotate(error=type(e).__name__)
+    finally:
+        dedup.finish(entry, reply_xml)
+    return reply_xml
+
+
+async def on_startup(app):
+    # 启动钩子会初始化数据库（同步IO），放到线程中执行，不阻塞事件循环
+    await asyncio.get_running_loop().run_in_executor(None, lifecycle.startup)
+    await async_client.start()
+
+
+async def on_cleanup(app):
+    # 等待正在推送的后台回复完成，再关闭连接和线程池
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=config.REPLY_DEADLINE)
+    await async_client.close()
+    lifecycle.shutdown()
+    db_executor.shutdown(wait=True)
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', wechat_verify)
+    app.router.add_post('/', receive_message)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=config.ASYNC_SERVER_HOST, port=config.ASYNC_SERVER_PORT)
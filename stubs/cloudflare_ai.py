@@ -0,0 +1,179 @@
+"""
+Cloudflare AI 接口本地桩服务 - 模拟 /client/v4/accounts/<id>/ai/run/<model>
+支持非流式 JSON 响应和 SSE 流式响应，响应延迟按指定的分布随机抽取，并可按比例返回错误。
+
+用法：
+    python -m stubs.cloudflare_ai 8082 --latency lognormal:0.8,0.5 --error-rate 0.02
+    然后设置环境变量 CF_API_BASE=http://127.0.0.1:8082
+    （以及任意非空的 CLOUDFLARE_ACCOUNT_ID / CLOUDFLARE_AUTH_TOKEN）再启动 main.py
+
+延迟分布（首个 token 前的等待时间，秒）：
+    fixed:0.5            固定值
+    uniform:0.2,1.5      均匀分布
+    lognormal:0.8,0.5    对数正态分布，参数为中位数和 sigma，长尾接近真实模型
+    exp:0.6              指数分布，参数为均值
+
+在测试代码中可以直接调用 start_stub()，它会在后台线程中启动服务，
+请求计数保存在返回对象的 stats 字典里。
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RUN_PATH = re.compile(r'^/client/v4/accounts/[^/]+/ai/run/.+$')
+
+FILLER = "这是一条来自本地桩服务的模拟回复，用于压力测试。它的长度和分段方式接近真实的模型输出。"
+
+
+def parse_latency(spec):
+    """把延迟分布描述（如 lognormal:0.8,0.5）转换为返回秒数的函数。"""
+    kind, _, args = spec.partition(':')
+    params = [float(x) for x in args.split(',')] if args else []
+    if kind == 'fixed' and len(params) == 1:
+        return lambda: params[0]
+    if kind == 'uniform' and len(params) == 2:
+        return lambda: random.uniform(params[0], params[1])
+    if kind == 'lognormal' and len(params) == 2:
+        mu = math.log(params[0])
+        return lambda: random.lognormvariate(mu, params[1])
+    if kind == 'exp' and len(params) == 1:
+        return lambda: random.expovariate(1 / params[0])
+    raise ValueError(f"无法识别的延迟分布: {spec}")
+
+
+class CloudflareStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency='lognormal:0.8,0.5', error_rate=0.0, api_error_rate=0.0,
+                 reply_chars=120, chunk_chars=4, token_interval=0.02):
+        super().__init__(address, _StubHandler)
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate  # 返回 HTTP 5xx 的比例
+        self.api_error_rate = api_error_rate  # 返回 200 但 success 为 false 的比例
+        self.reply_chars = reply_chars
+        self.chunk_chars = chunk_chars  # 流式响应每个 SSE 事件的字数
+        self.token_interval = token_interval  # 流式响应相邻两个事件的间隔（秒）
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "http_errors": 0, "api_errors": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def make_reply(self, messages):
+        """回显最后一条用户消息，再用固定文本补足到 reply_chars 字。"""
+        last = messages[-1].get('content', '') if messages else ''
+        text = f"收到：{last[:40]}。"
+        while len(text) < self.reply_chars:
+            text += FILLER
+        return text[:self.reply_chars]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 非流式响应保持长连接，与真实接口一致
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+        if not RUN_PATH.match(self.path.split('?', 1)[0]):
+            self._send_json(404, {"success": False, "errors": [{"code": 7000, "message": "No route for that URI"}]})
+            return
+
+        server = self.server
+        server.count("requests")
+        try:
+            data = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            self._send_json(400, {"success": False, "errors": [{"code": 5006, "message": "Invalid JSON"}]})
+            return
+
+        time.sleep(server.latency())
+        roll = random.random()
+        if roll < server.error_rate:
+            server.count("http_errors")
+            self._send_json(503, {"success": False, "errors": [{"code": 3040, "message": "Capacity temporarily exceeded"}]})
+            return
+        if roll < server.error_rate + server.api_error_rate:
+            server.count("api_errors")
+            self._send_json(200, {"success": False, "errors": [{"code": 3030, "message": "Internal server error"}], "result": None})
+            return
+
+        reply = server.make_reply(data.get('messages') or [])
+        if data.get('stream'):
+            server.count("streamed")
+            self._send_stream(reply)
+        else:
+            self._send_json(200, {"success": True, "errors": [], "messages": [], "result": {"response": reply}})
+
+    def _send_stream(self, reply):
+        """按 SSE 格式逐段发送回复，最后发送 [DONE]。客户端提前断开时直接结束。"""
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i in range(0, len(reply), server.chunk_chars):
+                if i:
+                    time.sleep(server.token_interval)
+                event = json.dumps({"response": reply[i:i + server.chunk_chars]}, ensure_ascii=False)
+                self.wfile.write(f"data: {event}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def start_stub(port=0, host='127.0.0.1', **options):
+    """
+    在后台线程中启动桩服务并返回服务对象，port=0 时自动分配端口。
+    options 与 CloudflareStubServer 的参数相同。
+    """
+    server = CloudflareStubServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cloudflare AI 接口本地桩服务")
+    parser.add_argument('port', type=int, nargs='?', default=8082)
+    parser.add_argument('--latency', default='lognormal:0.8,0.5', help="首个 token 前的延迟分布")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回 HTTP 503 的比例")
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help="返回 success=false 的比例")
+    parser.add_argument('--reply-chars', type=int, default=120, help="每条回复的字数")
+    parser.add_argument('--token-interval', type=float, default=0.02, help="流式响应的事件间隔（秒）")
+    args = parser.parse_args()
+
+    server = CloudflareStubServer(
+        ('127.0.0.1', args.port), latency=args.latency, error_rate=args.error_rate,
+        api_error_rate=args.api_error_rate, reply_chars=args.reply_chars, token_interval=args.token_interval,
+    )
+    print(f"Cloudflare AI 桩服务已启动: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
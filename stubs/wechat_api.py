@@ -0,0 +1,100 @@
+"""
+微信接口本地桩服务 - 模拟 access_token 与客服消息接口
+用法：
+    python -m stubs.wechat_api 8081
+    然后设置环境变量 WECHAT_API_BASE=http://127.0.0.1:8081 再启动 main.py
+
+在测试代码中可以直接调用 start_stub()，它会在后台线程中启动服务，
+收到的客服消息保存在返回对象的 messages 列表里。
+"""
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+STUB_TOKEN = "stub_access_token"
+
+
+class WechatStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, _StubHandler)
+        self.messages = []  # 收到的客服消息 (touser, content)
+        self.lock = threading.Lock()
+        self.received = threading.Condition(self.lock)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def wait_for_messages(self, count, timeout=10):
+        """
+        等待收到至少 count 条客服消息，返回消息列表的副本。
+        """
+        with self.received:
+            self.received.wait_for(lambda: len(self.messages) >= count, timeout=timeout)
+            return list(self.messages)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/cgi-bin/token':
+            self._send_json({"access_token": STUB_TOKEN, "expires_in": 7200})
+        else:
+            self._send_json({"errcode": 404, "errmsg": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+
+        if url.path != '/cgi-bin/message/custom/send':
+            self._send_json({"errcode": 404, "errmsg": "not found"})
+            return
+        token = parse_qs(url.query).get('access_token', [''])[0]
+        if token != STUB_TOKEN:
+            self._send_json({"errcode": 40001, "errmsg": "invalid credential"})
+            return
+
+        data = json.loads(payload.decode('utf-8'))
+        server = self.server
+        with server.received:
+            server.messages.append((data.get('touser'), data.get('text', {}).get('content')))
+            server.received.notify_all()
+        self._send_json({"errcode": 0, "errmsg": "ok"})
+
+
+def start_stub(port=0, host='127.0.0.1'):
+    """
+    在后台线程中启动桩服务并返回服务对象，port=0 时自动分配端口。
+    """
+    server = WechatStubServer((host, port))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    server = WechatStubServer(('127.0.0.1', port))
+    print(f"微信接口桩服务已启动: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -25,16 +25,18 @@ def generate_signature(timestamp: str, nonce: str) -> str:
     return hashlib.sha1(tmp_str.encode('utf-8')).hexdigest()
 
 
-def build_message_xml(content: str) -> str:
+def build_message_xml(content: str, user_id: str = TEST_USER_ID, msg_id: str = None) -> str:
     """
     构建发送给服务器的微信消息 XML
+    压测时可以指定模拟的用户 OpenID 和消息ID（服务器按 MsgId 去重，并发发送时需保证唯一）
     """
     timestamp = int(time.time())
-    msg_id = str(int(time.time() * 1000))  # 模拟消息ID
+    if msg_id is None:
+        msg_id = str(int(time.time() * 1000))  # 模拟消息ID
     
     xml_template = f"""<xml>
     <ToUserName><![CDATA[{BOT_ID}]]></ToUserName>
-    <FromUserName><![CDATA[{TEST_USER_ID}]]></FromUserName>
+    <FromUserName><![CDATA[{user_id}]]></FromUserName>
     <CreateTime>{timestamp}</CreateTime>
     <MsgType><![CDATA[text]]></MsgType>
     <Content><![CDATA[{content}]]></Content>
@@ -43,6 +45,15 @@ def build_message_xml(content: str) -> str:
     return xml_template
 
 
+def sign_params() -> dict:
+    """
+    生成带签名的请求参数
+    """
+    timestamp = str(int(time.time()))
+    nonce = "test_nonce_123"
+    return {'signature': generate_signature(timestamp, nonce), 'timestamp': timestamp, 'nonce': nonce}
+
+
 def parse_response_xml(xml_str: str) -> str:
     """
     解析服务器返回的 XML，提取回复内容
@@ -68,21 +79,12 @@ def send_message(content: str) -> str:
     # 构建请求数据
     xml_data = build_message_xml(content)
     
-    # 生成签名参数
-    timestamp = str(int(time.time()))
-    nonce = "test_nonce_123"
-    signature = generate_signature(timestamp, nonce)
-    
-    # 发送 POST 请求
+    # 发送 POST 请求（带签名参数）
     try:
         response = requests.post(
             SERVER_URL,
             data=xml_data.encode('utf-8'),
-            params={
-                'signature': signature,
-                'timestamp': timestamp,
-                'nonce': nonce
-            },
+            params=sign_params(),
             headers={'Content-Type': 'application/xml'},
             timeout=30
         )
@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import config
+
+# 模型调用的准入控制：
+# 1. 令牌桶：按上游配额（LLM_RATE_PER_MINUTE）限制调用速率，整个账号共用；
+# 2. 并发上限：同时进行的调用不超过 LLM_MAX_CONCURRENCY，其余排队等待；
+# 3. 排队人数或等待时间超出预算时立即拒绝（抛出 Overloaded），由调用方回复繁忙提示。
+# 限制只在单进程内生效，多进程部署时需按进程数分摊配置。
+
+class Overloaded(Exception):
+    """模型调用被拒绝（排队已满、等待超时或超出速率配额）。"""
+
+
+_cond = threading.Condition()
+_in_flight = 0
+_waiting = 0
+_async_waiters = deque()  # 排队中的协程：(事件循环, Future)，释放名额时唤醒队首
+_bucket_tokens = None
+_bucket_updated = 0.0
+_stats = {"admitted": 0, "shed_queue_full": 0, "shed_timeout": 0, "shed_rate": 0, "wait_total": 0.0}
+
+
+def _reserve_token(now, max_wait):
+    """
+    从令牌桶中预留一个令牌（需持有 _cond）。返回需要等待的秒数；
+    等待时间超过 max_wait 时不预留，返回 None。
+    """
+    global _bucket_tokens, _bucket_updated
+    rate = config.LLM_RATE_PER_MINUTE / 60.0
+    if rate <= 0:
+        return 0.0
+    if _bucket_tokens is None:
+        _bucket_tokens = float(config.LLM_RATE_BURST)
+    else:
+        _bucket_tokens = min(float(config.LLM_RATE_BURST), _bucket_tokens + (now - _bucket_updated) * rate)
+    _bucket_updated = now
+
+    wait = 0.0 if _bucket_tokens >= 1 else (1 - _bucket_tokens) / rate
+    if wait > max_wait:
+        return None
+    _bucket_tokens -= 1
+    return wait
+
+
+def _check_and_reserve(start, timeout):
+    """检查排队人数并从令牌桶预留令牌，返回需要等待的秒数；超出预算时抛出 Overloaded。"""
+    with _cond:
+        if _in_flight >= config.LLM_MAX_CONCURRENCY and _waiting >= config.LLM_MAX_QUEUE:
+            _stats["shed_queue_full"] += 1
+            raise Overloaded("queue full")
+        rate_wait = _reserve_token(start, timeout)
+        if rate_wait is None:
+            _stats["shed_rate"] += 1
+            raise Overloaded("rate limited")
+    return rate_wait
+
+
+def _take_slot(start):
+    """占用一个并发名额（需持有 _cond）。"""
+    global _in_flight
+    _in_flight += 1
+    _stats["admitted"] += 1
+    _stats["wait_total"] += time.time() - start
+
+
+def _wake_async():
+    """唤醒排队最久的协程（需持有 _cond）。"""
+    if _async_waiters:
+        loop, waiter = _async_waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(_resolve_waiter, waiter)
+        except RuntimeError:  # 事件循环已关闭
+            _wake_async()
+
+
+def _resolve_waiter(waiter):
+    """在事件循环中唤醒协程；它已经超时或被取消时把这次唤醒转给下一个。"""
+    if waiter.done():
+        with _cond:
+            _wake_async()
+    else:
+        waiter.set_result(None)
+
+
+def _release_slot():
+    global _in_flight
+    with _cond:
+        _in_flight -= 1
+        # 线程和协程各唤醒一个，没抢到名额的一方重新排队
+        _cond.notify()
+        _wake_async()
+
+
+@contextmanager
+def admit(timeout=None):
+    """
+    申请一次模型调用，最多等待 timeout 秒（默认 LLM_QUEUE_TIMEOUT），失败抛出 Overloaded。
+    """
+    global _waiting
+    timeout = config.LLM_QUEUE_TIMEOUT if timeout is None else timeout
+    start = time.time()
+
+    rate_wait = _check_and_reserve(start, timeout)
+    if rate_wait > 0:
+        time.sleep(rate_wait)
+
+    with _cond:
+        _waiting += 1
+        try:
+            remaining = max(timeout - (time.time() - start), 0)
+            admitted = _cond.wait_for(lambda: _in_flight < config.LLM_MAX_CONCURRENCY, remaining)
+        finally:
+            _waiting -= 1
+        if not admitted:
+            _stats["shed_timeout"] += 1
+            raise Overloaded("queue timeout")
+        _take_slot(start)
+
+    try:
+        yield
+    finally:
+        _release_slot()
+
+
+@asynccontextmanager
+async def admit_async(timeout=None):
+    """
+    admit() 的协程版本，供异步入口使用：排队时挂起协程而不是占用线程。
+    与 admit() 共用并发名额和令牌桶；名额释放时（无论由线程还是协程释放）唤醒排队最久的协程。
+    """
+    global _waiting
+    timeout = config.LLM_QUEUE_TIMEOUT if timeout is None else timeout
+    start = time.time()
+
+    rate_wait = _check_and_reserve(start, timeout)
+    if rate_wait > 0:
+        await asyncio.sleep(rate_wait)
+
+    loop = asyncio.get_running_loop()
+    with _cond:
+        _waiting += 1
+    try:
+        while True:
+            with _cond:
+                if _in_flight < config.LLM_MAX_CONCURRENCY:
+                    _take_slot(start)
+                    break
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    _stats["shed_timeout"] += 1
+                    raise Overloaded("queue timeout")
+                waiter = loop.create_future()
+                _async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # 收到唤醒后被取消：把这次唤醒转给下一个协程
+                if waiter.done() and not waiter.cancelled():
+                    with _cond:
+                        _wake_async()
+                raise
+            finally:
+                with _cond:
+                    if (loop, waiter) in _async_waiters:
+                        _async_waiters.remove((loop, waiter))
+    finally:
+        with _cond:
+            _waiting -= 1
+
+    try:
+        yield
+    finally:
+        _release_slot()
+
+
+def get_stats():
+    """返回进行中的调用数、排队数、放行次数、各类拒绝次数和平均等待时间（秒）。"""
+    with _cond:
+        stats = dict(_stats, in_flight=_in_flight, waiting=_waiting)
+    stats["wait_avg"] = stats["wait_total"] / stats["admitted"] if stats["admitted"] else 0.0
+    return stats
@@ -0,0 +1,165 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+import aiohttp
+import config
+import tool.chatAI as chatAI
+import tool.http_client as http_client
+import tool.tracing as tracing
+import tool.wechat_api as wechat_api
+
+# 异步入口（server_async.py）使用的上游客户端：基于 aiohttp，等待上游时只占用协程。
+# 请求构造、流式解析和统计与同步版本（chatAI.chat_with_cf、wechat_api）共用。
+
+_session = None
+
+
+async def start():
+    """创建共享的 ClientSession，在事件循环中调用一次。"""
+    global _session
+    connector = aiohttp.TCPConnector(
+        limit_per_host=config.HTTP_POOL_SIZE,
+        ttl_dns_cache=config.HTTP_DNS_CACHE_TTL or None,
+        use_dns_cache=config.HTTP_DNS_CACHE_TTL > 0,
+    )
+    _session = aiohttp.ClientSession(connector=connector)
+
+
+async def close():
+    """关闭 ClientSession 和其中的长连接。"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def _count_error(url, error):
+    """上游错误与同步客户端记在同一个计数器中。"""
+    http_client.UPSTREAM_ERRORS.inc(urlsplit(url).hostname or "", error)
+
+
+@tracing.traced()
+async def chat_with_cf(messages, max_tokens=None, on_text=None, stream=None):
+    """
+    chatAI.chat_with_cf 的协程版本，返回值和出错时的错误信息格式相同。
+    on_text 为协程函数，依次收到生成的文本片段。
+    """
+    cf_request = chatAI.build_cf_request(messages, max_tokens, stream)
+    if cf_request is None:
+        return chatAI.CONFIG_INCOMPLETE_REPLY
+    API_URL, headers, data = cf_request
+    stream = data.get("stream", False)
+    timeout = aiohttp.ClientTimeout(total=20, sock_connect=config.HTTP_CONNECT_TIMEOUT)
+
+    start = time.time()
+    try:
+        async with _session.post(API_URL, headers=headers, json=data, timeout=timeout) as response:
+            tracing.annotate(status=response.status)
+            if response.status >= 400:
+                print(f"HTTP Error: {response.status}, {await response.text()}")
+                _count_error(API_URL, f"HTTP {response.status}")
+                chatAI.LLM_ERRORS.inc(f"HTTP {response.status}")
+                return f"请求失败: 状态码 {response.status}"
+
+            if stream:
+                reader = chatAI.StreamAccumulator()
+                async for raw_line in response.content:
+                    new_text = reader.feed(raw_line.decode('utf-8').strip())
+                    if on_text and new_text:
+                        await on_text(new_text)
+                    if reader.done:
+                        break
+                if reader.early_stop:
+                    # 提前结束时关闭连接，不再等待模型生成剩余内容
+                    response.close()
+                chatAI.record_llm_call(time.time() - start, reader.ttft, reader.early_stop)
+                return chatAI.stream_result(reader.text)
+
+            result = await response.json(content_type=None)
+            chatAI.record_llm_call(time.time() - start)
+            return chatAI.parse_cf_result(result)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Network exception: {e!r}")
+        _count_error(API_URL, type(e).__name__)
+        chatAI.LLM_ERRORS.inc(type(e).__name__)
+        return f"网络请求异常: {e!r}"
+    except ValueError as e:
+        print(f"Invalid response: {e}")
+        chatAI.LLM_ERRORS.inc("InvalidResponse")
+        return "API返回错误: 响应格式错误"
+    finally:
+        chatAI.LLM_SECONDS.observe(time.time() - start, "stream" if stream else "blocking")
+
+
+async def send_text_message(openid, content):
+    """wechat_api.send_text_message 的协程版本，成功返回 True。"""
+    body = wechat_api.build_text_message_body(openid, content)
+    loop = asyncio.get_running_loop()
+
+    for attempt in range(2):
+        # access_token 有缓存，只有过期时才会真正发起请求，放到默认线程池中获取
+        token = await loop.run_in_executor(None, wechat_api.get_access_token, attempt > 0)
+        if not token:
+            return False
+
+        url = f"{config.WECHAT_API_BASE}/cgi-bin/message/custom/send"
+        try:
+            with tracing.span('http', method='POST', host=urlsplit(url).hostname):
+                async with _session.post(url, params={"access_token": token}, data=body,
+                                         timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"发送客服消息时发生错误: {e!r}")
+            _count_error(url, type(e).__name__)
+            return False
+
+        ok = wechat_api.check_send_result(result)
+        if ok is not None:
+            return ok
+    return False
+
+
+class StreamingReply:
+    """
+    wechat_api.StreamingReply 的协程版本：被动回复超时后调用 start()，
+    之后按句分段通过客服消息推送，finish() 推送剩余内容。
+    """
+
+    def __init__(self, openid):
+        self.openid = openid
+        self._lock = asyncio.Lock()
+        self._buffer = ""
+        self._received = False
+        self._started = False
+
+    async def on_text(self, piece):
+        async with self._lock:
+            self._buffer += piece
+            self._received = True
+            if self._started:
+                await self._send_segments()
+
+    async def start(self):
+        """切换为异步推送模式，先推送已经积累的完整句子。"""
+        async with self._lock:
+            self._started = True
+            await self._send_segments()
+
+    async def finish(self, content):
+        """生成结束后推送剩余文本。没有收到任何流式文本时（如天气回复、出错）推送 content。"""
+        async with self._lock:
+            remainder = self._buffer if self._received else content
+            self._buffer = ""
+            if remainder and remainder.strip():
+                await self._send(remainder.strip())
+
+    async def _send_segments(self):
+        segments, self._buffer = wechat_api.split_segments(self._buffer)
+        for segment in segments:
+            await self._send(segment)
+
+    async def _send(self, content):
+        if not await send_text_message(self.openid, content):
+            print(f"客服消息推送失败: {self.openid}")
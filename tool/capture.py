@@ -0,0 +1,151 @@
+import contextvars
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+import config
+import tool.tracing as tracing
+
+# 生产流量采集（CAPTURE_ENABLED 开启）：把收到的消息XML、到达时间和处理耗时写入按大小轮转的 JSONL 文件，
+# 供 bench/replay.py 按原始节奏回放。FromUserName 用 tracing.anonymize 替换，
+# 跨重启回放同一用户的对话时需要配置固定的 ANON_SALT。
+# record() 只把原始数据放入队列，匿名化和写文件在写线程中完成；队列满时丢弃并计数。
+# 轮转出的旧文件用 gzip 压缩（capture.jsonl.1.gz ...）。
+# 是否改为客服消息推送由 reply_within_deadline 超时时调用 mark_pushed() 标记，
+# 非文本消息、事件和空消息同样回复 success，但不算推送。
+
+_queue = queue.Queue(maxsize=config.CAPTURE_QUEUE_SIZE)
+_writer = None
+_STOP = object()
+_dropped = 0
+_current = contextvars.ContextVar('capture_request', default=None)
+
+
+class _Request:
+    __slots__ = ('pushed',)
+
+    def __init__(self):
+        self.pushed = False
+
+
+@contextmanager
+def track():
+    """在请求入口使用，返回的对象的 pushed 属性表示本次请求是否改为客服消息推送。"""
+    request = _Request()
+    token = _current.set(request)
+    try:
+        yield request
+    finally:
+        _current.reset(token)
+
+
+def mark_pushed():
+    """标记当前请求已改为客服消息推送，不在 track() 中时不做任何事。"""
+    request = _current.get()
+    if request is not None:
+        request.pushed = True
+
+
+def record(xml_data, received_at, duration, pushed):
+    """记录一条请求：原始XML、到达时间、处理耗时（秒）和是否改为客服消息推送。"""
+    global _dropped
+    if _writer is None:
+        return
+    try:
+        _queue.put_nowait((xml_data, received_at, duration, pushed))
+    except queue.Full:
+        _dropped += 1
+
+
+def get_dropped():
+    return _dropped
+
+
+def anonymize_xml(xml_data):
+    """把消息XML中的 FromUserName 替换为匿名 id，返回紧凑的XML字符串。格式错误时返回 None。"""
+    try:
+        root = ET.fromstring(xml_data)
+    except ET.ParseError:
+        return None
+    sender = root.find('FromUserName')
+    if sender is not None:
+        sender.text = tracing.anonymize(sender.text)
+    return ET.tostring(root, encoding='unicode')
+
+
+def _namer(name):
+    return name + '.gz'
+
+
+def _rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def _make_logger():
+    os.makedirs(os.path.dirname(config.CAPTURE_FILE), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        config.CAPTURE_FILE, maxBytes=config.CAPTURE_MAX_BYTES,
+        backupCount=config.CAPTURE_BACKUPS, encoding='utf-8'
+    )
+    handler.namer = _namer
+    handler.rotator = _rotator
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = logging.getLogger('chat_server.capture')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+        old.close()
+    logger.addHandler(handler)
+    return logger
+
+
+def _writer_loop(logger):
+    while True:
+        item = _queue.get()
+        if item is _STOP:
+            break
+        xml_data, received_at, duration, pushed = item
+        xml_text = anonymize_xml(xml_data)
+        if xml_text is None:
+            continue
+        # 键名尽量短：t 到达时间，ms 处理耗时，async 是否改为客服消息推送
+        entry = {"t": round(received_at, 3), "ms": round(duration * 1000, 1), "xml": xml_text}
+        if pushed:
+            entry["async"] = 1
+        logger.info(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def start_writer():
+    """开启采集（CAPTURE_ENABLED 为真时由启动钩子调用）。"""
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    try:
+        logger = _make_logger()
+    except OSError as e:
+        print(f"打开流量采集文件失败: {e}")
+        return
+    _writer = threading.Thread(target=_writer_loop, args=(logger,), name='capture-writer', daemon=True)
+    _writer.start()
+
+
+def stop_writer(timeout=10):
+    """停止采集：队列中已有的记录全部写入后再退出。"""
+    global _writer
+    writer = _writer
+    if writer is None:
+        return
+    _writer = None
+    _queue.put(_STOP)
+    writer.join(timeout)
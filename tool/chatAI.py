@@ -1,34 +1,29 @@
 import config
 import requests
-import os
+import json
+import threading
+import time
 import tool.database as db
+import tool.http_client as http_client
 import tool.weather as weather  # 导入天气模块
+import tool.persona as persona
+import tool.context_builder as context_builder
+import tool.reply_cache as reply_cache
+import tool.admission as admission
+import tool.metrics as metrics
+import tool.tracing as tracing
 
-    
-def get_identity_prompt(identity_id):
-    """根据身份ID获取对应的prompt内容。"""
-    base_prompt = "你是一个名为驱不散的雾的AI助手。你的任务是友好、简洁地回答用户的问题。请始终使用简体中文回复。回复应像真人聊天，通常不超过30字，除非用户要求详细解释。"
-
-    if identity_id == 0:
-        return base_prompt
+# chat_with_cf 出错时返回内容的前缀，这类回复不计入历史
+ERROR_PREFIXES = ("API返回错误:", "请求失败:", "网络请求异常:")
 
-    persona = config.PERSONAS.get(str(identity_id))
-    if not persona: 
-        return base_prompt
+def is_error_reply(reply):
+    """判断 chat_with_cf 的返回是否为错误信息或繁忙提示。"""
+    return not reply or reply.startswith(ERROR_PREFIXES) or reply == config.BUSY_REPLY
 
-    filename = persona.get("file")
-    if not filename:
-        return base_prompt
-
-    try:
-        # prompt 文件夹在项目根目录，不在 tool 目录下
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        filepath = os.path.join(base_dir, 'prompt', filename)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            persona_prompt = f.read().strip()
-            return persona_prompt
-    except FileNotFoundError:
-        return base_prompt
+    
+def get_identity_prompt(identity_id):
+    """根据身份ID获取对应的prompt内容（从内存中的身份注册表读取）。"""
+    return persona.get_prompt(identity_id)
 
 def get_weather_report(city):
     """获取并格式化天气报告。"""
@@ -41,89 +36,345 @@ def get_weather_report(city):
         return f"今日{city_name}的天气是{weather_type}，温度是{temp}，有{wind}。"
     return None
 
-def get_response(user_id, user_message):
-    """获取AI回复，并管理会话历史。"""
+def get_weather_reports(cities):
+    """获取多个城市的天气报告，每个城市一行，全部查不到时返回 None。"""
+    reports = [get_weather_report(city) for city in cities[:config.WEATHER_MAX_CITIES]]
+    reports = [report for report in reports if report]
+    if not reports:
+        return None
+    # 启动时加载的旧快照还没有刷新成功时，说明数据的时间
+    note = weather.get_staleness_note()
+    if note:
+        reports.append(note)
+    return "\n".join(reports)
+
+class ChatTurn:
+    """
+    一轮对话的准备结果，由 prepare_response() 生成。
+    reply 不为 None 时无需调用模型（天气回复等），直接返回即可；
+    cached_reply 不为 None 时命中了回复缓存，仍需调用 finish_response() 写入历史；
+    其余情况使用 messages 和 max_tokens 调用模型后，再调用 finish_response()。
+    """
+
+    def __init__(self, user_id, user_message, reply=None):
+        self.user_id = user_id
+        self.user_message = user_message
+        self.reply = reply
+        self.identity_id = None
+        self.messages = None
+        self.max_tokens = None
+        self.cacheable = False
+        self.cached_reply = None
+
+def prepare_response(user_id, user_message):
+    """
+    处理待处理动作和天气查询，并为标准聊天构建上下文、查询回复缓存。
+    只做数据库和内存操作，不调用模型，同步和异步入口共用。
+    """
     
     # 1. 检查是否有待处理的动作
     pending_action = db.get_user_setting(user_id, 'pending_action')
     if pending_action == 'awaiting_city_for_weather':
         # 用户回复了城市名，直接查天气
-        report = get_weather_report(user_message.strip())
+        report = get_weather_reports([user_message.strip()]) or get_weather_reports(weather.find_cities(user_message))
         db.update_user_setting(user_id, 'pending_action', None) # 清除状态
         if report:
             # 天气查询成功，不计入历史，直接返回结果
-            return report
+            return ChatTurn(user_id, user_message, reply=report)
         # 如果用户回复的不是城市名，或者查不到，则继续走标准流程
 
     # 2. 检查用户是否在问天气
     weather_keywords = ['天气', '气温', '温度']
     if any(keyword in user_message for keyword in weather_keywords):
-        # 尝试从消息中提取城市名 (例如 "北京天气怎么样" or "查一下北京的天气")
-        all_cities = weather.get_all_cities() # 获取所有支持的城市列表
-        found_city = None
-        for city in all_cities:
-            if city in user_message:
-                found_city = city
-                break
+        # 一次扫描提取消息中的所有城市名 (例如 "北京天气怎么样" or "北京和上海的气温")
+        found_cities = weather.find_cities(user_message)
         
-        if found_city:
+        if found_cities:
             # 找到了城市，直接查询并返回天气
-            report = get_weather_report(found_city)
+            report = get_weather_reports(found_cities)
             if report:
                 # 天气查询成功，不计入历史，直接返回结果
-                return report
+                return ChatTurn(user_id, user_message, reply=report)
         else:
             # 没找到城市，向用户提问，并直接返回
             db.update_user_setting(user_id, 'pending_action', 'awaiting_city_for_weather')
-            return "想查询哪里的天气？"
+            return ChatTurn(user_id, user_message, reply="想查询哪里的天气？")
 
     # 3. 如果以上都不是，则走标准聊天流程
-    identity_id = db.get_user_identity(user_id)
-    identity_prompt = get_identity_prompt(identity_id)
-    
-    history = db.get_user_session(user_id) or []
-    messages_to_send = [{"role": "system", "content": identity_prompt}]
-    
-    history_for_api = history[-(config.MAX_HISTORY_LEN - 1):]
-    messages_to_send.extend(history_for_api)
+    turn = ChatTurn(user_id, user_message)
+    turn.identity_id = db.get_user_identity(user_id)
+    PERSONA_REQUESTS.inc(str(turn.identity_id or 0))
+    identity_prompt = get_identity_prompt(turn.identity_id)
     
-    messages_to_send.append({"role": "user", "content": user_message})
+    history = db.get_user_session(user_id, limit=config.MAX_HISTORY_LEN - 1) or []
+    summary, summary_upto = db.get_user_summary(user_id)
+    # 在 token 预算内选取最近的历史，更早的内容由摘要代替
+    turn.messages = context_builder.build_messages(
+        identity_prompt, history, user_message, summary=summary, summary_upto=summary_upto
+    )
+    turn.max_tokens = persona.get_max_tokens(turn.identity_id)
 
-    ai_response = chat_with_cf(messages_to_send)
+    # 没有上下文的短消息先查回复缓存
+    turn.cacheable = not summary and reply_cache.is_cacheable(turn.identity_id, user_message, len(history))
+    if turn.cacheable:
+        turn.cached_reply = reply_cache.get(turn.identity_id, user_message)
+    return turn
 
-    if ai_response and not ai_response.startswith(("API返回错误:", "请求失败:", "网络请求异常:")):
-        history.append({"role": "user", "content": user_message})
-        history.append({"role": "assistant", "content": ai_response})
-        final_history_to_save = history[-config.MAX_HISTORY_LEN:]
-        db.update_user_session(user_id, final_history_to_save)
-    
+def finish_response(turn, ai_response, latency=0.0):
+    """模型回复（或缓存的回复）生成后，写入回复缓存和会话历史，返回回复内容。"""
+    if turn.cacheable and turn.cached_reply is None and not is_error_reply(ai_response):
+        reply_cache.put(turn.identity_id, turn.user_message, ai_response, latency)
+
+    if not is_error_reply(ai_response):
+        db.append_messages(turn.user_id, [
+            {"role": "user", "content": turn.user_message},
+            {"role": "assistant", "content": ai_response},
+        ])
     return ai_response
 
-def chat_with_cf(messages):
-    """调用Cloudflare AI API。"""
+@tracing.traced()
+def get_response(user_id, user_message, on_text=None):
+    """
+    获取AI回复，并管理会话历史。
+    on_text 会收到模型流式生成的文本片段（天气等直接回复不会触发）。
+    """
+    turn = prepare_response(user_id, user_message)
+    if turn.reply is not None:
+        return turn.reply
+    if turn.cached_reply is not None:
+        return finish_response(turn, turn.cached_reply)
+
+    start = time.time()
+    try:
+        # 准入控制：并发和速率超出预算时直接回复繁忙提示，不再排队等超时
+        with admission.admit():
+            ai_response = chat_with_cf(turn.messages, max_tokens=turn.max_tokens, on_text=on_text)
+    except admission.Overloaded:
+        return config.BUSY_REPLY
+    return finish_response(turn, ai_response, time.time() - start)
+
+def summarize_user_history(user_id, last_seq, upto_seq):
+    """
+    把用户 (upto_seq, last_seq - SUMMARY_KEEP_RECENT] 之间的消息连同旧摘要折叠成新摘要。
+    成功返回 True。
+    """
+    fold_upto = last_seq - config.SUMMARY_KEEP_RECENT
+    if fold_upto <= upto_seq:
+        return False
+    old_summary, _ = db.get_user_summary(user_id)
+    messages = db.get_messages_between(user_id, upto_seq, fold_upto)
+    if not messages:
+        return False
+
+    content = ""
+    if old_summary:
+        content += f"之前的摘要：\n{old_summary}\n\n"
+    content += "新的对话：\n" + context_builder.format_transcript(messages)
+    prompt = [
+        {"role": "system", "content": f"请用不超过{config.SUMMARY_MAX_CHARS}字的简体中文，总结对话中关于用户的重要信息、偏好和正在进行的话题，供之后的对话参考。只输出摘要本身。"},
+        {"role": "user", "content": content},
+    ]
+    # 后台任务不排队，模型繁忙时把机会让给用户，下次再试
+    try:
+        with admission.admit(timeout=0):
+            summary = chat_with_cf(prompt)
+    except admission.Overloaded:
+        return False
+    if is_error_reply(summary):
+        return False
+    return db.save_user_summary(user_id, summary[:config.SUMMARY_MAX_CHARS * 2], messages[-1]["seq"])
+
+def refresh_summaries():
+    """为积累了较多未摘要消息的用户更新滚动摘要，返回更新的用户数。"""
+    min_unsummarized = config.SUMMARY_KEEP_RECENT + config.SUMMARY_MIN_BATCH
+    updated = 0
+    for user_id, last_seq, upto_seq in db.get_users_needing_summary(min_unsummarized):
+        if summarize_user_history(user_id, last_seq, upto_seq):
+            updated += 1
+    return updated
+
+# 模型调用统计：首 token 时间、总生成时间、提前结束次数
+_llm_stats_lock = threading.Lock()
+_llm_stats = {"calls": 0, "streamed": 0, "ttft_total": 0.0, "duration_total": 0.0, "early_stops": 0}
+
+# 模型调用耗时（按是否流式区分）、失败次数（按错误类型）和各身份的对话次数，同步和异步客户端共用
+LLM_SECONDS = metrics.histogram('chat_llm_seconds', '调用 Cloudflare AI 的耗时（秒）', ('mode',))
+LLM_ERRORS = metrics.counter('chat_llm_errors_total', '模型调用失败次数', ('error',))
+PERSONA_REQUESTS = metrics.counter('chat_persona_requests_total', '各身份的对话次数', ('persona',))
+
+def record_llm_call(duration, ttft=None, early_stop=False):
+    """记录一次模型调用（同步和异步客户端共用）。"""
+    with _llm_stats_lock:
+        _llm_stats["calls"] += 1
+        _llm_stats["duration_total"] += duration
+        if ttft is not None:
+            _llm_stats["streamed"] += 1
+            _llm_stats["ttft_total"] += ttft
+        if early_stop:
+            _llm_stats["early_stops"] += 1
+
+def get_llm_stats():
+    """返回模型调用统计：调用次数、平均首 token 时间、平均总耗时（秒）和提前结束次数。"""
+    with _llm_stats_lock:
+        stats = dict(_llm_stats)
+    stats["avg_ttft"] = stats["ttft_total"] / stats["streamed"] if stats["streamed"] else 0
+    stats["avg_duration"] = stats["duration_total"] / stats["calls"] if stats["calls"] else 0
+    return stats
+
+def _truncate_reply(text):
+    """
+    检查流式输出是否已达到长度限制。返回 (保留的文本, 是否应停止)。
+    达到句子数上限时在该句末尾截断；达到字数上限时尽量在最后一个完整句子处截断。
+    """
+    if config.STREAM_MAX_SENTENCES > 0:
+        count = 0
+        for i, ch in enumerate(text):
+            if ch in config.SENTENCE_ENDINGS and i > 0 and text[i - 1] not in config.SENTENCE_ENDINGS:
+                count += 1
+                if count >= config.STREAM_MAX_SENTENCES:
+                    return text[:i + 1], True
+    if config.STREAM_MAX_CHARS > 0 and len(text) >= config.STREAM_MAX_CHARS:
+        head = text[:config.STREAM_MAX_CHARS]
+        cut = max(head.rfind(ch) for ch in config.SENTENCE_ENDINGS)
+        return (head[:cut + 1] if cut > 0 else head), True
+    return text, False
+
+class StreamAccumulator:
+    """
+    把 SSE 数据行累积成回复文本，处理长度限制和首 token 时间。
+    同步（_read_stream）和异步（tool/async_client.py）两种读取方式共用。
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.ttft = None
+        self.text = ""
+        self.done = False
+        self.early_stop = False
+
+    def feed(self, line):
+        """处理一行 SSE 数据，返回新保留下来的文本（可能为空）。读取应在 done 为 True 时结束。"""
+        if not line or not line.startswith("data:"):
+            return ""
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            self.done = True
+            return ""
+        piece = json.loads(payload).get("response") or ""
+        if not piece:
+            return ""
+        if self.ttft is None:
+            self.ttft = time.time() - self.start
+
+        kept, stop = _truncate_reply(self.text + piece)
+        # 已经交给 on_text 的文本不再收回
+        if len(kept) < len(self.text):
+            kept = self.text
+        new_text = kept[len(self.text):]
+        self.text = kept
+        if stop:
+            self.done = True
+            self.early_stop = True
+        return new_text
+
+def _read_stream(response, on_text):
+    """
+    读取 SSE 流式响应，返回 (完整文本, 首 token 时间, 是否提前结束)。
+    每收到一段保留下来的文本就调用一次 on_text。
+    """
+    reader = StreamAccumulator()
+    # text/event-stream 响应不带 charset，requests 会按 ISO-8859-1 解码，中文会变成乱码
+    response.encoding = 'utf-8'
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            new_text = reader.feed(line)
+            if on_text and new_text:
+                on_text(new_text)
+            if reader.done:
+                break
+    finally:
+        # 提前结束时关闭连接，不再等待模型生成剩余内容
+        response.close()
+    return reader.text, reader.ttft, reader.early_stop
+
+def build_cf_request(messages, max_tokens=None, stream=None):
+    """
+    构造 Cloudflare AI 请求，返回 (url, headers, data)；配置不完整时返回 None。
+    stream 默认取 CF_STREAM_ENABLED。
+    """
     if not all([config.ACCOUNT_ID, config.AUTH_TOKEN, config.MODEL]):
-        return "网络请求异常: 服务器配置不完整，请联系管理员。"
+        return None
 
-    API_URL = f"https://api.cloudflare.com/client/v4/accounts/{config.ACCOUNT_ID}/ai/run/@cf/meta/{config.MODEL}"
+    API_URL = f"{config.CF_API_BASE}/client/v4/accounts/{config.ACCOUNT_ID}/ai/run/@cf/meta/{config.MODEL}"
 
     headers = {"Authorization": f"Bearer {config.AUTH_TOKEN}"}
     data = {"messages": messages}
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    if stream is None:
+        stream = config.CF_STREAM_ENABLED
+    if stream:
+        data["stream"] = True
+    return API_URL, headers, data
+
+def stream_result(text):
+    """把流式读取到的完整文本转换为 chat_with_cf 的返回值。"""
+    if text.strip():
+        return text.strip()
+    print("API Error: 流式响应没有内容")
+    LLM_ERRORS.inc("EmptyStream")
+    return "API返回错误: 模型没有返回内容"
 
+def parse_cf_result(result):
+    """把非流式响应的 JSON 转换为 chat_with_cf 的返回值。"""
+    if result.get('success') and result.get('result'):
+        return result['result']['response'].strip()
+    else:
+        error_details = result.get('errors') or result.get('messages', '未知API错误')
+        print(f"API Error: {error_details}")
+        LLM_ERRORS.inc("APIError")
+        return f"API返回错误: {error_details}"
+
+CONFIG_INCOMPLETE_REPLY = "网络请求异常: 服务器配置不完整，请联系管理员。"
+
+@tracing.traced()
+def chat_with_cf(messages, max_tokens=None, on_text=None, stream=None):
+    """
+    调用Cloudflare AI API。
+    stream 为 True（默认取 CF_STREAM_ENABLED）时使用流式响应，达到长度限制即提前结束；
+    on_text 会依次收到生成的文本片段，可用于边生成边推送。
+    """
+    cf_request = build_cf_request(messages, max_tokens, stream)
+    if cf_request is None:
+        return CONFIG_INCOMPLETE_REPLY
+    API_URL, headers, data = cf_request
+    stream = data.get("stream", False)
+
+    start = time.time()
     try:
-        response = requests.post(API_URL, headers=headers, json=data, timeout=20)
+        response = http_client.post(API_URL, headers=headers, json=data, timeout=20, stream=stream)
         response.raise_for_status()
 
+        if stream:
+            text, ttft, early_stop = _read_stream(response, on_text)
+            record_llm_call(time.time() - start, ttft, early_stop)
+            return stream_result(text)
+
         result = response.json()
-        if result.get('success') and result.get('result'):
-            return result['result']['response'].strip()
-        else:
-            error_details = result.get('errors') or result.get('messages', '未知API错误')
-            print(f"API Error: {error_details}")
-            return f"API返回错误: {error_details}"
+        record_llm_call(time.time() - start)
+        return parse_cf_result(result)
             
     except requests.exceptions.HTTPError as e:
         print(f"HTTP Error: {e.response.status_code}, {e.response.text}")
+        LLM_ERRORS.inc(f"HTTP {e.response.status_code}")
         return f"请求失败: 状态码 {e.response.status_code}"
     except requests.exceptions.RequestException as e:
         print(f"Network exception: {e}")
-        return f"网络请求异常: {e}"
\ No newline at end of file
+        LLM_ERRORS.inc(type(e).__name__)
+        return f"网络请求异常: {e}"
+    except ValueError as e:
+        print(f"Invalid response: {e}")
+        LLM_ERRORS.inc("InvalidResponse")
+        return "API返回错误: 响应格式错误"
+    finally:
+        LLM_SECONDS.observe(time.time() - start, "stream" if stream else "blocking")
\ No newline at end of file
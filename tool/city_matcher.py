@@ -0,0 +1,79 @@
+from collections import deque
+
+# Aho-Corasick 多模式匹配：一次扫描消息即可找出其中出现的所有城市名。
+# 在天气缓存刷新时构建，之后只读，可以被多个线程同时使用。
+
+class CityMatcher:
+    def __init__(self, names):
+        """
+        names: {匹配词: 标准城市名}，匹配词可以是城市名本身或别名。
+        """
+        self._goto = [{}]       # 每个节点的转移表
+        self._fail = [0]        # 失败指针
+        self._word = [None]     # 以该节点结尾的词：(长度, 标准城市名)
+        self._dict_link = [0]   # 沿失败指针最近的、以词结尾的节点（0 表示没有）
+
+        for word, city in names.items():
+            if word:
+                self._add(word, city)
+        self._build()
+
+    def __len__(self):
+        return sum(1 for w in self._word if w is not None)
+
+    def _add(self, word, city):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._word.append(None)
+                self._dict_link.append(0)
+            node = nxt
+        self._word[node] = (len(word), city)
+
+    def _build(self):
+        """按广度优先计算失败指针和输出链接。"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[child] = fail
+                self._dict_link[child] = fail if self._word[fail] is not None else self._dict_link[fail]
+                queue.append(child)
+
+    def _matches(self, text):
+        """生成所有匹配 (起始位置, 长度, 标准城市名)。"""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            out = node if self._word[node] is not None else self._dict_link[node]
+            while out:
+                length, city = self._word[out]
+                yield i - length + 1, length, city
+                out = self._dict_link[out]
+
+    def find_all(self, text):
+        """
+        返回消息中提到的所有城市（按出现顺序、去重）。
+        重叠时优先最靠左、其次最长的匹配，例如“南京市”不会被识别成“南”+“京市”。
+        """
+        matches = sorted(self._matches(text), key=lambda m: (m[0], -m[1]))
+        cities = []
+        end = 0
+        for start, length, city in matches:
+            if start < end:
+                continue
+            end = start + length
+            if city not in cities:
+                cities.append(city)
+        return cities
@@ -2,123 +2,320 @@ import config
 import tool.database as database
 import random
 from datetime import datetime
-import tool.weather as weather
+import tool.persona as persona
+import tool.context_builder as context_builder
+import tool.chatAI as chatAI
+import tool.reply_cache as reply_cache
+import tool.dedup as dedup
+import tool.admission as admission
+import tool.metrics as metrics
+import tool.tracing as tracing
 import os
+import threading
+import time
 
 # 获取项目根目录
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+UNKNOWN_COMMAND_REPLY = "未知指令或格式错误。"
+
+# 各指令的调用次数，未知指令（以及非管理员使用的管理员指令）统一记为 unknown，避免标签无限增长
+COMMANDS = metrics.counter('chat_commands_total', '指令调用次数', ('command',))
+
+# --- 指令注册表 ---
+# 每个指令用 @command 声明名称、别名、是否仅限管理员、参数解析函数和用法；
+# handle_command 按名称查字典分发，新增指令不需要修改分发逻辑。
+
+class Command:
+    __slots__ = ('name', 'handler', 'aliases', 'admin', 'parser', 'usage')
+
+    def __init__(self, name, handler, aliases, admin, parser, usage):
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.admin = admin
+        self.parser = parser
+        self.usage = usage
+
+
+_commands = {}  # 指令名和别名 -> Command
+_stats_lock = threading.Lock()
+_stats = {}  # 指令名 -> {"calls", "total", "max"}（秒）
+
+def command(name, aliases=(), admin=False, parser=None, usage=None):
+    """
+    装饰器：注册一个指令，handler(args, from_user_name) 返回回复内容。
+    parser 把参数字符串转换为 handler 需要的值，抛出 ValueError 时回复“指令格式错误，请使用：usage”。
+    """
+    def decorator(handler):
+        cmd = Command(name, handler, tuple(aliases), admin, parser, usage or name)
+        for key in (name, *cmd.aliases):
+            if key in _commands:
+                raise ValueError(f"指令重复注册：{key}")
+            _commands[key] = cmd
+        return handler
+    return decorator
+
+def required(args):
+    """参数解析：参数不能为空。"""
+    if not args:
+        raise ValueError("缺少参数")
+    return args
+
+def _record(name, elapsed):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0})
+        stats["calls"] += 1
+        stats["total"] += elapsed
+        if elapsed > stats["max"]:
+            stats["max"] = elapsed
+
+def get_command_stats():
+    """返回各指令的调用次数、平均和最长耗时（秒），按调用次数从多到少排列。"""
+    with _stats_lock:
+        items = [(name, dict(stats)) for name, stats in _stats.items()]
+    result = []
+    for name, stats in sorted(items, key=lambda item: -item[1]["calls"]):
+        result.append((name, stats["calls"], stats["total"] / stats["calls"], stats["max"]))
+    return result
+
+# 指令文档只在第一次使用时读取，/reload 时清空
+_help_docs = {}
+
+def get_help_doc(doc_name):
+    """读取并缓存 command_md 中的指令文档，文件不存在时返回 None。"""
+    doc = _help_docs.get(doc_name)
+    if doc is None:
+        doc_file = os.path.join(BASE_DIR, 'command_md', doc_name)
+        try:
+            with open(doc_file, 'r', encoding='utf-8') as f:
+                doc = f.read()
+        except FileNotFoundError:
+            return None
+        _help_docs[doc_name] = doc
+    return doc
+
+def format_prompt_stats(stats):
+    """格式化各身份提示词的大小（每次对话都会附带这些 token）。"""
+    lines = ["各身份提示词大小："]
+    for persona_id, name, chars, tokens in stats:
+        lines.append(f"{persona_id}. {name}：{chars}字，约{tokens} tokens")
+    return "\n".join(lines)
+
+@tracing.traced()
 def handle_command(user_input, from_user_name):
     """
     处理用户输入的指令。
     返回一个字符串作为回复内容。
     """
     command_parts = user_input.split(maxsplit=1)
-    command = command_parts[0]
+    name = command_parts[0]
     args = command_parts[1] if len(command_parts) > 1 else ""
-    reply_content = "未知指令或格式错误。"  # 默认回复
+
+    cmd = _commands.get(name)
+    # 非管理员使用管理员指令时，和未知指令一样回复
+    if cmd is None or (cmd.admin and from_user_name not in config.ADMIN_USER_ID):
+        COMMANDS.inc("unknown")
+        return UNKNOWN_COMMAND_REPLY
+    COMMANDS.inc(cmd.name)
+    tracing.annotate(command=cmd.name)
+    if cmd.parser is not None:
+        try:
+            args = cmd.parser(args)
+        except ValueError:
+            return f"指令格式错误，请使用：{cmd.usage}"
+
+    start = time.perf_counter()
+    try:
+        return cmd.handler(args, from_user_name)
+    finally:
+        _record(cmd.name, time.perf_counter() - start)
+
+# --- 通用指令 ---
+
+@command('/意见', parser=required, usage='/意见 [内容]')
+def feedback(args, from_user_name):
+    database.add_feedback(from_user_name, args)
+    return "感谢你的反馈！"
+
+@command('/天气', parser=required, usage='/天气 [城市名]')
+def weather_report(args, from_user_name):
+    report = chatAI.get_weather_reports([args])
+    if report:
+        return report
+    return f"抱歉，未能查询到“{args}”的天气信息，请确认城市名称是否正确或等待数据更新。"
+
+@command('/身份列表')
+def persona_list(args, from_user_name):
+    return persona.get_persona_list_text()
+
+@command('/身份', parser=int, usage='/身份 [数字]')
+def switch_identity(identity_id, from_user_name):
+    if identity_id != 0 and str(identity_id) not in config.PERSONAS:
+        return "无效的身份编号。"
+    database.set_user_identity(from_user_name, identity_id)
+    if identity_id == 0:
+        return "已恢复默认身份。"
+    return f"身份已切换为：{config.PERSONAS[str(identity_id)]['name']}"
+
+@command('/当前身份')
+def current_identity(args, from_user_name):
+    identity_id = database.get_user_identity(from_user_name)
+    if identity_id == 0:
+        return "当前为默认身份。"
+    current = config.PERSONAS.get(str(identity_id))
+    return f"当前身份：{current['name'] if current else '未知身份'}"
+
+@command('/清空历史')
+def clear_history(args, from_user_name):
+    database.clear_user_history(from_user_name)
+    return "您的对话历史已清空。"
+
+@command('/随机身份')
+def random_identity(args, from_user_name):
+    random_id_str = random.choice(list(config.PERSONAS.keys()))
+    database.set_user_identity(from_user_name, int(random_id_str))
+    return f"已随机切换身份为：{config.PERSONAS[random_id_str]['name']}"
+
+@command('/指令', aliases=('/帮助',))
+def help_doc(args, from_user_name):
     is_admin = from_user_name in config.ADMIN_USER_ID
+    doc = get_help_doc('command_system.md' if is_admin else 'command_user.md')
+    return doc if doc is not None else "指令文档丢失，请联系管理员。"
 
-    # --- 通用指令 ---
-    if command == '/意见':
-        if args:
-            with open(config.FEEDBACK_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [{from_user_name}] {args}\n")
-            reply_content = "感谢你的反馈！"
-        else:
-            reply_content = "指令格式错误，请使用：/意见 [内容]"
-
-    elif command == '/天气':
-        if args:
-            weather_data = weather.get_weather(args)
-            if weather_data:
-                city = weather_data['city']
-                temp = weather_data['temp']
-                weather_type = weather_data['weather_type']
-                wind = weather_data['wind']
-                reply_content = f"今日{city}的天气是{weather_type}，温度是{temp}，有{wind}。"
-            else:
-                reply_content = f"抱歉，未能查询到“{args}”的天气信息，请确认城市名称是否正确或等待数据更新。"
+# --- 管理员专用指令 ---
+
+def parse_feedback_query(args):
+    """
+    解析 /反馈列表 的参数：[页码]、用户 [用户ID] [页码]、日期 [YYYY-MM-DD] [页码]。
+    返回 (页码, 用户ID, 起始日期)。
+    """
+    parts = args.split()
+    user_id = since = None
+    if parts and parts[0] in ('用户', '日期'):
+        if len(parts) < 2:
+            raise ValueError("缺少筛选条件")
+        if parts[0] == '用户':
+            user_id = parts[1]
         else:
-            reply_content = "指令格式错误，请使用：/天气 [城市名]"
+            since = datetime.strptime(parts[1], '%Y-%m-%d').strftime('%Y-%m-%d')
+        parts = parts[2:]
+    if len(parts) > 1:
+        raise ValueError("参数过多")
+    page = int(parts[0]) if parts else 1
+    if page < 1:
+        raise ValueError("页码无效")
+    return page, user_id, since
 
-    elif command == '/身份列表':
-        reply_content = "可选身份列表：\n"
-        for id, persona in config.PERSONAS.items():
-            reply_content += f"{id}. {persona['name']}\n"
-        reply_content += "使用 /身份 [数字] 切换，/身份 0 恢复默认。"
+@command('/反馈列表', admin=True, parser=parse_feedback_query,
+         usage='/反馈列表 [页码]、/反馈列表 用户 [用户ID] [页码] 或 /反馈列表 日期 [YYYY-MM-DD] [页码]')
+def feedback_list(query, from_user_name):
+    page, user_id, since = query
+    entries, total = database.get_feedback(page, user_id=user_id, since=since)
+    if not total:
+        return "目前没有反馈。"
+    pages = (total + config.FEEDBACK_PAGE_SIZE - 1) // config.FEEDBACK_PAGE_SIZE
+    if not entries:
+        return f"共{total}条反馈，只有{pages}页。"
+    lines = [f"反馈（第{page}/{pages}页，共{total}条）："]
+    lines += [f"#{e['id']} [{e['created_at']}] [{e['user_id']}] {e['content']}" for e in entries]
+    return "\n".join(lines)
 
-    elif command == '/身份':
-        try:
-            identity_id = int(args)
-            if identity_id == 0 or str(identity_id) in config.PERSONAS:
-                database.set_user_identity(from_user_name, identity_id)
-                if identity_id == 0:
-                    reply_content = "已恢复默认身份。"
-                else:
-                    reply_content = f"身份已切换为：{config.PERSONAS[str(identity_id)]['name']}"
-            else:
-                reply_content = "无效的身份编号。"
-        except (ValueError, KeyError):
-            reply_content = "指令格式错误或身份编号无效，请使用：/身份 [数字]"
-
-    elif command == '/当前身份':
-        identity_id = database.get_user_identity(from_user_name)
-        if identity_id == 0:
-            reply_content = "当前为默认身份。"
-        else:
-            persona = config.PERSONAS.get(str(identity_id))
-            reply_content = f"当前身份：{persona['name'] if persona else '未知身份'}"
-    
-    elif command == '/清空历史':
-        database.clear_user_history(from_user_name)
-        reply_content = "您的对话历史已清空。"
-
-    elif command == '/随机身份':
-        random_id_str = random.choice(list(config.PERSONAS.keys()))
-        database.set_user_identity(from_user_name, int(random_id_str))
-        reply_content = f"已随机切换身份为：{config.PERSONAS[random_id_str]['name']}"
-    
-    elif command == '/指令':
-        doc_name = 'command_system.md' if is_admin else 'command_user.md'
-        doc_file = os.path.join(BASE_DIR, 'command_md', doc_name)
-        try:
-            with open(doc_file, 'r', encoding='utf-8') as f:
-                reply_content = f.read()
-        except FileNotFoundError:
-            reply_content = "指令文档丢失，请联系管理员。"
-
-    # --- 管理员专用指令 ---
-    elif is_admin:
-        if command == '/反馈列表':
-            try:
-                with open(config.FEEDBACK_FILE, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                if not lines:
-                    reply_content = "目前没有反馈。"
-                else:
-                    reply_content = "最近30条反馈：\n" + "".join(lines[-30:])
-            except FileNotFoundError:
-                reply_content = "目前没有反馈。"
-        
-        elif command == '/访问':
-            total, today = database.get_access_stats()
-            reply_content = f"累计访问人数：{total}\n今日访问人数：{today}"
-
-        elif command == '/清除反馈':
-            try:
-                with open(config.FEEDBACK_FILE, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                if len(lines) <= 5:
-                    open(config.FEEDBACK_FILE, 'w').close()
-                    reply_content = "已清除所有反馈。"
-                else:
-                    with open(config.FEEDBACK_FILE, 'w', encoding='utf-8') as f:
-                        f.writelines(lines[:-5])
-                    reply_content = "已清除最近5条反馈。"
-            except FileNotFoundError:
-                reply_content = "反馈文件不存在，无需清除。"
-
-    return reply_content
-
-#Finish
\ No newline at end of file
+@command('/访问', admin=True)
+def access_stats(args, from_user_name):
+    if args in ('7', '30'):
+        daily, unique, approximate = database.get_daily_access_stats(int(args))
+        reply_content = f"最近{args}天独立访问人数：{'约' if approximate else ''}{unique}\n"
+        reply_content += "".join(f"{day[5:]}：{visitors}人/{visits}次\n" for day, visitors, visits in daily)
+        return reply_content.rstrip()
+    if args == '小时':
+        hourly = database.get_hourly_access_stats()
+        peak = max(hourly) or 1
+        reply_content = "今日每小时访问次数：\n"
+        reply_content += "".join(
+            f"{hour:02d}时 {'█' * round(visits * 10 / peak)} {visits}\n"
+            for hour, visits in enumerate(hourly) if visits
+        )
+        return reply_content.rstrip()
+    total, today = database.get_access_stats()
+    return f"累计访问人数：{total}\n今日访问人数：{today}"
+
+@command('/reload', admin=True)
+def reload_config(args, from_user_name):
+    stats = persona.reload(reload_config=True)
+    _help_docs.clear()
+    return "已重新加载配置、身份文件和指令文档。\n" + format_prompt_stats(stats)
+
+@command('/提示词', admin=True)
+def prompt_stats(args, from_user_name):
+    return format_prompt_stats(persona.get_prompt_stats())
+
+@command('/上下文', admin=True)
+def context_stats(args, from_user_name):
+    stats = context_builder.get_stats()
+    return (
+        f"对话调用次数：{stats['calls']}\n"
+        f"平均提示词：约{stats['avg_prompt_tokens']:.0f} tokens\n"
+        f"不裁剪时平均：约{stats['avg_full_tokens']:.0f} tokens\n"
+        f"节省比例：{stats['saved_ratio']:.0%}"
+    )
+
+@command('/模型', admin=True)
+def model_stats(args, from_user_name):
+    stats = chatAI.get_llm_stats()
+    gate = admission.get_stats()
+    return (
+        f"模型调用次数：{stats['calls']}（流式{stats['streamed']}次）\n"
+        f"平均首字时间：{stats['avg_ttft']:.2f}秒\n"
+        f"平均总耗时：{stats['avg_duration']:.2f}秒\n"
+        f"提前结束次数：{stats['early_stops']}\n"
+        f"进行中：{gate['in_flight']}，排队：{gate['waiting']}，平均等待{gate['wait_avg']:.2f}秒\n"
+        f"拒绝次数：排队已满{gate['shed_queue_full']}，等待超时{gate['shed_timeout']}，超出配额{gate['shed_rate']}"
+    )
+
+@command('/缓存', admin=True)
+def cache_stats(args, from_user_name):
+    replies = reply_cache.get_stats()
+    users = database.get_user_cache_stats()
+    retries = dedup.get_stats()
+    return (
+        f"回复缓存：命中率{replies['hit_rate']:.0%}（{replies['hits']}/{replies['hits'] + replies['misses']}），"
+        f"节省{replies['saved_seconds']:.1f}秒，{replies['size']}条/{replies['bytes'] // 1024}KB\n"
+        f"用户状态缓存：命中率{users['hit_rate']:.0%}，{users['size']}个用户\n"
+        f"重试去重：等待{retries['waited']}次，直接返回{retries['cached']}次"
+    )
+
+@command('/指令统计', admin=True)
+def command_stats(args, from_user_name):
+    stats = get_command_stats()
+    if not stats:
+        return "还没有指令调用记录。"
+    lines = ["各指令调用次数和耗时："]
+    for name, calls, avg, longest in stats:
+        lines.append(f"{name}：{calls}次，平均{avg * 1000:.1f}ms，最长{longest * 1000:.1f}ms")
+    return "\n".join(lines)
+
+def parse_profile_count(args):
+    """参数解析：要分析的请求数，没有参数时为1，不能为负数。"""
+    count = int(args) if args else 1
+    if count < 0:
+        raise ValueError(args)
+    return count
+
+@command('/性能分析', admin=True, parser=parse_profile_count, usage='/性能分析 [请求数]，/性能分析 0 取消')
+def profile_requests(count, from_user_name):
+    tracing.request_profiles(count)
+    if count == 0:
+        return "已取消尚未开始的性能分析。"
+    return f"将对接下来的{count}个请求进行性能分析，结果保存在 {config.PROFILE_DIR}。"
+
+def parse_optional_id(args):
+    """参数解析：可选的编号，没有参数时返回 None。"""
+    return int(args.lstrip('#')) if args else None
+
+@command('/清除反馈', admin=True, parser=parse_optional_id, usage='/清除反馈 或 /清除反馈 [编号]')
+def clear_feedback(feedback_id, from_user_name):
+    deleted = database.delete_feedback(feedback_id)
+    if feedback_id is not None:
+        return f"已清除反馈 #{feedback_id}。" if deleted else f"反馈 #{feedback_id} 不存在或已清除。"
+    return f"已清除最近{deleted}条反馈。" if deleted else "目前没有反馈，无需清除。"
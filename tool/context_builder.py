@@ -0,0 +1,77 @@
+import threading
+import config
+from tool.tokens import estimate_tokens
+
+# 上下文构建：在 token 预算内从最近的消息往前填充历史，
+# 更早的对话由后台任务折叠成滚动摘要，附在系统提示词之后。
+
+SUMMARY_HEADER = "\n\n以下是你与该用户之前对话的摘要，供参考：\n"
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "prompt_tokens": 0, "full_tokens": 0, "history_messages": 0, "dropped_messages": 0}
+
+
+def build_messages(system_prompt, history, user_message, summary=None, summary_upto=0, budget=None):
+    """
+    构建发送给模型的消息列表。
+    history 为带 seq 的历史消息（按时间顺序），seq <= summary_upto 的消息已包含在摘要中，不再发送。
+    budget 为历史消息（含摘要）可使用的 token 数，默认 CONTEXT_TOKEN_BUDGET。
+    """
+    budget = config.CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+    system_content = system_prompt
+    used = 0
+    if summary:
+        system_content += SUMMARY_HEADER + summary
+        used += estimate_tokens(summary)
+
+    # 从最近的消息往前填充，超出预算即停止
+    selected = []
+    for message in reversed(history):
+        if message.get("seq", 0) <= summary_upto:
+            break
+        tokens = estimate_tokens(message["content"])
+        if used + tokens > budget:
+            break
+        used += tokens
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
+
+    messages = [{"role": "system", "content": system_content}]
+    messages.extend(selected)
+    messages.append({"role": "user", "content": user_message})
+
+    base_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_message)
+    full_tokens = base_tokens + sum(estimate_tokens(m["content"]) for m in history)
+    _record(base_tokens + used, full_tokens, len(selected), len(history) - len(selected))
+    return messages
+
+
+def _record(prompt_tokens, full_tokens, history_messages, dropped_messages):
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["prompt_tokens"] += prompt_tokens
+        _stats["full_tokens"] += full_tokens
+        _stats["history_messages"] += history_messages
+        _stats["dropped_messages"] += dropped_messages
+
+
+def get_stats():
+    """
+    返回提示词 token 统计：调用次数、平均实际 token 数、
+    平均全量历史 token 数（不做裁剪时的开销）以及节省比例。
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    calls = stats["calls"]
+    stats["avg_prompt_tokens"] = stats["prompt_tokens"] / calls if calls else 0
+    stats["avg_full_tokens"] = stats["full_tokens"] / calls if calls else 0
+    saved = stats["full_tokens"] - stats["prompt_tokens"]
+    stats["saved_ratio"] = saved / stats["full_tokens"] if stats["full_tokens"] else 0
+    return stats
+
+
+def format_transcript(messages):
+    """把消息格式化成摘要任务使用的对话记录文本。"""
+    names = {"user": "用户", "assistant": "AI"}
+    return "\n".join(f"{names.get(m['role'], m['role'])}：{m['content']}" for m in messages)
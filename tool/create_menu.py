@@ -1,39 +1,14 @@
 import requests
 import json
 import config # 导入你的配置文件
-
-def get_access_token():
-    """
-    获取微信全局接口的 access_token
-    """
-    # 从配置文件中读取 AppID 和 AppSecret
-    app_id = config.APP_ID
-    app_secret = config.APP_SECRET
-
-    url = f"https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={app_id}&secret={app_secret}"
-    
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # 如果请求失败（非200状态码），则抛出异常
-        
-        result = response.json()
-        
-        if "access_token" in result:
-            print(f"成功获取 access_token，有效期至：{result['expires_in']} 秒")
-            return result['access_token']
-        else:
-            print(f"获取 access_token 失败：{result}")
-            return None
-            
-    except requests.exceptions.RequestException as e:
-        print(f"请求 access_token 时发生网络错误: {e}")
-        return None
+import tool.http_client as http_client
+import tool.wechat_api as wechat_api # access_token 的获取与服务共用（同样读取 WECHAT_API_BASE）
 
 def create_menu(access_token):
     """
     使用 access_token 创建自定义菜单
     """
-    url = f"https://api.weixin.qq.com/cgi-bin/menu/create?access_token={access_token}"
+    url = f"{config.WECHAT_API_BASE}/cgi-bin/menu/create"
     
     # --- 在这里定义你的菜单结构 ---
     # type: click -> 用户点击后，微信服务器会向你的后台发送一条消息，内容为 key 的值
@@ -74,7 +49,7 @@ def create_menu(access_token):
     menu_json = json.dumps(menu_data, ensure_ascii=False).encode('utf-8')
     
     try:
-        response = requests.post(url, data=menu_json)
+        response = http_client.post(url, params={"access_token": access_token}, data=menu_json)
         response.raise_for_status()
         
         result = response.json()
@@ -89,7 +64,7 @@ def create_menu(access_token):
 
 if __name__ == '__main__':
     print("开始创建自定义菜单...")
-    token = get_access_token()
+    token = wechat_api.get_access_token()
     if token:
         create_menu(token)
     else:
@@ -1,41 +1,183 @@
 import sqlite3
+import atexit
 import json
 import os
-from datetime import datetime
-from flask import g # 导入g
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from flask import g, has_app_context # 导入g
+import config
+import tool.metrics as metrics
+import tool.tracing as tracing
+from tool.hyperloglog import HyperLogLog
 
 # 数据库文件放在项目根目录
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATABASE_FILE = os.path.join(BASE_DIR, 'chat_history.db')
 
+# --- 用户状态缓存 ---
+# 缓存活跃用户的身份、待处理动作、最近的对话历史和摘要，按 LRU + TTL 淘汰。
+# 每次写入用户状态都在同一事务中把 user_versions 表里该用户的版本号加一，并更新本进程的缓存（write-through）。
+# 缓存记录了数据对应的版本号，距上次核对超过 USER_CACHE_CHECK_INTERVAL 秒时读取前先查一次版本号，
+# 其他进程写过（版本号不同）就丢弃缓存重新加载，多进程部署时不会长时间读到旧的身份或待处理动作。
+_MISSING = object()
+_cache_lock = threading.Lock()
+_user_cache = OrderedDict()  # user_id -> {"version", "checked_at", "expire_at", "identity_id", "pending_action", "history", "summary"}
+_cache_stats = {"hits": 0, "misses": 0}
+
+def _read_version(db, user_id):
+    """读取用户状态的版本号，从未写入过的用户为 0。"""
+    row = db.execute('SELECT version FROM user_versions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def _bump_version(db, user_id):
+    """在当前事务中把用户状态的版本号加一，返回新的版本号。"""
+    db.execute(
+        'INSERT INTO user_versions (user_id, version) VALUES (?, 1) '
+        'ON CONFLICT(user_id) DO UPDATE SET version = version + 1',
+        (user_id,)
+    )
+    return _read_version(db, user_id)
+
+def _cache_get(user_id, field):
+    """从缓存中读取用户的某个字段，未命中（或已被其他进程改写）返回 _MISSING。"""
+    now = time.time()
+    with _cache_lock:
+        state = _user_cache.get(user_id)
+        if state is not None and state['expire_at'] <= now:
+            del _user_cache[user_id]
+            state = None
+        hit = state is not None and field in state
+        need_check = hit and state['checked_at'] + config.USER_CACHE_CHECK_INTERVAL <= now
+    if need_check:
+        version = _read_version(get_db(), user_id)
+        with _cache_lock:
+            if state['version'] == version:
+                state['checked_at'] = now
+            else:
+                hit = False
+                if _user_cache.get(user_id) is state:
+                    del _user_cache[user_id]
+    with _cache_lock:
+        if not hit:
+            _cache_stats['misses'] += 1
+            return _MISSING
+        if _user_cache.get(user_id) is state:
+            _user_cache.move_to_end(user_id)
+        _cache_stats['hits'] += 1
+        return state[field]
+
+def _cache_state(user_id, version, written):
+    """
+    返回用户在 version 版本的缓存状态并刷新过期时间（需持有 _cache_lock）。
+    written 为 True 表示本进程刚写入并得到了 version：缓存原本是上一个版本时沿用其余字段，
+    否则说明中间有其他写入，丢弃旧状态。超出容量时淘汰最久未用的用户。
+    """
+    now = time.time()
+    state = _user_cache.get(user_id)
+    expected = version - 1 if written else version
+    if state is None or state['expire_at'] <= now or state['version'] != expected:
+        state = {}
+        _user_cache[user_id] = state
+    state['version'] = version
+    state['checked_at'] = now
+    state['expire_at'] = now + config.USER_CACHE_TTL
+    _user_cache.move_to_end(user_id)
+    while len(_user_cache) > config.USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return state
+
+def _cache_put(user_id, version, written=False, **fields):
+    """
+    写入用户在 version 版本的若干字段。从数据库加载时先读版本号再读数据，
+    保证缓存的数据不比记录的版本旧；写入后调用时传 written=True。
+    """
+    if config.USER_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        _cache_state(user_id, version, written).update(fields)
+
+def invalidate_user_cache(user_id):
+    """使指定用户的缓存失效，下次读取时重新从数据库加载。"""
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
+
+def get_user_cache_stats():
+    """返回用户状态缓存的命中数、未命中数、命中率和当前缓存用户数。"""
+    with _cache_lock:
+        hits, misses = _cache_stats['hits'], _cache_stats['misses']
+        size = len(_user_cache)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "size": size,
+    }
+
+def _connect():
+    """创建一个新的数据库连接，并设置 synchronous 和 busy_timeout。"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=config.DB_BUSY_TIMEOUT / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT)}')
+    conn.execute(f'PRAGMA synchronous = {config.DB_SYNCHRONOUS}')
+    return conn
+
+# 不在 Flask 应用上下文中时（异步入口的数据库线程、后台任务线程），每个线程复用一个连接
+_thread_local = threading.local()
+
 def get_db():
     """
     获取当前请求的数据库连接。
     如果连接不存在，则创建一个新的连接。
-    在Flask请求上下文中，连接会存储在g对象中并复用。
+    在Flask请求上下文中，连接会存储在g对象中并复用，请求结束时关闭；
+    不在应用上下文中时，连接按线程复用，随线程一起释放。
     """
-    if 'db' not in g:
-        # 如果不在请求上下文中，或者连接尚未创建
-        conn = sqlite3.connect(DATABASE_FILE)
-        conn.row_factory = sqlite3.Row
-        # 如果在请求上下文中，则存入g以供复用
-        if g:
-            g.db = conn
+    if not has_app_context():
+        conn = getattr(_thread_local, 'db', None)
+        if conn is None:
+            conn = _thread_local.db = _connect()
         return conn
+    if 'db' not in g:
+        g.db = _connect()
     return g.db
 
 # init_db 可以在应用启动时独立调用，保持不变
 def init_db():
     """初始化数据库并创建表（如果不存在）。"""
     conn = sqlite3.connect(DATABASE_FILE)
+    # WAL 模式：写入时不阻塞读取，该设置会持久保存在数据库文件中
+    conn.execute('PRAGMA journal_mode = WAL')
     cursor = conn.cursor()
-    # 原有的对话历史表
+    # 原有的对话历史表（整段JSON），仅用于迁移旧数据
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS conversations (
             user_id TEXT PRIMARY KEY,
             history TEXT NOT NULL
         )
     ''')
+    # 对话消息表，每条消息一行，按 (user_id, seq) 聚簇存储
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    # 对话滚动摘要表：upto_seq 及之前的消息已折叠进摘要
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            upto_seq INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     # 用户设置表，增加 pending_action 字段
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_settings (
@@ -44,6 +186,13 @@ def init_db():
             pending_action TEXT 
         )
     ''')
+    # 用户状态的版本号，每次写入身份、待处理动作、历史或摘要时加一，用于多进程间的缓存失效
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_versions (
+            user_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
     # 访问日志表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS access_log (
@@ -52,72 +201,327 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    # --- 访问统计汇总表（随访问日志增量维护，日期和小时均为本地时间） ---
+    # 每日独立访客集合
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_visitors (
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # 累计独立访客集合
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS visitors (
+            user_id TEXT PRIMARY KEY,
+            first_seen TEXT NOT NULL
+        )
+    ''')
+    # 每日独立访客数和访问次数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            visitors INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 每小时访问次数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_visits (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour)
+        ) WITHOUT ROWID
+    ''')
+    # 全局计数器（如累计访客数）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 每日访客的 HyperLogLog 草图，用于近似统计多日独立访客数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_sketches (
+            day TEXT PRIMARY KEY,
+            registers BLOB NOT NULL
+        )
+    ''')
+    # 用户反馈表：删除只做标记，按时间和用户查询都走索引
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_feedback_user ON feedback (user_id, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_feedback_created ON feedback (created_at)')
     conn.commit()
+    _backfill_rollups(conn)
+    _migrate_conversations(conn)
+    _import_feedback_file(conn)
     conn.close()
 
-def get_user_session(user_id):
-    """根据用户ID检索对话历史。"""
+def _migrate_conversations(conn):
+    """把旧 conversations 表中的整段JSON历史拆分写入 messages 表，迁移后删除旧记录。"""
+    rows = conn.execute('SELECT user_id, history FROM conversations').fetchall()
+    if not rows:
+        return
+    with conn:
+        for user_id, history_json in rows:
+            # 已经有新格式数据的用户只删除旧记录
+            exists = conn.execute('SELECT 1 FROM messages WHERE user_id = ? LIMIT 1', (user_id,)).fetchone()
+            if not exists:
+                history = json.loads(history_json)[-config.MAX_HISTORY_LEN:]
+                conn.executemany(
+                    'INSERT INTO messages (user_id, seq, role, content) VALUES (?, ?, ?, ?)',
+                    [(user_id, seq, m['role'], m['content']) for seq, m in enumerate(history, start=1)]
+                )
+            conn.execute('DELETE FROM conversations WHERE user_id = ?', (user_id,))
+    print(f"已将 {len(rows)} 个用户的对话历史迁移到 messages 表。")
+
+def _parse_feedback_file(lines):
+    """
+    解析旧反馈文件，每条为 “[时间] [用户] 内容”；不以该格式开头的行属于上一条的多行内容。
+    """
+    entries = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('[') and '] [' in line:
+            created_at, rest = line[1:].split('] [', 1)
+            if '] ' in rest:
+                user_id, content = rest.split('] ', 1)
+                entries.append([user_id, content, created_at])
+                continue
+        if entries:
+            entries[-1][1] += '\n' + line
+    return entries
+
+def _import_feedback_file(conn):
+    """把旧的 user_feedback.txt 一次性导入 feedback 表，导入后把文件重命名为 .imported。"""
+    try:
+        with open(config.FEEDBACK_FILE, 'r', encoding='utf-8') as f:
+            entries = _parse_feedback_file(f)
+    except FileNotFoundError:
+        return
+    with conn:
+        conn.executemany(
+            'INSERT INTO feedback (user_id, content, created_at) VALUES (?, ?, ?)', entries
+        )
+    os.replace(config.FEEDBACK_FILE, config.FEEDBACK_FILE + '.imported')
+    print(f"已将 {len(entries)} 条反馈导入 feedback 表。")
+
+def get_user_session(user_id, limit=None):
+    """
+    检索用户最近的 limit 条对话历史（默认 MAX_HISTORY_LEN 条），按时间顺序返回。
+    每条消息为 {"role", "content", "seq"}，发送给接口前需去掉 seq。
+    """
+    limit = min(limit or config.MAX_HISTORY_LEN, config.MAX_HISTORY_LEN)
+    cached = _cache_get(user_id, 'history')
+    if cached is not _MISSING:
+        return cached[-limit:]
+
     db = get_db()
+    version = _read_version(db, user_id)
     cursor = db.cursor()
-    cursor.execute('SELECT history FROM conversations WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    if 'db' not in g: # 如果不在请求上下文中，用完即关
-        db.close()
-    if row:
-        return json.loads(row[0])
-    return None
+    cursor.execute(
+        'SELECT seq, role, content FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?',
+        (user_id, config.MAX_HISTORY_LEN)
+    )
+    rows = cursor.fetchall()
+    history = [{"role": row[1], "content": row[2], "seq": row[0]} for row in reversed(rows)]
+    _cache_put(user_id, version, history=history)
+    return history[-limit:]
+
+def _last_seq(db, user_id):
+    """
+    用户已用过的最大 seq：现存消息和摘要 upto_seq 中的较大者。
+    清空历史后摘要行保留 upto_seq，新消息从这之后编号，seq 不会被重复使用。
+    """
+    row = db.execute(
+        'SELECT MAX(COALESCE((SELECT MAX(seq) FROM messages WHERE user_id = ?), 0), '
+        'COALESCE((SELECT upto_seq FROM summaries WHERE user_id = ?), 0))',
+        (user_id, user_id)
+    ).fetchone()
+    return row[0]
+
+def append_messages(user_id, messages):
+    """
+    在用户的对话历史末尾追加消息，每条消息只写入一行。
+    超出 MAX_HISTORY_LEN 的旧消息每隔 HISTORY_TRIM_INTERVAL 条批量删除一次。
+    """
+    db = get_db()
+    # 立即获取写锁，保证多个进程同时追加时 seq 不冲突
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        last_seq = _last_seq(db, user_id)
+        new_rows = [
+            {"role": m['role'], "content": m['content'], "seq": last_seq + i}
+            for i, m in enumerate(messages, start=1)
+        ]
+        db.executemany(
+            'INSERT INTO messages (user_id, seq, role, content) VALUES (?, ?, ?, ?)',
+            [(user_id, m['seq'], m['role'], m['content']) for m in new_rows]
+        )
+        new_last_seq = last_seq + len(new_rows)
+        # 惰性裁剪：跨过 HISTORY_TRIM_INTERVAL 的整数倍时才删除旧消息
+        if new_last_seq // config.HISTORY_TRIM_INTERVAL != last_seq // config.HISTORY_TRIM_INTERVAL:
+            db.execute(
+                'DELETE FROM messages WHERE user_id = ? AND seq <= ?',
+                (user_id, new_last_seq - config.MAX_HISTORY_LEN)
+            )
+        version = _bump_version(db, user_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    if config.USER_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        # 其他进程写过时 _cache_state 会丢弃旧状态，缓存中没有历史，下次重新加载
+        state = _cache_state(user_id, version, written=True)
+        if 'history' in state:
+            state['history'] = (state['history'] + new_rows)[-config.MAX_HISTORY_LEN:]
 
 def update_user_session(user_id, history):
-    """更新或创建用户的对话历史。"""
+    """用给定的消息列表整体替换用户的对话历史。"""
     db = get_db()
-    history_json = json.dumps(history, ensure_ascii=False)
-    db.execute('INSERT OR REPLACE INTO conversations (user_id, history) VALUES (?, ?)', (user_id, history_json))
-    db.commit()
-    if 'db' not in g:
-        db.close()
+    history = history[-config.MAX_HISTORY_LEN:]
+    new_rows = [{"role": m['role'], "content": m['content'], "seq": seq} for seq, m in enumerate(history, start=1)]
+    with db:
+        db.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+        db.executemany(
+            'INSERT INTO messages (user_id, seq, role, content) VALUES (?, ?, ?, ?)',
+            [(user_id, m['seq'], m['role'], m['content']) for m in new_rows]
+        )
+        version = _bump_version(db, user_id)
+    _cache_put(user_id, version, written=True, history=new_rows)
 
 def clear_user_history(user_id):
-    """清空指定用户的对话历史。"""
-    update_user_session(user_id, [])
+    """
+    清空指定用户的对话历史和摘要。
+    摘要行改为空摘要并把 upto_seq 设为已用过的最大 seq：之后的消息继续往后编号，
+    清空前开始的摘要任务用旧的 seq 保存时会被 save_user_summary 拒绝，不会恢复已清空的摘要。
+    """
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        last_seq = _last_seq(db, user_id)
+        db.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+        db.execute(
+            'INSERT OR REPLACE INTO summaries (user_id, summary, upto_seq, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+            (user_id, '', last_seq)
+        )
+        version = _bump_version(db, user_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _cache_put(user_id, version, written=True, history=[], summary=(None, last_seq))
+
+def get_user_summary(user_id):
+    """获取用户的对话摘要，返回 (摘要文本或None, 已折叠到的seq)。"""
+    cached = _cache_get(user_id, 'summary')
+    if cached is not _MISSING:
+        return cached
+    db = get_db()
+    version = _read_version(db, user_id)
+    row = db.execute('SELECT summary, upto_seq FROM summaries WHERE user_id = ?', (user_id,)).fetchone()
+    # 清空历史后摘要为空字符串
+    summary = (row[0] or None, row[1]) if row else (None, 0)
+    _cache_put(user_id, version, summary=summary)
+    return summary
+
+def save_user_summary(user_id, summary, upto_seq):
+    """
+    保存用户的对话摘要。只在 upto_seq 比已保存的更新时写入，
+    摘要生成期间历史被清空或已有更新的摘要时返回 False。
+    """
+    db = get_db()
+    cursor = db.execute(
+        'INSERT INTO summaries (user_id, summary, upto_seq, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP) '
+        'ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, upto_seq = excluded.upto_seq, '
+        'updated_at = excluded.updated_at WHERE excluded.upto_seq > summaries.upto_seq',
+        (user_id, summary, upto_seq)
+    )
+    if cursor.rowcount == 0:
+        db.commit()
+        return False
+    version = _bump_version(db, user_id)
+    db.commit()
+    _cache_put(user_id, version, written=True, summary=(summary, upto_seq))
+    return True
+
+def get_users_needing_summary(min_unsummarized, limit=100):
+    """
+    找出未折叠进摘要的消息数不少于 min_unsummarized 的用户。
+    返回 [(user_id, 最新seq, 已折叠到的seq)]。
+    """
+    db = get_db()
+    rows = db.execute('''
+        SELECT m.user_id, MAX(m.seq), COALESCE(s.upto_seq, 0)
+        FROM messages m LEFT JOIN summaries s ON s.user_id = m.user_id
+        GROUP BY m.user_id
+        HAVING MAX(m.seq) - COALESCE(s.upto_seq, 0) >= ?
+        LIMIT ?
+    ''', (min_unsummarized, limit)).fetchall()
+    return [tuple(row) for row in rows]
+
+def get_messages_between(user_id, after_seq, upto_seq):
+    """获取 seq 在 (after_seq, upto_seq] 之间的消息，按顺序返回。"""
+    db = get_db()
+    rows = db.execute(
+        'SELECT seq, role, content FROM messages WHERE user_id = ? AND seq > ? AND seq <= ? ORDER BY seq',
+        (user_id, after_seq, upto_seq)
+    ).fetchall()
+    return [{"role": row[1], "content": row[2], "seq": row[0]} for row in rows]
 
 def set_user_identity(user_id, identity_id):
     """设置或更新用户的AI身份。"""
     db = get_db()
-    db.execute('INSERT OR REPLACE INTO user_settings (user_id, identity_id, pending_action) SELECT ?, ?, pending_action FROM user_settings WHERE user_id = ? ON CONFLICT(user_id) DO UPDATE SET identity_id = excluded.identity_id', (user_id, identity_id, user_id))
-    db.execute('INSERT OR IGNORE INTO user_settings (user_id, identity_id) VALUES (?, ?)', (user_id, identity_id))
+    # 单条 upsert，保留 pending_action，不会与其他写入交错
+    db.execute(
+        'INSERT INTO user_settings (user_id, identity_id) VALUES (?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET identity_id = excluded.identity_id',
+        (user_id, identity_id)
+    )
+    version = _bump_version(db, user_id)
     db.commit()
-    if 'db' not in g:
-        db.close()
+    _cache_put(user_id, version, written=True, identity_id=identity_id)
 
-def get_user_identity(user_id):
-    """获取用户的AI身份，如果不存在则创建默认值。"""
+def _load_user_settings(user_id):
+    """一次查询加载用户的全部设置并放入缓存，用户不存在时创建默认记录。"""
     db = get_db()
+    version = _read_version(db, user_id)
     cursor = db.cursor()
-    cursor.execute('SELECT identity_id FROM user_settings WHERE user_id = ?', (user_id,))
+    cursor.execute('SELECT identity_id, pending_action FROM user_settings WHERE user_id = ?', (user_id,))
     row = cursor.fetchone()
     if row:
-        identity_id = row[0]
-        if 'db' not in g:
-            db.close()
-        return identity_id
+        settings = {'identity_id': row[0], 'pending_action': row[1]}
     else:
         db.execute('INSERT OR IGNORE INTO user_settings (user_id, identity_id) VALUES (?, 0)', (user_id,))
         db.commit()
-        if 'db' not in g:
-            db.close()
-        return 0
+        settings = {'identity_id': 0, 'pending_action': None}
+    _cache_put(user_id, version, **settings)
+    return settings
+
+def get_user_identity(user_id):
+    """获取用户的AI身份，如果不存在则创建默认值。"""
+    identity_id = _cache_get(user_id, 'identity_id')
+    if identity_id is _MISSING:
+        identity_id = _load_user_settings(user_id)['identity_id']
+    return identity_id
 
 def get_user_setting(user_id, key):
     """获取用户的特定设置项。"""
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    result = None
-    if row and key in row.keys():
-        result = row[key]
-    if 'db' not in g:
-        db.close()
+    result = _cache_get(user_id, key)
+    if result is _MISSING:
+        result = _load_user_settings(user_id).get(key)
     return result
 
 def update_user_setting(user_id, key, value):
@@ -132,33 +536,301 @@ def update_user_setting(user_id, key, value):
     db.execute('INSERT OR IGNORE INTO user_settings (user_id, identity_id) VALUES (?, 0)', (user_id,))
     # 更新特定字段（key已通过白名单验证）
     db.execute(f'UPDATE user_settings SET {key} = ? WHERE user_id = ?', (value, user_id))
+    version = _bump_version(db, user_id)
     db.commit()
-    if 'db' not in g:
-        db.close()
+    _cache_put(user_id, version, written=True, **{key: value})
+
+# --- 访问日志后台批量写入 ---
+# log_access 只把事件放入内存队列，由单独的写线程按批次（数量或时间间隔）提交，
+# 避免每条消息都在请求路径上做一次 commit（fsync）。
+_access_queue = queue.Queue(maxsize=config.ACCESS_LOG_QUEUE_SIZE)
+_access_writer = None
+_STOP = object()
+
+def _flush_access_events(conn, events):
+    """
+    在一个事务中写入一批访问事件，并增量更新访问统计汇总表。
+    每个事件为 (user_id, UTC时间戳, 本地日期, 本地小时)。
+    """
+    with conn:
+        conn.executemany('INSERT INTO access_log (user_id, timestamp) VALUES (?, ?)', [e[:2] for e in events])
+        _update_rollups(conn, events)
+
+def _update_rollups(conn, events):
+    new_daily = Counter()
+    new_total = 0
+    for user_id, _, day, _ in events:
+        if conn.execute('INSERT OR IGNORE INTO daily_visitors (day, user_id) VALUES (?, ?)', (day, user_id)).rowcount:
+            new_daily[day] += 1
+        if conn.execute('INSERT OR IGNORE INTO visitors (user_id, first_seen) VALUES (?, ?)', (user_id, day)).rowcount:
+            new_total += 1
+
+    visits = Counter(e[2] for e in events)
+    conn.executemany(
+        'INSERT INTO daily_stats (day, visitors, visits) VALUES (?, ?, ?) '
+        'ON CONFLICT(day) DO UPDATE SET visitors = visitors + excluded.visitors, visits = visits + excluded.visits',
+        [(day, new_daily[day], count) for day, count in visits.items()]
+    )
+    hourly = Counter((e[2], e[3]) for e in events)
+    conn.executemany(
+        'INSERT INTO hourly_visits (day, hour, visits) VALUES (?, ?, ?) '
+        'ON CONFLICT(day, hour) DO UPDATE SET visits = visits + excluded.visits',
+        [(day, hour, count) for (day, hour), count in hourly.items()]
+    )
+    if new_total:
+        conn.execute(
+            "INSERT INTO rollup_counters (name, value) VALUES ('total_visitors', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (new_total,)
+        )
+
+    if config.ACCESS_HLL_ENABLED:
+        sketches = {}
+        for user_id, _, day, _ in events:
+            sketches.setdefault(day, HyperLogLog(config.ACCESS_HLL_PRECISION)).add(user_id)
+        _merge_sketches(conn, sketches)
+
+def _merge_sketches(conn, sketches):
+    """把新的草图与库中已有的草图合并后写回（合并是幂等的，多进程写入也不会丢数据）。"""
+    for day, sketch in sketches.items():
+        row = conn.execute('SELECT registers FROM daily_sketches WHERE day = ?', (day,)).fetchone()
+        if row:
+            sketch.merge(HyperLogLog.from_bytes(row[0]))
+        conn.execute('INSERT OR REPLACE INTO daily_sketches (day, registers) VALUES (?, ?)', (day, sketch.to_bytes()))
+
+def _backfill_rollups(conn):
+    """汇总表为空而访问日志有数据时（首次升级），扫描一次访问日志重建汇总表。"""
+    if conn.execute('SELECT 1 FROM daily_stats LIMIT 1').fetchone():
+        return
+    if not conn.execute('SELECT 1 FROM access_log LIMIT 1').fetchone():
+        return
+    with conn:
+        conn.execute('''
+            INSERT OR IGNORE INTO daily_visitors (day, user_id)
+            SELECT DISTINCT DATE(timestamp, 'localtime'), user_id FROM access_log
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO visitors (user_id, first_seen)
+            SELECT user_id, MIN(DATE(timestamp, 'localtime')) FROM access_log GROUP BY user_id
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO daily_stats (day, visitors, visits)
+            SELECT DATE(timestamp, 'localtime'), COUNT(DISTINCT user_id), COUNT(*) FROM access_log
+            GROUP BY DATE(timestamp, 'localtime')
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO hourly_visits (day, hour, visits)
+            SELECT DATE(timestamp, 'localtime'), CAST(strftime('%H', timestamp, 'localtime') AS INTEGER), COUNT(*)
+            FROM access_log GROUP BY 1, 2
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO rollup_counters (name, value)
+            SELECT 'total_visitors', COUNT(*) FROM visitors
+        ''')
+        if config.ACCESS_HLL_ENABLED:
+            sketches = {}
+            for day, user_id in conn.execute('SELECT day, user_id FROM daily_visitors'):
+                sketches.setdefault(day, HyperLogLog(config.ACCESS_HLL_PRECISION)).add(user_id)
+            _merge_sketches(conn, sketches)
+    print("已根据访问日志重建访问统计汇总表。")
+
+def _access_writer_loop():
+    conn = _connect()
+    stopping = False
+    while not stopping:
+        item = _access_queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + config.ACCESS_LOG_FLUSH_INTERVAL
+        while len(batch) < config.ACCESS_LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _access_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            _flush_access_events(conn, batch)
+        except sqlite3.Error as e:
+            print(f"写入访问日志失败（{len(batch)}条）: {e}")
+    conn.close()
+
+def start_access_writer():
+    """启动访问日志写线程，进程退出时自动排空队列。"""
+    global _access_writer
+    if _access_writer is not None and _access_writer.is_alive():
+        return
+    _access_writer = threading.Thread(target=_access_writer_loop, name='access-log-writer', daemon=True)
+    _access_writer.start()
+    atexit.register(stop_access_writer)
+
+def stop_access_writer(timeout=10):
+    """停止写线程：队列中已有的事件全部写入后再退出。"""
+    global _access_writer
+    writer = _access_writer
+    if writer is None:
+        return
+    _access_writer = None  # 之后的 log_access 改为同步写入
+    _access_queue.put(_STOP)
+    writer.join(timeout)
+
+def _access_event(user_id):
+    """构造访问事件：访问日志与 CURRENT_TIMESTAMP 一致使用 UTC 时间，汇总表使用本地日期和小时。"""
+    now = datetime.now(timezone.utc)
+    local_now = now.astimezone()
+    return (user_id, now.strftime('%Y-%m-%d %H:%M:%S'), local_now.strftime('%Y-%m-%d'), local_now.hour)
+
+def try_log_access(user_id):
+    """
+    只尝试把访问事件放入写线程的队列，不访问数据库，不会阻塞（供事件循环调用）。
+    写线程未启动或队列已满时返回 False，由调用方改用 log_access 同步写入。
+    """
+    if _access_writer is None:
+        return False
+    try:
+        _access_queue.put_nowait(_access_event(user_id))
+        return True
+    except queue.Full:
+        return False
 
 def log_access(user_id):
-    """记录用户访问。"""
+    """记录用户访问。写线程未启动或队列已满时同步写入。"""
+    if try_log_access(user_id):
+        return
     db = get_db()
-    db.execute('INSERT INTO access_log (user_id, timestamp) VALUES (?, CURRENT_TIMESTAMP)', (user_id,))
-    db.commit()
-    if 'db' not in g:
-        db.close()
+    _flush_access_events(db, [_access_event(user_id)])
 
 def get_access_stats():
-    """获取访问统计数据（总用户数和今日用户数）。"""
+    """获取访问统计数据（总用户数和今日用户数），直接读取汇总表。"""
     db = get_db()
     cursor = db.cursor()
     
     # 累计独立访问用户数
-    cursor.execute("SELECT COUNT(DISTINCT user_id) FROM access_log")
-    total_users = cursor.fetchone()[0]
+    cursor.execute("SELECT value FROM rollup_counters WHERE name = 'total_visitors'")
+    row = cursor.fetchone()
+    total_users = row[0] if row else 0
     
     # 今日独立访问用户数
     today_str = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("SELECT COUNT(DISTINCT user_id) FROM access_log WHERE DATE(timestamp) = ?", (today_str,))
-    today_users = cursor.fetchone()[0]
-    
-    if 'db' not in g:
-        db.close()
+    cursor.execute("SELECT visitors FROM daily_stats WHERE day = ?", (today_str,))
+    row = cursor.fetchone()
+    today_users = row[0] if row else 0
     
-    return total_users, today_users
\ No newline at end of file
+    return total_users, today_users
+
+def get_daily_access_stats(days):
+    """
+    获取最近 days 天（含今天）每天的独立访客数和访问次数，
+    以及这段时间内的独立访客总数。返回 (每日列表, 独立访客数, 是否为近似值)。
+    开启 ACCESS_HLL_ENABLED 时独立访客总数由每日草图合并估算。
+    """
+    today = datetime.now().date()
+    day_list = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days - 1, -1, -1)]
+    db = get_db()
+    rows = db.execute(
+        'SELECT day, visitors, visits FROM daily_stats WHERE day BETWEEN ? AND ?',
+        (day_list[0], day_list[-1])
+    ).fetchall()
+    by_day = {row[0]: (row[1], row[2]) for row in rows}
+    daily = [(day, *by_day.get(day, (0, 0))) for day in day_list]
+
+    if config.ACCESS_HLL_ENABLED:
+        merged = HyperLogLog(config.ACCESS_HLL_PRECISION)
+        for (registers,) in db.execute(
+            'SELECT registers FROM daily_sketches WHERE day BETWEEN ? AND ?', (day_list[0], day_list[-1])
+        ):
+            merged.merge(HyperLogLog.from_bytes(registers))
+        unique, approximate = merged.count(), True
+    else:
+        # 只扫描这几天的访客集合，不会随访问日志增长而变慢
+        unique = db.execute(
+            'SELECT COUNT(DISTINCT user_id) FROM daily_visitors WHERE day BETWEEN ? AND ?',
+            (day_list[0], day_list[-1])
+        ).fetchone()[0]
+        approximate = False
+    return daily, unique, approximate
+
+def get_hourly_access_stats(day=None):
+    """获取某一天（默认今天）每小时的访问次数，返回长度为24的列表。"""
+    day = day or datetime.now().strftime('%Y-%m-%d')
+    db = get_db()
+    rows = db.execute('SELECT hour, visits FROM hourly_visits WHERE day = ?', (day,)).fetchall()
+    hourly = [0] * 24
+    for hour, visits in rows:
+        hourly[hour] = visits
+    return hourly
+
+# --- 用户反馈 ---
+# 反馈写入 feedback 表（旧的 user_feedback.txt 在 init_db 时一次性导入），
+# 按时间倒序分页查询，删除只做标记。
+
+def add_feedback(user_id, content):
+    """记录一条用户反馈。单条 INSERT 是原子的，多个进程同时写入也不会交错。"""
+    db = get_db()
+    db.execute(
+        'INSERT INTO feedback (user_id, content, created_at) VALUES (?, ?, ?)',
+        (user_id, content, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    db.commit()
+
+def get_feedback(page=1, user_id=None, since=None, page_size=None):
+    """
+    分页查询未删除的反馈（最新的在前），可按用户和起始日期（YYYY-MM-DD）筛选。
+    返回 (本页反馈列表, 符合条件的总条数)，每条为 {"id", "user_id", "content", "created_at"}。
+    """
+    page_size = page_size or config.FEEDBACK_PAGE_SIZE
+    conditions, params = ['deleted = 0'], []
+    if user_id:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if since:
+        conditions.append('created_at >= ?')
+        params.append(since)
+    where = ' AND '.join(conditions)
+
+    db = get_db()
+    total = db.execute(f'SELECT COUNT(*) FROM feedback WHERE {where}', params).fetchone()[0]
+    rows = db.execute(
+        f'SELECT id, user_id, content, created_at FROM feedback WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?',
+        params + [page_size, (max(page, 1) - 1) * page_size]
+    ).fetchall()
+    return [dict(row) for row in rows], total
+
+def delete_feedback(feedback_id=None, count=5):
+    """
+    软删除反馈：指定 feedback_id 时删除该条，否则删除最近的 count 条。返回删除的条数。
+    """
+    db = get_db()
+    if feedback_id is not None:
+        cursor = db.execute('UPDATE feedback SET deleted = 1 WHERE id = ? AND deleted = 0', (feedback_id,))
+    else:
+        cursor = db.execute(
+            'UPDATE feedback SET deleted = 1 WHERE id IN '
+            '(SELECT id FROM feedback WHERE deleted = 0 ORDER BY id DESC LIMIT ?)',
+            (count,)
+        )
+    db.commit()
+    return cursor.rowcount
+
+# --- 调用耗时指标和追踪 ---
+# 在模块末尾统一替换为计时（并记录 span）的版本，模块内部按名字调用的地方（如写线程的 _flush_access_events）也会被计时
+DB_CALL_SECONDS = metrics.histogram('chat_db_call_seconds', '数据库函数的调用耗时（秒）', ('function',))
+TIMED_FUNCTIONS = (
+    'get_user_session', 'append_messages', 'update_user_session', 'clear_user_history',
+    'get_user_summary', 'save_user_summary', 'get_users_needing_summary', 'get_messages_between',
+    'set_user_identity', 'get_user_identity', 'get_user_setting', 'update_user_setting',
+    'add_feedback', 'get_feedback', 'delete_feedback',
+    'log_access', 'get_access_stats', 'get_daily_access_stats', 'get_hourly_access_stats',
+    '_flush_access_events',
+)
+for _name in TIMED_FUNCTIONS:
+    globals()[_name] = tracing.traced('db.' + _name)(
+        metrics.timed_function(DB_CALL_SECONDS, _name)(globals()[_name])
+    )
+del _name
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+import config
+
+# 微信在5秒内收不到回复会用相同的 MsgId 重试3次。
+# 这里按消息键记录正在处理和已完成的请求：
+# 处理中的重试等待第一次的结果，处理完的重试直接拿到缓存的回复XML。
+
+class _Entry:
+    __slots__ = ('done', 'reply', 'expire_at', 'waiters')
+
+    def __init__(self, expire_at):
+        self.done = threading.Event()
+        self.reply = None
+        self.expire_at = expire_at
+        self.waiters = []  # 等待结果的协程：[(事件循环, Future)]，由 finish() 唤醒
+
+    def wait(self, timeout):
+        """等待第一次处理的结果，超时返回 None。"""
+        if self.done.wait(timeout):
+            return self.reply
+        return None
+
+    async def wait_async(self, timeout):
+        """等待第一次处理的结果（异步入口使用），等待时只挂起协程，超时返回 None。"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        with _lock:
+            if self.done.is_set():
+                return self.reply
+            self.waiters.append((loop, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.reply
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_stats = {"new": 0, "waited": 0, "cached": 0}
+
+
+def make_key(msg_id, from_user_name, create_time):
+    """
+    普通消息使用 MsgId 去重；事件消息没有 MsgId，改用 FromUserName + CreateTime。
+    """
+    if msg_id:
+        return f"msg:{msg_id}"
+    return f"evt:{from_user_name}:{create_time}"
+
+
+def _evict(now):
+    """清理过期条目，并在超出容量时淘汰最旧的条目。"""
+    while _entries:
+        key, entry = next(iter(_entries.items()))
+        if entry.expire_at > now and len(_entries) <= config.DEDUP_MAX_ENTRIES:
+            break
+        del _entries[key]
+
+
+def begin(key):
+    """
+    登记一条消息。返回 (entry, is_new)：
+    is_new 为 True 时调用方负责处理并调用 finish()，否则说明这是一次重试。
+    """
+    now = time.time()
+    with _lock:
+        _evict(now)
+        entry = _entries.get(key)
+        if entry is not None:
+            if entry.done.is_set():
+                _stats["cached"] += 1
+            else:
+                _stats["waited"] += 1
+            return entry, False
+
+        # 处理中的条目同样设置过期时间，防止处理线程异常退出后永远占位
+        entry = _Entry(now + config.DEDUP_TTL)
+        _entries[key] = entry
+        _stats["new"] += 1
+        return entry, True
+
+
+def finish(entry, reply):
+    """记录处理结果，并唤醒等待中的重试请求（线程和协程）。"""
+    entry.reply = reply
+    entry.expire_at = time.time() + config.DEDUP_TTL
+    with _lock:
+        entry.done.set()
+        waiters, entry.waiters = entry.waiters, []
+    for loop, waiter in waiters:
+        try:
+            loop.call_soon_threadsafe(_wake, waiter)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+
+def get_stats():
+    """返回去重统计：新消息数、等待中命中数、缓存命中数以及当前条目数。"""
+    with _lock:
+        return dict(_stats, size=len(_entries))
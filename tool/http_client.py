@@ -0,0 +1,213 @@
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import config
+import tool.metrics as metrics
+import tool.tracing as tracing
+
+# 所有对外 HTTP 请求（Cloudflare、微信、天气网）共用的客户端：
+# 每个主机一个长连接池，连接超时与读取超时分开，幂等请求失败时带抖动退避重试。
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_stats_lock = threading.Lock()
+_host_stats = {}  # host -> {"requests": n, "handshakes": n, "retries": n}
+_dns_stats = {"hits": 0, "misses": 0}
+
+
+def _incr(host, key):
+    with _stats_lock:
+        stats = _host_stats.setdefault(host, {"requests": 0, "handshakes": 0, "retries": 0})
+        stats[key] += 1
+
+
+# --- 连接计数：每次真正建立 TCP/TLS 连接时计数一次 ---
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _incr(self.host, "handshakes")
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _incr(self.host, "handshakes")
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+# --- DNS 缓存：install_dns_cache() 后替换 socket.getaddrinfo，按 TTL 缓存解析结果 ---
+# 替换对整个进程生效，所以不在导入时安装，由启动钩子显式调用；最多缓存 HTTP_DNS_CACHE_SIZE 条，按 LRU 淘汰
+_dns_lock = threading.Lock()
+_dns_cache = OrderedDict()  # (host, port, ...) -> (过期时间, 解析结果)
+_original_getaddrinfo = None  # 安装后保存原来的 socket.getaddrinfo
+
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    original = _original_getaddrinfo
+    if original is None:  # 已卸载
+        return socket.getaddrinfo(host, port, family, type, proto, flags)
+    key = (host, port, family, type, proto, flags)
+    now = time.time()
+    with _dns_lock:
+        cached = _dns_cache.get(key)
+        if cached and cached[0] > now:
+            _dns_cache.move_to_end(key)
+            _dns_stats["hits"] += 1
+            return cached[1]
+        _dns_stats["misses"] += 1
+    result = original(host, port, family, type, proto, flags)
+    with _dns_lock:
+        _dns_cache[key] = (now + config.HTTP_DNS_CACHE_TTL, result)
+        _dns_cache.move_to_end(key)
+        while len(_dns_cache) > config.HTTP_DNS_CACHE_SIZE:
+            _dns_cache.popitem(last=False)
+    return result
+
+
+def install_dns_cache():
+    """把 socket.getaddrinfo 替换为带缓存的版本（对整个进程生效），重复调用不做任何事。"""
+    global _original_getaddrinfo
+    if config.HTTP_DNS_CACHE_TTL <= 0 or config.HTTP_DNS_CACHE_SIZE <= 0 or _original_getaddrinfo is not None:
+        return
+    _original_getaddrinfo = socket.getaddrinfo
+    socket.getaddrinfo = _cached_getaddrinfo
+
+
+def uninstall_dns_cache():
+    """恢复原来的 socket.getaddrinfo 并清空缓存。"""
+    global _original_getaddrinfo
+    if _original_getaddrinfo is None:
+        return
+    socket.getaddrinfo = _original_getaddrinfo
+    _original_getaddrinfo = None
+    with _dns_lock:
+        _dns_cache.clear()
+
+
+def _make_session():
+    session = requests.Session()
+    adapter = _PooledAdapter(
+        pool_connections=config.HTTP_POOL_HOSTS,
+        pool_maxsize=config.HTTP_POOL_SIZE,
+        max_retries=0,  # 重试由 request() 自己处理
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _make_session()
+
+
+# 上游错误次数，按主机和错误类型（异常类名或 HTTP 状态码）统计，异步客户端也记录在这里
+UPSTREAM_ERRORS = metrics.counter('chat_upstream_errors_total', '上游请求错误次数', ('host', 'error'))
+
+
+def _backoff(attempt):
+    """全抖动指数退避：在 [0, base * 2^attempt] 之间随机等待。"""
+    ceiling = min(config.HTTP_BACKOFF_MAX, config.HTTP_BACKOFF_BASE * (2 ** attempt))
+    time.sleep(random.uniform(0, ceiling))
+
+
+def request(method, url, timeout=10, idempotent=None, **kwargs):
+    """
+    发送 HTTP 请求并返回 requests.Response，失败时抛出 requests 的异常。
+    timeout 为读取超时，连接超时统一使用 config.HTTP_CONNECT_TIMEOUT。
+    幂等请求在连接失败、超时或 429/5xx 时重试；
+    非幂等请求（如 POST）只在连接尚未建立时重试。
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    host = urlsplit(url).hostname or ""
+    timeout = (config.HTTP_CONNECT_TIMEOUT, timeout)
+
+    with tracing.span('http', method=method, host=host) as span:
+        return _request_with_retries(method, url, host, timeout, idempotent, span, **kwargs)
+
+
+def _request_with_retries(method, url, host, timeout, idempotent, span, **kwargs):
+    attempt = 0
+    while True:
+        _incr(host, "requests")
+        try:
+            response = _session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout as e:
+            UPSTREAM_ERRORS.inc(host, type(e).__name__)
+            if attempt >= config.HTTP_MAX_RETRIES:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            UPSTREAM_ERRORS.inc(host, type(e).__name__)
+            if not idempotent or attempt >= config.HTTP_MAX_RETRIES:
+                raise
+        else:
+            if response.status_code >= 400:
+                UPSTREAM_ERRORS.inc(host, f"HTTP {response.status_code}")
+            if not (idempotent and response.status_code in RETRY_STATUS and attempt < config.HTTP_MAX_RETRIES):
+                span.set(status=response.status_code, attempts=attempt + 1)
+                return response
+            response.close()
+
+        _incr(host, "retries")
+        _backoff(attempt)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def warm_up(urls):
+    """
+    启动时预先与各上游建立连接（已安装DNS缓存时同时缓存解析结果），失败只打印不抛出。
+    """
+    def _warm(url):
+        try:
+            request('HEAD', url, timeout=5, allow_redirects=False).close()
+        except requests.exceptions.RequestException as e:
+            print(f"预热连接 {url} 失败: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        list(executor.map(_warm, urls))
+
+
+def get_stats():
+    """
+    返回每个主机的请求数、握手数、连接池命中数和重试数，以及DNS缓存命中情况。
+    """
+    with _stats_lock:
+        hosts = {}
+        for host, stats in _host_stats.items():
+            hosts[host] = dict(stats, pool_hits=max(stats["requests"] - stats["handshakes"], 0))
+    with _dns_lock:
+        dns = dict(_dns_stats)
+    return {"hosts": hosts, "dns": dns}
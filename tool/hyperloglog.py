@@ -0,0 +1,50 @@
+import hashlib
+import math
+
+# HyperLogLog 基数估计：用固定大小的寄存器数组近似统计不重复元素个数。
+# 精度 p=12 时占用 4096 字节，标准误差约 1.6%；多个草图可以无损合并。
+
+class HyperLogLog:
+    def __init__(self, p=12, registers=None):
+        if not 4 <= p <= 16:
+            raise ValueError(f"Invalid HyperLogLog precision: {p}")
+        self.p = p
+        self.m = 1 << p
+        if registers is None:
+            self.registers = bytearray(self.m)
+        else:
+            if len(registers) != self.m:
+                raise ValueError("HyperLogLog registers size mismatch")
+            self.registers = bytearray(registers)
+
+    def add(self, value):
+        """加入一个元素（字符串）。"""
+        h = int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """把另一个同精度的草图合并进来（逐个寄存器取最大值）。"""
+        if other.p != self.p:
+            raise ValueError("Cannot merge HyperLogLog sketches with different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        """返回不重复元素个数的估计值。"""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # 小基数时使用线性计数修正
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(p=int(math.log2(len(data))), registers=data)
@@ -0,0 +1,119 @@
+import threading
+import time
+import config
+import tool.capture as capture
+import tool.chatAI as chatAI
+import tool.database as database
+import tool.http_client as http_client
+import tool.metrics as metrics
+import tool.weather as weather
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能单进程运行，总是自己更新摘要
+    fcntl = None
+
+# 服务的启动和关闭流程，Flask 入口（main.py）和异步入口（server_async.py）共用
+
+# 多进程部署时只有抢到这个锁的进程更新对话摘要，与天气抓取的选举方式相同
+SUMMARY_LOCK_FILE = database.DATABASE_FILE + '.summary.lock'
+_summarizer_lock_file = None
+
+
+def schedule_weather_updates():
+    """
+    定时任务函数，启动后立即刷新一次，之后每小时更新一次天气缓存；
+    刷新失败时按指数退避重试。
+    多进程部署时只有抢到抓取锁的进程会抓取，其他进程重新加载共享快照。
+    """
+    retry_delay = config.WEATHER_RETRY_BASE
+    while True:
+        try:
+            ok = weather.refresh_shared_cache()
+        except Exception as e:
+            print(f"更新天气缓存失败: {e}")
+            ok = False
+        if ok:
+            retry_delay = config.WEATHER_RETRY_BASE
+            time.sleep(config.WEATHER_REFRESH_INTERVAL)
+        else:
+            print(f"天气数据刷新失败，{retry_delay:.0f} 秒后重试。")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, config.WEATHER_REFRESH_INTERVAL)
+
+
+def _try_become_summarizer():
+    """
+    尝试成为负责更新摘要的进程：对锁文件加非阻塞的排他锁，抢到后一直持有到进程退出。
+    负责的进程退出后锁自动释放，其他进程在下一轮接替。
+    """
+    global _summarizer_lock_file
+    if _summarizer_lock_file is not None or fcntl is None:
+        return True
+    lock_file = open(SUMMARY_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _summarizer_lock_file = lock_file
+    return True
+
+
+def schedule_summary_updates():
+    """
+    定时任务函数，定期把较早的对话折叠成滚动摘要。
+    多进程部署时只有抢到摘要锁的进程执行，避免对同一用户重复调用模型。
+    """
+    while True:
+        time.sleep(config.SUMMARY_INTERVAL)
+        if not _try_become_summarizer():
+            continue
+        try:
+            updated = chatAI.refresh_summaries()
+            if updated:
+                print(f"已更新 {updated} 个用户的对话摘要。")
+        except Exception as e:
+            print(f"更新对话摘要失败: {e}")
+
+
+def startup():
+    """
+    启动钩子：初始化数据库、访问日志和流量采集的写线程，启动指标服务，安装DNS缓存，加载上次保存的天气快照，
+    并在后台预热上游连接、刷新天气和执行定时任务。不等待任何网络请求。
+    """
+    database.init_db()
+    database.start_access_writer()
+
+    if config.CAPTURE_ENABLED:
+        capture.start_writer()
+
+    # 指标服务（多进程部署时只有第一个绑定端口成功的进程对外暴露）
+    if config.METRICS_PORT:
+        metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+
+    # 先用上次保存的快照提供服务（标记为过期），刷新成功后替换
+    if not weather.load_snapshot():
+        print("没有可用的天气快照，等待后台刷新。")
+
+    # 安装DNS缓存（替换 socket.getaddrinfo，对整个进程生效）并预热上游连接
+    http_client.install_dns_cache()
+    threading.Thread(target=http_client.warm_up, args=([
+        config.CF_API_BASE,
+        config.WECHAT_API_BASE,
+        weather.URLS[0],
+    ],), name='warm-up', daemon=True).start()
+
+    # 启动后台线程刷新天气（立即刷新一次，之后定时更新）
+    threading.Thread(target=schedule_weather_updates, name='weather-updater', daemon=True).start()
+
+    # 启动后台线程定时更新对话摘要
+    if config.SUMMARY_ENABLED:
+        threading.Thread(target=schedule_summary_updates, name='summary-updater', daemon=True).start()
+
+
+def shutdown():
+    """关闭钩子：把访问日志和流量采集队列中的记录写完，卸载DNS缓存。定时任务是守护线程，随进程退出。"""
+    database.stop_access_writer()
+    capture.stop_writer()
+    http_client.uninstall_dns_cache()
@@ -0,0 +1,112 @@
+import importlib
+import os
+import threading
+import time
+import config
+from tool.tokens import estimate_tokens
+import tool.reply_cache as reply_cache
+
+# 身份（persona）注册表：启动时把 prompt/ 下的身份文件全部读入内存，
+# 之后按修改时间检测变化，或由管理员 /reload 指令触发，整体替换为新的注册表。
+
+# prompt 文件夹在项目根目录，不在 tool 目录下
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROMPT_DIR = os.path.join(BASE_DIR, 'prompt')
+
+BASE_PROMPT = "你是一个名为驱不散的雾的AI助手。你的任务是友好、简洁地回答用户的问题。请始终使用简体中文回复。回复应像真人聊天，通常不超过30字，除非用户要求详细解释。"
+
+_reload_lock = threading.Lock()
+_registry = None
+_last_check = 0
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _build_registry():
+    """读取所有身份文件，生成新的注册表。"""
+    prompts = {"0": BASE_PROMPT}
+    mtimes = {}
+    for persona_id, persona in config.PERSONAS.items():
+        filename = persona.get("file")
+        if not filename:
+            prompts[persona_id] = BASE_PROMPT
+            continue
+        filepath = os.path.join(PROMPT_DIR, filename)
+        mtimes[filepath] = _file_mtime(filepath)
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                prompts[persona_id] = f.read().strip()
+        except FileNotFoundError:
+            print(f"身份文件不存在: {filepath}")
+            prompts[persona_id] = BASE_PROMPT
+
+    list_text = "可选身份列表：\n"
+    for persona_id, persona in config.PERSONAS.items():
+        list_text += f"{persona_id}. {persona['name']}\n"
+    list_text += "使用 /身份 [数字] 切换，/身份 0 恢复默认。"
+
+    return {"prompts": prompts, "mtimes": mtimes, "list_text": list_text}
+
+
+def reload(reload_config=False):
+    """
+    重新加载所有身份文件；reload_config 为 True 时同时重新加载 config.py
+    （PERSONAS、ADMIN_USER_ID 等）。返回各身份的提示词大小。
+    """
+    global _registry, _last_check
+    with _reload_lock:
+        if reload_config:
+            importlib.reload(config)
+        _registry = _build_registry()
+        _last_check = time.time()
+        # 提示词变了，之前缓存的回复不再适用
+        reply_cache.clear()
+    return get_prompt_stats()
+
+
+def _get_registry():
+    """返回当前注册表，每隔 PERSONA_CHECK_INTERVAL 秒检查一次文件是否被修改。"""
+    global _last_check
+    registry = _registry
+    if registry is None:
+        reload()
+        return _registry
+
+    now = time.time()
+    if config.PERSONA_CHECK_INTERVAL > 0 and now - _last_check >= config.PERSONA_CHECK_INTERVAL:
+        _last_check = now
+        if any(_file_mtime(path) != mtime for path, mtime in registry["mtimes"].items()):
+            print("检测到身份文件变化，重新加载。")
+            reload()
+            registry = _registry
+    return registry
+
+
+def get_prompt(identity_id):
+    """根据身份ID获取对应的prompt内容，未知身份返回默认prompt。"""
+    return _get_registry()["prompts"].get(str(identity_id), BASE_PROMPT)
+
+
+def get_persona_list_text():
+    """返回预先生成的 /身份列表 回复文本。"""
+    return _get_registry()["list_text"]
+
+
+def get_max_tokens(identity_id):
+    """返回身份的 max_tokens（PERSONAS 中的 "max_tokens"），未配置时使用 DEFAULT_MAX_TOKENS。"""
+    persona = config.PERSONAS.get(str(identity_id)) or {}
+    return persona.get("max_tokens", config.DEFAULT_MAX_TOKENS)
+
+def get_prompt_stats():
+    """返回每个身份的提示词大小：[(身份ID, 名称, 字符数, 估计token数)]。"""
+    prompts = _get_registry()["prompts"]
+    stats = [("0", "默认", len(prompts["0"]), estimate_tokens(prompts["0"]))]
+    for persona_id, persona in config.PERSONAS.items():
+        prompt = prompts.get(persona_id, BASE_PROMPT)
+        stats.append((persona_id, persona['name'], len(prompt), estimate_tokens(prompt)))
+    return stats
@@ -0,0 +1,96 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+import config
+
+# 回复缓存：没有上下文的消息（问候语、清空历史后的第一句话等）对同一身份的回复可以复用。
+# 键为 (身份ID, 规范化后的消息)，按 LRU + TTL 淘汰，并限制总内存占用。
+
+_PUNCTUATION = re.compile(r"[\s!！?？。.,，~～…、]+")
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> (reply, expire_at, size, latency)
+_total_bytes = 0
+_stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+
+
+def normalize(message):
+    """规范化消息：去掉空白和标点，英文转小写。"""
+    return _PUNCTUATION.sub("", message).lower()
+
+
+def is_cacheable(identity_id, message, history_len):
+    """
+    判断这一轮对话能否使用缓存：缓存已开启、身份没有关闭缓存（PERSONAS 中 "cache": False）、
+    历史足够短，且消息较短。
+    """
+    if not config.REPLY_CACHE_ENABLED or history_len > config.REPLY_CACHE_MAX_HISTORY:
+        return False
+    persona = config.PERSONAS.get(str(identity_id)) or {}
+    if not persona.get("cache", True):
+        return False
+    normalized = normalize(message)
+    return 0 < len(normalized) <= config.REPLY_CACHE_MAX_MESSAGE_CHARS
+
+
+def _remove(key):
+    global _total_bytes
+    entry = _entries.pop(key)
+    _total_bytes -= entry[2]
+
+
+def get(identity_id, message):
+    """查找缓存的回复，未命中或已过期返回 None。"""
+    key = (str(identity_id), normalize(message))
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[1] <= now:
+            _remove(key)
+            entry = None
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats["hits"] += 1
+        _stats["saved_seconds"] += entry[3]
+        return entry[0]
+
+
+def put(identity_id, message, reply, latency):
+    """
+    缓存一条回复，latency 为这次生成的耗时，用于统计命中节省的时间。
+    调用方需保证 reply 不是错误信息。
+    """
+    global _total_bytes
+    if not reply:
+        return
+    key = (str(identity_id), normalize(message))
+    size = len(key[1].encode('utf-8')) + len(reply.encode('utf-8'))
+    if size > config.REPLY_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        if key in _entries:
+            _remove(key)
+        _entries[key] = (reply, time.time() + config.REPLY_CACHE_TTL, size, latency)
+        _total_bytes += size
+        while _total_bytes > config.REPLY_CACHE_MAX_BYTES or len(_entries) > config.REPLY_CACHE_MAX_ENTRIES:
+            _remove(next(iter(_entries)))
+
+
+def clear():
+    """清空缓存（例如身份文件重新加载后）。"""
+    global _total_bytes
+    with _lock:
+        _entries.clear()
+        _total_bytes = 0
+
+
+def get_stats():
+    """返回命中数、未命中数、命中率、节省的生成时间（秒）、条目数和占用字节数。"""
+    with _lock:
+        stats = dict(_stats, size=len(_entries), bytes=_total_bytes)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
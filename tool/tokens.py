@@ -0,0 +1,13 @@
+# 粗略估计文本的 token 数，不依赖分词器：
+# 中日韩字符大约每个字 1 个 token，其他字符（英文、数字、标点）大约每 4 个字符 1 个 token。
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return 0x3000 <= code <= 0x9FFF or 0xF900 <= code <= 0xFAFF or 0xFF00 <= code <= 0xFFEF
+
+def estimate_tokens(text):
+    """估计一段文本的 token 数。"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
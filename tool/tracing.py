@@ -0,0 +1,384 @@
+import contextvars
+import cProfile
+import functools
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import pstats
+import random
+import threading
+import time
+import config
+
+# 按请求记录调用树（span）：入口用 start_trace() 开始一次追踪，各层用 span() / traced() 记录耗时。
+# 当前 span 保存在 contextvars 中；交给线程池或后台任务执行的函数需要先经过 bind()，
+# 这样它们的 span 会挂在同一棵树上，并且整棵树要等它们都结束后才算完成。
+# 没有被采样的请求里 span() 只做一次 contextvar 查询，直接返回空操作对象。
+# 总耗时超过 TRACE_SLOW_THRESHOLD 的请求整棵树写入按大小轮转的 JSONL 慢请求日志，用户 id 匿名化。
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+# 匿名化用的密钥：未配置时每个进程随机生成，同一进程内同一用户的匿名 id 相同
+_anon_key = (config.ANON_SALT or os.urandom(16).hex()).encode('utf-8')
+
+
+def anonymize(user_id):
+    """把 OpenID 转换为不可逆的短 id（HMAC-SHA256 前 16 位），空值原样返回。"""
+    if not user_id:
+        return user_id
+    digest = hmac.new(_anon_key, user_id.encode('utf-8'), hashlib.sha256).hexdigest()
+    return "u_" + digest[:16]
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'attrs', 'start', 'duration', 'error', 'children')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def set(self, **attrs):
+        """给 span 补充属性（如状态码、指令名）。"""
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin):
+        node = {"name": self.name, "start_ms": round((self.start - origin) * 1000, 3)}
+        # 还没结束的 span（如被丢弃的后台任务）不记录耗时
+        if self.duration is not None:
+            node["ms"] = round(self.duration * 1000, 3)
+        if self.attrs:
+            node["attrs"] = self.attrs
+        if self.error:
+            node["error"] = self.error
+        if self.children:
+            node["children"] = [child.to_dict(origin) for child in self.children]
+        return node
+
+
+class _NullSpan:
+    """没有被采样时使用的空操作 span。"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """一次请求的调用树。pending 为还没结束的持有者数（根 span 和经过 bind() 的函数）。"""
+
+    def __init__(self, name, attrs, profile):
+        self.id = os.urandom(8).hex()
+        self.started_at = time.time()
+        self.user = None
+        self.span_count = 1
+        self.dropped = 0
+        self.profile = profile
+        self.profiles = []
+        self._lock = threading.Lock()
+        self._pending = 1
+        self.root = Span(self, name, attrs)
+
+    def acquire(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            _finish_trace(self)
+
+
+class _SpanContext:
+    __slots__ = ('span', 'token')
+
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.duration = time.perf_counter() - span.start
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        _current.reset(self.token)
+        return False
+
+
+def span(name, **attrs):
+    """上下文管理器：在当前追踪中记录一个子 span，没有追踪时不做任何事。"""
+    parent = _current.get()
+    if parent is None:
+        return _NULL_SPAN
+    trace = parent.trace
+    if trace.span_count >= config.TRACE_MAX_SPANS:
+        trace.dropped += 1
+        return _NULL_SPAN
+    trace.span_count += 1
+    child = Span(trace, name, attrs)
+    parent.children.append(child)
+    return _SpanContext(child)
+
+
+def annotate(**attrs):
+    """给当前 span 补充属性，没有追踪时不做任何事。"""
+    current = _current.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def set_user(user_id):
+    """记录当前追踪对应的用户（写入日志时匿名化）。"""
+    current = _current.get()
+    if current is not None:
+        current.trace.user = user_id
+
+
+def traced(name=None):
+    """装饰器：把函数（或协程函数）的每次调用记录为一个 span，默认以函数名命名。"""
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Binding:
+    """bind() 对追踪的一次持有：调用结束或 discard() 时释放，只释放一次。"""
+    __slots__ = ('trace', 'released')
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.released = False
+        trace.acquire()
+
+    def release(self):
+        with self.trace._lock:
+            if self.released:
+                return
+            self.released = True
+        self.trace.release()
+
+
+def bind(func):
+    """
+    把 func 绑定到当前追踪，用于提交给线程池、注册为回调或创建后台任务的函数（协程函数也可以）。
+    没有追踪时原样返回 func。绑定后的函数必须被调用一次，追踪才会结束；
+    确定不会再调用时（如线程池已关闭、任务被取消）改为调用它的 discard()。
+    """
+    current = _current.get()
+    if current is None:
+        return func
+    trace = current.trace
+    binding = _Binding(trace)
+    context = contextvars.copy_context()
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            # 协程任务创建时已经复制了上下文，这里只需要负责追踪的结束
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                binding.release()
+        async_wrapper.discard = binding.release
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            if trace.profile:
+                return context.run(_run_profiled, trace, func, args, kwargs)
+            return context.run(func, *args, **kwargs)
+        finally:
+            binding.release()
+    wrapper.discard = binding.release
+    return wrapper
+
+
+# --- 性能分析 ---
+# 通过 /性能分析 指令（或 PROFILE_REQUESTS 配置）请求对接下来的 N 个请求做 cProfile。
+# cProfile 按线程工作，同一时间只分析一个请求，经过 bind() 的后台线程也会单独记录并最后合并。
+_profile_lock = threading.Lock()
+_profile_remaining = config.PROFILE_REQUESTS
+_profile_active = False
+
+
+def request_profiles(count):
+    """对接下来的 count 个请求做性能分析，0 为取消。"""
+    global _profile_remaining
+    with _profile_lock:
+        _profile_remaining = max(count, 0)
+
+
+def get_profile_status():
+    with _profile_lock:
+        return _profile_remaining, _profile_active
+
+
+def _take_profile_slot():
+    global _profile_remaining, _profile_active
+    if not _profile_remaining:  # 不加锁的快速判断，绝大多数请求到这里就返回
+        return False
+    with _profile_lock:
+        if _profile_remaining <= 0 or _profile_active:
+            return False
+        _profile_remaining -= 1
+        _profile_active = True
+        return True
+
+
+def _run_profiled(trace, func, args, kwargs):
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 这个线程中已经有其他分析器在运行
+        return func(*args, **kwargs)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        trace.profiles.append(profiler)
+
+
+def _save_profile(trace):
+    global _profile_active
+    try:
+        if not trace.profiles:
+            return None
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.id}.prof")
+        stats = pstats.Stats(trace.profiles[0])
+        for profiler in trace.profiles[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        print(f"性能分析结果已保存: {path}")
+        return path
+    except (OSError, TypeError) as e:
+        print(f"保存性能分析结果失败: {e}")
+        return None
+    finally:
+        with _profile_lock:
+            _profile_active = False
+
+
+# --- 慢请求日志 ---
+_slow_logger = None
+_slow_logger_lock = threading.Lock()
+
+
+def _get_slow_logger():
+    global _slow_logger
+    with _slow_logger_lock:
+        if _slow_logger is None:
+            os.makedirs(os.path.dirname(config.TRACE_SLOW_LOG), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                config.TRACE_SLOW_LOG, maxBytes=config.TRACE_SLOW_LOG_MAX_BYTES,
+                backupCount=config.TRACE_SLOW_LOG_BACKUPS, encoding='utf-8'
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger('chat_server.slow_requests')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _slow_logger = logger
+        return _slow_logger
+
+
+def _finish_trace(trace):
+    duration = time.perf_counter() - trace.root.start
+    profile_path = _save_profile(trace) if trace.profile else None
+    if duration < config.TRACE_SLOW_THRESHOLD and profile_path is None:
+        return
+    record = {
+        "trace": trace.id,
+        "time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(trace.started_at)),
+        "user": anonymize(trace.user),
+        "ms": round(duration * 1000, 3),
+        "spans": trace.root.to_dict(trace.root.start),
+    }
+    if trace.dropped:
+        record["dropped_spans"] = trace.dropped
+    if profile_path:
+        record["profile"] = profile_path
+    try:
+        _get_slow_logger().info(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str))
+    except OSError as e:
+        print(f"写入慢请求日志失败: {e}")
+
+
+class _TraceContext:
+    __slots__ = ('trace', 'token', 'profiler')
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.profiler = None
+
+    def __enter__(self):
+        self.token = _current.set(self.trace.root)
+        if self.trace.profile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                self.profiler = None
+        return self.trace.root
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if self.profiler is not None:
+            self.profiler.disable()
+            trace.profiles.append(self.profiler)
+        root = trace.root
+        root.duration = time.perf_counter() - root.start
+        if exc_type is not None:
+            root.error = exc_type.__name__
+        _current.reset(self.token)
+        trace.release()
+        return False
+
+
+def start_trace(name, **attrs):
+    """
+    上下文管理器：在入口处开始一次请求追踪，按 TRACE_SAMPLE_RATE 采样；
+    请求被选中做性能分析时总是追踪。没有被采样时返回空操作对象。
+    """
+    profile = _take_profile_slot()
+    if not profile and (config.TRACE_SAMPLE_RATE <= 0 or random.random() >= config.TRACE_SAMPLE_RATE):
+        return _NULL_SPAN
+    return _TraceContext(Trace(name, attrs, profile))
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+
+# 按用户串行处理消息：同一用户的消息按到达顺序逐条处理，不同用户之间完全并行。
+# 线程池中的任务用 submit_in_order 提交：同一用户的任务排成一条链，上一个结束后才把下一个交给线程池，
+# 排队中的消息不占用线程池的线程，一个用户连发多条消息不会挡住其他用户。
+# 只保证单进程内的顺序。
+
+_lock = threading.Lock()
+_async_locks = {}  # user_id -> [asyncio.Lock, 排队和处理中的协程数]，只在事件循环线程中访问
+_chains = {}  # user_id -> deque[(Future, fn, args, 提交时刻)]，队首为正在执行的任务，没有任务时删除
+_stats = {"acquired": 0, "contended": 0, "wait_total": 0.0, "wait_max": 0.0, "depth_max": 0}
+
+
+def _record_wait(waited):
+    with _lock:
+        _stats["acquired"] += 1
+        _stats["wait_total"] += waited
+        if waited > _stats["wait_max"]:
+            _stats["wait_max"] = waited
+
+
+def _record_depth(depth):
+    """记录排队深度（需持有 _lock）。"""
+    if depth > 1:
+        _stats["contended"] += 1
+    if depth > _stats["depth_max"]:
+        _stats["depth_max"] = depth
+
+
+def submit_in_order(executor, user_id, fn, *args):
+    """
+    把 fn(*args) 提交到 executor，同一用户的任务按提交顺序逐个执行，返回 Future。
+    前面还有该用户的任务时只在链上排队，等前一个执行完才交给线程池。
+    """
+    future = Future()
+    entry = (future, fn, args, time.perf_counter())
+    with _lock:
+        chain = _chains.get(user_id)
+        if chain is None:
+            chain = _chains[user_id] = deque()
+        chain.append(entry)
+        _record_depth(len(chain))
+        is_head = len(chain) == 1
+    if is_head:
+        _submit_head(executor, user_id, entry)
+    return future
+
+
+def _submit_head(executor, user_id, entry):
+    try:
+        executor.submit(_run_chained, executor, user_id, entry)
+    except RuntimeError as e:
+        # 线程池已关闭：链上剩下的任务都无法执行
+        with _lock:
+            chain = _chains.pop(user_id, ())
+        for future, fn, *_ in chain:
+            _discard(fn)
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+
+
+def _discard(fn):
+    """fn 不会被执行：经过 tracing.bind() 的函数需要释放对追踪的持有。"""
+    discard = getattr(fn, 'discard', None)
+    if discard is not None:
+        discard()
+
+
+def _run_chained(executor, user_id, entry):
+    future, fn, args, submitted_at = entry
+    _record_wait(time.perf_counter() - submitted_at)
+    result = error = None
+    if future.set_running_or_notify_cancel():
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            error = e
+    else:
+        _discard(fn)
+
+    # 先让出给该用户的下一条消息，再设置结果（结果的回调可能推送客服消息，不应推迟下一条）
+    with _lock:
+        chain = _chains[user_id]
+        chain.popleft()
+        next_entry = chain[0] if chain else None
+        if next_entry is None:
+            del _chains[user_id]
+    if next_entry is not None:
+        _submit_head(executor, user_id, next_entry)
+
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+@asynccontextmanager
+async def hold_async(user_id):
+    """
+    在同一用户的协程之间串行执行一段代码，供异步入口使用。asyncio.Lock 按请求顺序唤醒等待者，
+    因此同一用户的协程按调用顺序依次执行，等待时不占用线程。只能在同一个事件循环中使用。
+    """
+    entry = _async_locks.get(user_id)
+    if entry is None:
+        entry = _async_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    with _lock:
+        _record_depth(entry[1])
+    start = time.perf_counter()
+    try:
+        async with entry[0]:
+            _record_wait(time.perf_counter() - start)
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and _async_locks.get(user_id) is entry:
+            del _async_locks[user_id]
+
+
+def get_stats():
+    """
+    返回排队统计：当前有消息在处理的用户数、排队中的消息总数、
+    历史最大队列深度、需要等待的次数、平均和最长等待时间（秒）。
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["active_users"] = len(_async_locks) + len(_chains)
+        stats["queued"] = sum(len(chain) for chain in _chains.values())
+        stats["queued"] += sum(entry[1] for entry in list(_async_locks.values()))
+    stats["wait_avg"] = stats["wait_total"] / stats["acquired"] if stats["acquired"] else 0.0
+    return stats
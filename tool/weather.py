@@ -1,6 +1,19 @@
 import requests
-from bs4 import BeautifulSoup, FeatureNotFound
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+import json
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import config
+import tool.http_client as http_client
+import tool.metrics as metrics
+from tool.city_matcher import CityMatcher
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能单进程运行，总是自己抓取
+    fcntl = None
 
 HEADERS = {
     "User-Agent": (
@@ -20,97 +33,331 @@ URLS = [
     "http://www.weather.com.cn/textFC/xn.shtml",
 ]
 
-# 用于存储天气数据的全局缓存
-_weather_data_cache = {}
+# 城市别名：{别名: 天气网中的城市名}，只有目标城市存在时才生效
+CITY_ALIASES = {
+    "帝都": "北京",
+    "魔都": "上海",
+    "羊城": "广州",
+    "鹏城": "深圳",
+    "蓉城": "成都",
+    "山城": "重庆",
+    "春城": "昆明",
+    "泉城": "济南",
+    "冰城": "哈尔滨",
+    "江城": "武汉",
+}
+
+# 多进程共享的天气快照：负责抓取的进程写入临时文件后原子替换，其他进程按版本重新加载
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOT_FILE = os.path.join(BASE_DIR, 'weather_snapshot.json')
+LOCK_FILE = SNAPSHOT_FILE + '.lock'
+
+# 用于存储天气数据的进程内缓存：(天气数据, 城市名匹配器)，刷新时整体替换
+_weather_data_cache = ({}, CityMatcher({}))
+# 每个地区最近一次成功抓取的数据，某个地区抓取失败时沿用旧数据。
+# 按地区保存在快照中，重启或由其他进程接替抓取时从快照恢复，失败的地区不会因此丢失
+_region_data = {}
 
-def make_soup(html: str) -> BeautifulSoup:
-    for parser in ("html5lib", "lxml", "html.parser"):
+# 快照状态：已加载快照的版本（文件的 inode 和修改时间）、下次检查版本的时间、抓取锁
+_snapshot_lock = threading.Lock()
+_snapshot_version = None
+_next_snapshot_check = 0.0
+_refresher_lock_file = None
+
+# 数据新鲜度：当前数据的抓取时间；启动时从快照加载的数据在刷新成功前视为过期
+_data_updated_at = None
+_stale_before = None
+
+def make_soup(html: str, parse_only=None) -> BeautifulSoup:
+    # lxml 最快且支持 parse_only；html5lib 会忽略 parse_only，因此放在最后
+    for parser in ("lxml", "html.parser", "html5lib"):
         try:
-            return BeautifulSoup(html, parser)
+            return BeautifulSoup(html, parser, parse_only=parse_only)
         except FeatureNotFound:
             continue
-    raise RuntimeError("未找到可用的 HTML 解析器，请安装 html5lib 或 lxml。")
+    raise RuntimeError("未找到可用的 HTML 解析器，请安装 lxml 或 html5lib。")
 
-def _fetch_all_weather_data():
+def _fetch_region_html(url):
+    """下载一个地区的页面，失败返回 None。"""
+    try:
+        resp = http_client.get(url, headers=HEADERS, timeout=10)
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"请求 {url} 失败: {e}")
+        return None
+    # 天气网页面为 UTF-8；响应头没有声明编码时不再做耗时的编码探测
+    if 'charset' not in resp.headers.get('Content-Type', '').lower():
+        resp.encoding = "utf-8"
+    return resp.text
+
+def parse_region(html):
     """
-    一次性爬取所有地区的天气数据并返回一个字典。
+    解析一个地区页面中今天的天气表格，返回 {城市: 天气数据}。
+    只构建 div.conMidtab 子树，不解析整个页面。
     """
-    all_data = {}
-    for url in URLS:
-        try:
-            resp = requests.get(url, headers=HEADERS, timeout=10)
-            resp.encoding = resp.apparent_encoding or "utf-8"
-            text = resp.text
-        except requests.exceptions.RequestException as e:
-            print(f"请求 {url} 失败: {e}")
-            continue
+    region = {}
+    soup = make_soup(html, parse_only=SoupStrainer("div", class_="conMidtab"))
+    div_conMidtab = soup.find("div", class_="conMidtab")
+    if not div_conMidtab:
+        return region
 
-        soup = make_soup(text)
-        div_conMidtab = soup.find("div", class_="conMidtab")
-        if not div_conMidtab:
+    tables = div_conMidtab.find_all("table")
+    for table in tables:
+        trs = table.find_all("tr")
+        if len(trs) <= 2:
             continue
-
-        tables = div_conMidtab.find_all("table")
-        for table in tables:
-            trs = table.find_all("tr")
-            if len(trs) <= 2:
+        
+        for tr in trs[2:]:
+            tds = tr.find_all("td")
+            if len(tds) < 8:
                 continue
-            
-            for tr in trs[2:]:
-                tds = tr.find_all("td")
-                if len(tds) < 8:
-                    continue
 
-                try:
-                    city = next(tds[-8].stripped_strings, "")
-                    if not city:
-                        continue
-
-                    high_temp = next(tds[-5].stripped_strings, "-")
-                    low_temp = next(tds[-2].stripped_strings, "-")
-                    weather_day = next(tds[-7].stripped_strings, "-")
-                    weather_night = next(tds[-4].stripped_strings, "-")
-                    wind_day_parts = list(tds[-6].stripped_strings)
-                    wind_night_parts = list(tds[-3].stripped_strings)
-
-                    wind_day = "".join(wind_day_parts[:2]) if wind_day_parts else "--"
-                    wind_night = "".join(wind_night_parts[:2]) if wind_night_parts else "--"
-                    
-                    final_low = low_temp if low_temp != "-" else high_temp
-                    final_high = high_temp if high_temp != "-" else low_temp
-
-                    if final_low == final_high:
-                        temp_str = f"{final_high}摄氏度"
-                    else:
-                        temp_str = f"{final_low}至{final_high}摄氏度"
-                    
-                    all_data[city] = {
-                        "city": city,
-                        "temp": temp_str,
-                        "weather_type": weather_day if weather_day != "-" else weather_night,
-                        "wind": wind_day if wind_day != "--" else wind_night,
-                    }
-                except Exception:
+            try:
+                city = next(tds[-8].stripped_strings, "")
+                if not city:
                     continue
+
+                high_temp = next(tds[-5].stripped_strings, "-")
+                low_temp = next(tds[-2].stripped_strings, "-")
+                weather_day = next(tds[-7].stripped_strings, "-")
+                weather_night = next(tds[-4].stripped_strings, "-")
+                wind_day_parts = list(tds[-6].stripped_strings)
+                wind_night_parts = list(tds[-3].stripped_strings)
+
+                wind_day = "".join(wind_day_parts[:2]) if wind_day_parts else "--"
+                wind_night = "".join(wind_night_parts[:2]) if wind_night_parts else "--"
+                
+                final_low = low_temp if low_temp != "-" else high_temp
+                final_high = high_temp if high_temp != "-" else low_temp
+
+                if final_low == final_high:
+                    temp_str = f"{final_high}摄氏度"
+                else:
+                    temp_str = f"{final_low}至{final_high}摄氏度"
+                
+                region[city] = {
+                    "city": city,
+                    "temp": temp_str,
+                    "weather_type": weather_day if weather_day != "-" else weather_night,
+                    "wind": wind_day if wind_day != "--" else wind_night,
+                }
+            except Exception:
+                continue
+    return region
+
+def _fetch_region(url):
+    """下载并解析一个地区，失败返回 None。"""
+    html = _fetch_region_html(url)
+    if html is None:
+        return None
+    region = parse_region(html)
+    return region or None
+
+def _fetch_all_weather_data():
+    """
+    并发爬取所有地区的天气数据并返回一个字典。
+    抓取或解析失败的地区沿用上一次成功的数据；所有地区都失败时返回空字典。
+    """
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=config.WEATHER_FETCH_WORKERS) as executor:
+        futures = {executor.submit(_fetch_region, url): url for url in URLS}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                region = future.result()
+            except Exception as e:
+                print(f"解析 {url} 失败: {e}")
+                region = None
+            if region:
+                _region_data[url] = region
+                fetched += 1
+    if not fetched:
+        return {}
+
+    return _merge_regions(_region_data)
+
+def _merge_regions(regions):
+    """按 URLS 的顺序把各地区的数据合并为 {城市: 天气数据}。"""
+    all_data = {}
+    for url in URLS:
+        all_data.update(regions.get(url, {}))
     return all_data
 
+def _build_city_matcher(data):
+    """用城市名和别名构建匹配器。"""
+    names = {city: city for city in data}
+    for alias, city in CITY_ALIASES.items():
+        if city in data and alias not in names:
+            names[alias] = city
+    return CityMatcher(names)
+
+def _stat_version(path):
+    """用文件的 inode 和修改时间作为快照版本，原子替换后两者都会变化。"""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns)
+
+def _write_snapshot(regions, updated_at):
+    """把各地区的天气数据写入临时文件，再原子替换快照文件，读取方不会读到写了一半的文件。"""
+    global _snapshot_version
+    snapshot = {"version": time.time_ns(), "updated_at": updated_at, "regions": regions}
+    tmp_path = f"{SNAPSHOT_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, SNAPSHOT_FILE)
+        _snapshot_version = _stat_version(SNAPSHOT_FILE)
+    except OSError as e:
+        print(f"写入天气快照失败: {e}")
+
+def _load_snapshot():
+    """从快照文件加载天气数据，恢复各地区的数据并重建城市名匹配器，成功返回 True。"""
+    global _weather_data_cache, _snapshot_version, _data_updated_at, _region_data
+    try:
+        version = _stat_version(SNAPSHOT_FILE)
+        with open(SNAPSHOT_FILE, encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取天气快照失败: {e}")
+        return False
+    regions = snapshot.get("regions")
+    if regions:
+        # 接替抓取或重启后，抓取失败的地区沿用快照中的数据
+        _region_data = {url: region for url, region in regions.items() if url in URLS}
+        data = _merge_regions(_region_data)
+    else:
+        # 旧格式的快照只有合并后的数据，无法按地区恢复
+        data = snapshot.get("data") or {}
+    if data:
+        _weather_data_cache = (data, _build_city_matcher(data))
+        _data_updated_at = snapshot.get("updated_at")
+    _snapshot_version = version
+    return bool(data)
+
+def load_snapshot():
+    """
+    启动时立即加载上次保存的快照，不等待网络。
+    加载的数据在刷新成功之前标记为过期（is_stale），返回是否加载到数据。
+    """
+    global _stale_before
+    with _snapshot_lock:
+        loaded = _load_snapshot()
+    if loaded:
+        _stale_before = _data_updated_at
+    return loaded
+
+def _check_snapshot():
+    """
+    每隔 WEATHER_SNAPSHOT_CHECK_INTERVAL 秒检查一次快照版本，变化时重新加载。
+    其余时间只比较一次时间，查询几乎没有额外开销。
+    """
+    global _next_snapshot_check
+    now = time.monotonic()
+    if now < _next_snapshot_check:
+        return
+    with _snapshot_lock:
+        if now < _next_snapshot_check:
+            return
+        _next_snapshot_check = now + config.WEATHER_SNAPSHOT_CHECK_INTERVAL
+        try:
+            version = _stat_version(SNAPSHOT_FILE)
+        except OSError:
+            return
+        if version != _snapshot_version:
+            _load_snapshot()
+
+def _try_become_refresher():
+    """
+    尝试成为负责抓取的进程：对锁文件加非阻塞的排他锁，抢到后一直持有到进程退出。
+    负责抓取的进程退出后锁自动释放，其他进程在下一次刷新时接替。
+    """
+    global _refresher_lock_file
+    if _refresher_lock_file is not None or fcntl is None:
+        return True
+    lock_file = open(LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _refresher_lock_file = lock_file
+    return True
+
+def is_refresher():
+    """当前进程是否负责抓取天气。"""
+    return _refresher_lock_file is not None or fcntl is None
+
 def update_weather_cache():
     """
-    获取最新的天气数据并更新全局缓存。
+    获取最新的天气数据，写入共享快照，并连同城市名匹配器一起替换进程内缓存。
+    返回是否成功获取到数据。
     """
-    global _weather_data_cache
+    global _weather_data_cache, _data_updated_at
     new_data = _fetch_all_weather_data()
-    if new_data:
-        _weather_data_cache = new_data
+    if not new_data:
+        return False
+    updated_at = time.time()
+    _write_snapshot(dict(_region_data), updated_at)
+    _weather_data_cache = (new_data, _build_city_matcher(new_data))
+    _data_updated_at = updated_at
+    return True
+
+def refresh_shared_cache():
+    """
+    定时刷新：抢到抓取锁的进程抓取并写入快照，其他进程只重新加载快照。
+    返回是否刷新成功（其他进程需要快照中已有数据）。
+    """
+    if _try_become_refresher():
+        return update_weather_cache()
+    with _snapshot_lock:
+        return _load_snapshot()
+
+def get_data_age():
+    """返回当前天气数据距抓取时的秒数，没有数据时返回 None。"""
+    if _data_updated_at is None:
+        return None
+    return max(time.time() - _data_updated_at, 0)
 
+def is_stale():
+    """当前数据是否为启动时加载的旧快照（之后还没有刷新成功）。"""
+    return _stale_before is not None and _data_updated_at is not None and _data_updated_at <= _stale_before
+
+def get_staleness_note():
+    """数据过期时返回说明数据时间的提示，否则返回空字符串。"""
+    age = get_data_age()
+    if not is_stale() or age is None:
+        return ""
+    if age < 3600:
+        age_text = f"{max(int(age // 60), 1)}分钟"
+    elif age < 48 * 3600:
+        age_text = f"{int(age // 3600)}小时"
+    else:
+        age_text = f"{int(age // 86400)}天"
+    return f"（天气数据更新于{age_text}前，正在重新获取）"
+
+WEATHER_LOOKUP_SECONDS = metrics.histogram('chat_weather_lookup_seconds', '天气缓存查询的耗时（秒）', ('op',))
+metrics.gauge('chat_weather_cache_age_seconds', '天气数据距抓取时的秒数', get_data_age)
+metrics.gauge('chat_weather_cities', '天气缓存中的城市数', lambda: len(_weather_data_cache[0]))
+
+@metrics.timed_function(WEATHER_LOOKUP_SECONDS, 'get_weather')
 def get_weather(my_city: str):
     """
-    从缓存中获取指定城市的天气数据。
+    从缓存中获取指定城市的天气数据，支持别名。
+    """
+    _check_snapshot()
+    data = _weather_data_cache[0]
+    return data.get(my_city) or data.get(CITY_ALIASES.get(my_city))
+
+@metrics.timed_function(WEATHER_LOOKUP_SECONDS, 'find_cities')
+def find_cities(message: str):
+    """
+    一次扫描找出消息中提到的所有城市（按出现顺序），重叠时优先较长的城市名。
     """
-    return _weather_data_cache.get(my_city)
+    _check_snapshot()
+    return _weather_data_cache[1].find_all(message)
 
 def get_all_cities():
     """
     返回缓存中所有城市的列表。
     """
-    return list(_weather_data_cache.keys())
\ No newline at end of file
+    _check_snapshot()
+    return list(_weather_data_cache[0].keys())
\ No newline at end of file
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import threading
+import time
+import requests
+import config
+import tool.http_client as http_client
+
+# access_token 缓存，多个线程共享
+_token_lock = threading.Lock()
+_access_token = None
+_token_expire_at = 0
+
+# 表示 access_token 失效的错误码，遇到时刷新后重试一次
+TOKEN_INVALID_CODES = {40001, 40014, 42001}
+
+
+def check_signature(signature, timestamp, nonce):
+    """校验微信服务器请求的签名（服务器配置验证时使用）。"""
+    tmp_list = [config.TOKEN, str(timestamp), str(nonce)]
+    tmp_list.sort()
+    tmp_str = ''.join(tmp_list)
+    hashcode = hashlib.sha1(tmp_str.encode('utf-8')).hexdigest()
+    return hashcode == signature
+
+
+def get_access_token(force_refresh=False):
+    """
+    获取微信全局接口的 access_token，并缓存到过期前5分钟。
+    """
+    global _access_token, _token_expire_at
+    with _token_lock:
+        if not force_refresh and _access_token and time.time() < _token_expire_at:
+            return _access_token
+
+        url = f"{config.WECHAT_API_BASE}/cgi-bin/token"
+        params = {
+            "grant_type": "client_credential",
+            "appid": config.APP_ID,
+            "secret": config.APP_SECRET,
+        }
+        try:
+            response = http_client.get(url, params=params, timeout=5)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"请求 access_token 时发生错误: {e}")
+            return None
+
+        if "access_token" not in result:
+            print(f"获取 access_token 失败：{result}")
+            return None
+
+        _access_token = result["access_token"]
+        _token_expire_at = time.time() + int(result.get("expires_in", 7200)) - 300
+        return _access_token
+
+
+def build_text_message_body(openid, content):
+    """构造客服文本消息的请求体（UTF-8 编码的 JSON）。"""
+    payload = {"touser": openid, "msgtype": "text", "text": {"content": content}}
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def check_send_result(result):
+    """
+    检查客服消息接口的返回：成功返回 True，access_token 失效（应刷新后重试）返回 None，
+    其他错误返回 False。
+    """
+    errcode = result.get("errcode", 0)
+    if errcode == 0:
+        return True
+    if errcode in TOKEN_INVALID_CODES:
+        return None
+    print(f"发送客服消息失败：{result}")
+    return False
+
+
+def send_text_message(openid, content):
+    """
+    通过客服消息接口向用户推送一条文本消息，成功返回 True。
+    """
+    body = build_text_message_body(openid, content)
+
+    for attempt in range(2):
+        token = get_access_token(force_refresh=attempt > 0)
+        if not token:
+            return False
+
+        url = f"{config.WECHAT_API_BASE}/cgi-bin/message/custom/send"
+        try:
+            response = http_client.post(url, params={"access_token": token}, data=body, timeout=5)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"发送客服消息时发生错误: {e}")
+            return False
+
+        ok = check_send_result(result)
+        if ok is not None:
+            return ok
+    return False
+
+
+def split_segments(buffer):
+    """
+    从缓冲区切出可以推送的完整句子（至少 STREAM_SEGMENT_CHARS 字），返回 (段列表, 剩余文本)。
+    """
+    segments = []
+    while len(buffer) >= config.STREAM_SEGMENT_CHARS:
+        cut = max(buffer.rfind(ch) for ch in config.SENTENCE_ENDINGS)
+        if cut + 1 < config.STREAM_SEGMENT_CHARS:
+            break
+        segment, buffer = buffer[:cut + 1], buffer[cut + 1:]
+        if segment.strip():
+            segments.append(segment.strip())
+    return segments, buffer
+
+
+class StreamingReply:
+    """
+    收集模型流式生成的文本。被动回复超时后调用 start()，
+    之后每积累够 STREAM_SEGMENT_CHARS 字并遇到句子结尾就通过客服消息推送一段，
+    finish() 推送剩余内容。
+    """
+
+    def __init__(self, openid):
+        self.openid = openid
+        self._lock = threading.Lock()
+        self._buffer = ""
+        self._received = False
+        self._started = False
+
+    def on_text(self, piece):
+        with self._lock:
+            self._buffer += piece
+            self._received = True
+            if self._started:
+                self._send_segments()
+
+    def start(self):
+        """切换为异步推送模式，先推送已经积累的完整句子。"""
+        with self._lock:
+            self._started = True
+            self._send_segments()
+
+    def finish(self, content):
+        """
+        生成结束后推送剩余文本。没有收到任何流式文本时（如天气回复、出错）推送 content。
+        """
+        with self._lock:
+            remainder = self._buffer if self._received else content
+            self._buffer = ""
+            if remainder and remainder.strip():
+                self._send(remainder.strip())
+
+    def _send_segments(self):
+        segments, self._buffer = split_segments(self._buffer)
+        for segment in segments:
+            self._send(segment)
+
+    def _send(self, content):
+        if not send_text_message(self.openid, content):
+            print(f"客服消息推送失败: {self.openid}")
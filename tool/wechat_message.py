@@ -0,0 +1,95 @@
+import time
+import xml.etree.ElementTree as ET
+import tool.metrics as metrics
+
+# 微信消息的解析、分发和被动回复编码。
+# 入口（main.py、server_async.py）各自创建一个 Dispatcher，按 MsgType / Event 注册处理函数。
+
+# 解析和编码的耗时、消息计数都由入口在调用处记录，编解码函数本身不做统计
+PARSE_SECONDS = metrics.histogram('chat_xml_parse_seconds', '解析消息XML的耗时（秒）')
+ENCODE_SECONDS = metrics.histogram('chat_reply_encode_seconds', '编码被动回复XML的耗时（秒）')
+MESSAGES = metrics.counter('chat_messages_total', '收到的消息数，按 MsgType 统计', ('msg_type',))
+# 入口吞掉（只回复 success）的处理异常，按异常类名统计
+HANDLER_ERRORS = metrics.counter('chat_handler_errors_total', '处理消息时被忽略的异常次数', ('error',))
+
+
+class WechatMessage:
+    """解析后的一条微信消息或事件，不存在的字段为 None。"""
+    __slots__ = ('to_user', 'from_user', 'create_time', 'msg_type', 'msg_id',
+                 'content', 'event', 'event_key')
+
+    def __init__(self, fields):
+        self.to_user = fields.get('ToUserName')
+        self.from_user = fields.get('FromUserName')
+        self.create_time = fields.get('CreateTime')
+        self.msg_type = fields.get('MsgType')
+        self.msg_id = fields.get('MsgId')
+        self.content = fields.get('Content')
+        self.event = fields.get('Event')
+        self.event_key = fields.get('EventKey')
+
+
+def parse(xml_data):
+    """
+    解析微信推送的消息XML，只遍历一次根节点的子元素。
+    格式错误或缺少 FromUserName / MsgType 时抛出 ValueError。
+    """
+    try:
+        root = ET.fromstring(xml_data)
+    except ET.ParseError as e:
+        raise ValueError(f"消息XML格式错误: {e}") from None
+    message = WechatMessage({child.tag: child.text for child in root})
+    if not message.from_user or not message.msg_type:
+        raise ValueError("消息缺少 FromUserName 或 MsgType")
+    return message
+
+
+class Dispatcher:
+    """
+    按 (MsgType, Event) 查找处理函数。事件先按具体的 Event 查找，
+    找不到时退回只按 MsgType 注册的处理函数；Event 不区分大小写。
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, msg_type, event=None):
+        """装饰器：注册某类消息（或某个事件）的处理函数。"""
+        key = (msg_type, event.lower() if event else None)
+
+        def decorator(func):
+            self._handlers[key] = func
+            return func
+        return decorator
+
+    def resolve(self, message):
+        """返回消息对应的处理函数，没有注册时返回 None。"""
+        if message.event:
+            handler = self._handlers.get((message.msg_type, message.event.lower()))
+            if handler is not None:
+                return handler
+        return self._handlers.get((message.msg_type, None))
+
+
+def escape_cdata(text):
+    """CDATA 中不能出现 ]]>，把它拆到两个相邻的 CDATA 段中。"""
+    if "]]>" not in text:
+        return text
+    return text.replace("]]>", "]]]]><![CDATA[>")
+
+
+def encode_text_reply(to_user, from_user, content, create_time=None):
+    """
+    构造被动回复的文本消息XML。
+    使用不带缩进和换行的紧凑模板；f-string 在编译时就拆成了常量片段，拼接时无需再解析模板。
+    只有回复内容中出现 ]]> 时才转义；ToUserName / FromUserName 是微信的 openid 和原始ID，只含字母、数字、_ 和 -。
+    """
+    if "]]>" in content:
+        content = escape_cdata(content)
+    return (
+        f"<xml><ToUserName><![CDATA[{to_user}]]></ToUserName>"
+        f"<FromUserName><![CDATA[{from_user}]]></FromUserName>"
+        f"<CreateTime>{int(create_time or time.time())}</CreateTime>"
+        f"<MsgType><![CDATA[text]]></MsgType>"
+        f"<Content><![CDATA[{content}]]></Content></xml>"
+    )